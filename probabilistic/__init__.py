@@ -2,27 +2,72 @@
 """
 Random variable generators
 """
-from erp import flip, gaussian, gamma, beta, binomial, poisson, dirichlet, multinomial, uniform, multinomialDraw, uniformDraw
+from erp import flip, gaussian, gamma, beta, binomial, poisson, dirichlet, multinomial, uniform, randomInteger, multinomialDraw, uniformDraw, MultinomialWeights
+from lazy import lazy
 
 
 """
 Hard and soft constraints
 """
-from trace import condition, factor
+from trace import condition, factor, observe
 def softEq(a, b, tolerance):
 	return erp.gaussian_logprob(a-b, 0, tolerance)
 
 
+"""
+Observation datasets
+"""
+from dataset import Dataset, saveDataset
+
+
 """
 Inference procedures
 """
-from inference import mean, distrib, expectation, MAP, rejectionSample, traceMH, LARJMH
+from inference import mean, distrib, expectation, MAP, rejectionSample, traceMH, sliceMH, LARJMH, multipleTryMH, subsampledMH, amortizedQuery, VariableRecorder, TraceRecorder
+from inference import mcmcIterator, traceMHIterator, LARJMHIterator, QueryPool
+from resultcache import ResultCache
+from tempering import temperedMH
+from ensemble import ensembleMH
+from variational import meanFieldVI, fitMeanField
+from diagnostics import budgetedMCMC, budgetedTraceMH, budgetedLARJMH
+from warmstart import reattachTrace, warmStart, smcUpdate
+from optimization import annealedMAP, annealedMAPTrace, MAPOptimizer
+
+
+"""
+Convergence diagnostics
+"""
+from diagnostics import effectiveSampleSize, monteCarloStandardError, mserBurnIn, SampleList
+
+
+"""
+Inference server
+"""
+from server import InferenceServer
+
+
+"""
+Random number streams
+"""
+from randomstream import RandomStream, BufferedRandomStream
 
 
 """
 Control structures
 """
-from control import ntimes, foreach, until, repeat
+from control import ntimes, foreach, plate, until, repeat
+
+
+"""
+Static addressing
+"""
+from program import program
+
+
+"""
+Collapsed conjugate priors
+"""
+from conjugacy import collapsed
 
 
 """
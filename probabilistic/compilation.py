@@ -0,0 +1,307 @@
+from __future__ import division
+import trace
+import math
+import operator
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class CompileError(Exception):
+	"""
+	Raised when a program cannot be compiled into a flat log-density
+	(e.g. because a random value is used in control flow)
+	"""
+	pass
+
+
+class Symbol(object):
+	"""
+	Stand-in for a value that depends on the free random choices of a trace.
+	Arithmetic on symbols is recorded as straight-line code by the compiler;
+	anything that needs a concrete value raises CompileError.
+	"""
+
+	__slots__ = ["compiler", "var"]
+
+	def __init__(self, compiler, var):
+		self.compiler = compiler
+		self.var = var
+
+	def _binop(self, fmt, other, reverse=False):
+		a = self.compiler.operand(self)
+		b = self.compiler.operand(other)
+		return self.compiler.emit(fmt.format(*((b, a) if reverse else (a, b))))
+
+	def _unop(self, fmt):
+		return self.compiler.emit(fmt.format(self.compiler.operand(self)))
+
+	__add__ = lambda self, other: self._binop("{0} + {1}", other)
+	__radd__ = lambda self, other: self._binop("{0} + {1}", other, True)
+	__sub__ = lambda self, other: self._binop("{0} - {1}", other)
+	__rsub__ = lambda self, other: self._binop("{0} - {1}", other, True)
+	__mul__ = lambda self, other: self._binop("{0} * {1}", other)
+	__rmul__ = lambda self, other: self._binop("{0} * {1}", other, True)
+	__div__ = lambda self, other: self._binop("_div({0}, {1})", other)
+	__rdiv__ = lambda self, other: self._binop("_div({0}, {1})", other, True)
+	__truediv__ = lambda self, other: self._binop("{0} / {1}", other)
+	__rtruediv__ = lambda self, other: self._binop("{0} / {1}", other, True)
+	__floordiv__ = lambda self, other: self._binop("{0} // {1}", other)
+	__rfloordiv__ = lambda self, other: self._binop("{0} // {1}", other, True)
+	__mod__ = lambda self, other: self._binop("{0} % {1}", other)
+	__rmod__ = lambda self, other: self._binop("{0} % {1}", other, True)
+	__pow__ = lambda self, other: self._binop("{0} ** {1}", other)
+	__rpow__ = lambda self, other: self._binop("{0} ** {1}", other, True)
+	__lt__ = lambda self, other: self._binop("{0} < {1}", other)
+	__le__ = lambda self, other: self._binop("{0} <= {1}", other)
+	__gt__ = lambda self, other: self._binop("{0} > {1}", other)
+	__ge__ = lambda self, other: self._binop("{0} >= {1}", other)
+	__eq__ = lambda self, other: self._binop("{0} == {1}", other)
+	__ne__ = lambda self, other: self._binop("{0} != {1}", other)
+	__neg__ = lambda self: self._unop("-{0}")
+	__pos__ = lambda self: self._unop("+{0}")
+	__abs__ = lambda self: self._unop("abs({0})")
+	__invert__ = lambda self: self._unop("~{0}")
+
+	def _concrete(self, *args):
+		raise CompileError("Random value used where a concrete value is needed")
+
+	__nonzero__ = __float__ = __int__ = __long__ = __index__ = __hash__ = _concrete
+	__len__ = __iter__ = __getitem__ = __contains__ = __reduce__ = __reduce_ex__ = _concrete
+
+
+class _DensityCompiler:
+	"""
+	Stands in for the current trace while the program runs once, recording
+	straight-line code for everything that feeds into the log probability,
+	the conditions and the return value
+	"""
+
+	def __init__(self, tr):
+		self.trace = tr
+		self.staticAddressing = False
+		self.lines = []
+		self.consts = []
+		self.constIndices = {}
+		self.numTemps = 0
+		self.varIndex = 0
+		self.freeRecords = []
+		self.paramVars = []
+
+	@property
+	def rng(self):
+		# Only nested queries ask the current trace for its stream; their
+		# choices would otherwise be frozen into the compiled code as constants
+		raise CompileError("Programs with nested queries cannot be compiled")
+
+	def emit(self, expr):
+		var = "t{0}".format(self.numTemps)
+		self.numTemps += 1
+		self.lines.append("{0} = {1}".format(var, expr))
+		return Symbol(self, var)
+
+	def const(self, value):
+		key = id(value)
+		if key not in self.constIndices:
+			self.constIndices[key] = len(self.consts)
+			self.consts.append(value)
+		return "c[{0}]".format(self.constIndices[key])
+
+	def operand(self, value):
+		"""
+		Source expression for a value that may be, or may contain, symbols
+		"""
+		if isinstance(value, Symbol):
+			return value.var
+		if isinstance(value, (list, tuple)) and any(isinstance(v, (Symbol, list, tuple)) for v in value):
+			elems = ", ".join(self.operand(v) for v in value)
+			return ("[{0}]" if isinstance(value, list) else "({0},)").format(elems)
+		if isinstance(value, (bool, int, long)) or (isinstance(value, float) and not math.isinf(value) and not math.isnan(value)):
+			return repr(value)
+		return self.const(value)
+
+	def lookup(self, erp, params, numFrameSkip, isStructural, conditionedValue=None):
+		if self.varIndex >= len(self.trace.varlist):
+			raise CompileError("Program made more random choices than its trace")
+		record = self.trace.varlist[self.varIndex]
+		self.varIndex += 1
+		isConditioned = (conditionedValue != None)
+		if record.erp is not erp or record.structural != isStructural or record.conditioned != isConditioned or \
+		   record.stats is not None:
+			raise CompileError("Program structure does not match its trace")
+		paramsexpr = self.operand(params)
+		if isConditioned:
+			val = conditionedValue
+		else:
+			val = self.emit("x[{0}]".format(len(self.freeRecords)))
+			self.freeRecords.append(record)
+			self.paramVars.append(self.emit(paramsexpr).var)
+			paramsexpr = self.paramVars[-1]
+		self.lines.append(("score", erp, self.operand(val), paramsexpr))
+		return val
+
+	def lookupObservation(self, erp, params, data, numFrameSkip):
+		if self.varIndex >= len(self.trace.varlist):
+			raise CompileError("Program made more random choices than its trace")
+		record = self.trace.varlist[self.varIndex]
+		self.varIndex += 1
+		if record.erp is not erp or record.stats is None:
+			raise CompileError("Program structure does not match its trace")
+		stats = (record.stats if record.val is data else trace.sufficientStatistics(erp, data))
+		self.lines.append(("observe", erp, self.const(stats), self.operand(params)))
+
+	def addFactor(self, num):
+		self.lines.append("lp += {0}".format(self.operand(num)))
+
+	def conditionOn(self, boolexpr):
+		self.lines.append(("condition", self.operand(boolexpr)))
+
+	def run(self):
+		"""
+		Run the program once against the compiler, recording its code
+		"""
+		originalTrace = trace.setCurrentTrace(self)
+		try:
+			self.returnValue = self.trace.computation()
+		finally:
+			trace.setCurrentTrace(originalTrace)
+		if self.varIndex != len(self.trace.varlist):
+			raise CompileError("Program made fewer random choices than its trace")
+
+	def build(self, vectorized=False):
+		"""
+		Turn the recorded code into a log-density function.
+		A vectorized density takes NumPy arrays of values (one entry per
+		chain) and scores them with the ERPs' vectorized log probabilities.
+		"""
+		source = ["def _logdensity(x, c=c, _div=_div):", "\tlp = 0.0", "\tok = True"]
+		for line in self.lines:
+			# Scores, observations and conditions are rendered differently for vectorized densities
+			if isinstance(line, str):
+				pass
+			elif line[0] == "score":
+				erp, valexpr, paramsexpr = line[1:]
+				if vectorized and not erp.vectorized:
+					raise CompileError("ERP has no vectorized log probability")
+				logprob = (erp._vlogprob if vectorized else erp._logprob)
+				line = "lp += {0}({1}, {2})".format(self.const(logprob), valexpr, paramsexpr)
+			elif line[0] == "observe":
+				erp, statsexpr, paramsexpr = line[1:]
+				if vectorized and not erp.vectorized:
+					raise CompileError("ERP has no vectorized log probability")
+				logprob = (erp._vlogprobFromStatistics if vectorized else erp._logprobFromStatistics)
+				line = "lp += {0}({1}, {2})".format(self.const(logprob), statsexpr, paramsexpr)
+			elif line[0] == "condition":
+				line = ("ok = ok & ({0})" if vectorized else "if not {0}: ok = False").format(line[1])
+			source.append("\t" + line)
+		source.append("\treturn lp, ok, {0}, ({1})".format(self.operand(self.returnValue), \
+							"".join(p + ", " for p in self.paramVars)))
+		namespace = {"c": tuple(self.consts), "_div": operator.div}
+		exec compile("\n".join(source), "<compiled density>", "exec", division.compiler_flag, True) in namespace
+		return namespace["_logdensity"]
+
+
+class CompiledTrace(object):
+	"""
+	A fixed-structure execution trace whose log probability, conditions and
+	return value come from a compiled log-density function over the values
+	of its free variables, rather than from re-running the program
+	"""
+
+	def __init__(self, density, names, erps, values, rng, freeNames=None):
+		self.density = density
+		self.names = names
+		# Free variables are listed in the same order as in the interpreted trace,
+		# so a seeded chain makes the same choices either way
+		self.freeNames = (freeNames if freeNames is not None else names)
+		self.erps = erps
+		self.values = values
+		self.rng = rng
+		self.indices = dict((name, i) for i, name in enumerate(names))
+		self.newlogprob = 0.0
+		self.oldlogprob = 0.0
+		self.traceUpdate()
+
+	def traceUpdate(self, structureIsFixed=True):
+		self.logprob, self.conditionsSatisfied, self.returnValue, self.params = self.density(self.values)
+
+	def freeVarNames(self, structural=True, nonstructural=True):
+		return list(self.freeNames) if nonstructural else []
+
+	def getRecord(self, name):
+		i = self.indices.get(name)
+		if i is None:
+			return None
+		val = self.values[i]
+		return trace.RandomVariableRecord(name, self.erps[i], self.params[i], val, \
+										  self.erps[i]._logprob(val, self.params[i]), False)
+
+	@property
+	def _vars(self):
+		return dict((name, self.getRecord(name)) for name in self.names)
+
+	def proposeChange(self, varname):
+		i = self.indices[varname]
+		erp = self.erps[i]
+		params = self.params[i]
+		currval = self.values[i]
+		propval = erp._proposal(currval, params, self.rng)
+		fwdPropLP = erp._logProposalProb(currval, propval, params)
+		rvsPropLP = erp._logProposalProb(propval, currval, params)
+		return self.changeValue(varname, propval), fwdPropLP, rvsPropLP
+
+	def changeValue(self, varname, val):
+		values = list(self.values)
+		values[self.indices[varname]] = val
+		return CompiledTrace(self.density, self.names, self.erps, values, self.rng, self.freeNames)
+
+
+def compileTrace(tr):
+	"""
+	Compile a trace with no free structural variables into a CompiledTrace.
+	Returns None if the program cannot be compiled, in which case it
+	should keep being interpreted.
+	The program must make all of its random choices through ERPs.
+	"""
+	if len(tr.freeVarNames(nonstructural=False)) > 0:
+		return None
+	try:
+		compiler = _DensityCompiler(tr)
+		compiler.run()
+		density = compiler.build()
+		records = compiler.freeRecords
+		compiled = CompiledTrace(density, [r.name for r in records], [r.erp for r in records], \
+								 [r.val for r in records], tr.rng, tr.freeVarNames())
+		# Check that the compiled density reproduces the interpreter
+		if not (compiled.conditionsSatisfied == tr.conditionsSatisfied and \
+				abs(compiled.logprob - tr.logprob) <= 1e-9 * max(1.0, abs(tr.logprob)) and \
+				compiled.returnValue == tr.returnValue):
+			return None
+		return compiled
+	except Exception:
+		# Besides CompileErrors, ordinary code can fail on symbols in other ways
+		# (e.g. string formatting, or library functions that need numbers)
+		return None
+
+
+def compileVectorized(tr):
+	"""
+	Compile a trace with no free structural variables into a vectorized
+	log-density over arrays of free variable values.
+	Returns the density and the records of the free variables it takes,
+	or None if the program cannot be compiled this way.
+	"""
+	if len(tr.freeVarNames(nonstructural=False)) > 0:
+		return None
+	try:
+		compiler = _DensityCompiler(tr)
+		compiler.run()
+		density = compiler.build(vectorized=True)
+		records = compiler.freeRecords
+		lp, ok, ret, params = density([numpy.array([r.val]) for r in records])
+		if abs(float(numpy.ravel(lp)[0]) - tr.logprob) > 1e-6 * max(1.0, abs(tr.logprob)):
+			return None
+		return density, records
+	except Exception:
+		return None
@@ -0,0 +1,148 @@
+import erp
+import math
+import random
+
+
+class UncollapsibleUse(Exception):
+	"""
+	Raised when a collapsed variable is used in some way other than as
+	the parameter of a conjugate child, which has no closed form
+	"""
+
+	def __init__(self, variable):
+		Exception.__init__(self, "Collapsed variable used where its value is needed")
+		self.name = variable.name
+		self.owner = variable.owner
+
+
+class CollapsedVariable(object):
+	"""
+	Stand-in for a conjugate prior (beta, gamma or dirichlet) that has been
+	integrated out of a trace. It may only be passed as the parameter of
+	conditioned conjugate children (flip, poisson or multinomial, respectively),
+	which are then scored under its posterior predictive as it accumulates
+	their values. Once the program has run, it holds the exact posterior of the
+	variable given those children, from which sample() draws.
+	"""
+
+	def __init__(self, owner, name, erp, params):
+		self.owner = owner
+		self.name = name
+		self.erp = erp
+		self.posterior = list(params)
+
+	def sample(self, rng=random):
+		"""
+		Draw the variable from its posterior
+		"""
+		return self.erp._sample_impl(self.posterior, rng)
+
+	def mean(self):
+		"""
+		The posterior mean of the variable
+		"""
+		if self.erp is erp.beta:
+			a, b = self.posterior
+			return float(a) / (a + b)
+		if self.erp is erp.gamma:
+			a, b = self.posterior
+			return a*b
+		total = float(sum(self.posterior))
+		return map(lambda a: a / total, self.posterior)
+
+	def _observe(self, childErp, val):
+		"""
+		Log posterior predictive probability of one child value,
+		which is then added to the posterior
+		"""
+		post = self.posterior
+		if self.erp is erp.beta:
+			i = (0 if val else 1)
+			lp = math.log(float(post[i]) / (post[0] + post[1]))
+			post[i] += 1
+		elif self.erp is erp.gamma:
+			# Negative binomial; the gamma is parameterized by shape and scale
+			a, b = post
+			lp = erp.log_gamma(a + val) - erp.log_gamma(a) - erp.lnfact(val) + \
+				 val*math.log(b/(1.0 + b)) - a*math.log(1.0 + b)
+			post[0] = a + val
+			post[1] = b / (1.0 + b)
+		else:
+			if val < 0 or val >= len(post):
+				return -float('inf')
+			lp = math.log(post[val] / float(sum(post)))
+			post[val] += 1
+		return lp
+
+	def _observeStatistics(self, childErp, stats):
+		"""
+		Log marginal probability of a dataset of child values,
+		given its sufficient statistics
+		"""
+		post = self.posterior
+		if self.erp is erp.beta:
+			n, t = stats
+			a, b = post
+			lp = erp.log_beta(a + t, b + n - t) - erp.log_beta(a, b)
+			post[0] = a + t
+			post[1] = b + n - t
+		elif self.erp is erp.gamma:
+			n, s, slf = stats
+			a, b = post
+			lp = erp.log_gamma(a + s) - erp.log_gamma(a) - slf - a*math.log(b) - (a + s)*math.log(n + 1.0/b)
+			post[0] = a + s
+			post[1] = b / (1.0 + n*b)
+		else:
+			total = float(sum(post))
+			lp = erp.log_gamma(total) - erp.log_gamma(total + sum(count for val, count in stats))
+			for val, count in stats:
+				if val < 0 or val >= len(post):
+					return -float('inf')
+				lp += erp.log_gamma(post[val] + count) - erp.log_gamma(post[val])
+				post[val] += count
+		return lp
+
+	def _use(self, *args):
+		raise UncollapsibleUse(self)
+
+	__add__ = __radd__ = __sub__ = __rsub__ = __mul__ = __rmul__ = _use
+	__div__ = __rdiv__ = __truediv__ = __rtruediv__ = __floordiv__ = __rfloordiv__ = _use
+	__mod__ = __rmod__ = __pow__ = __rpow__ = __neg__ = __pos__ = __abs__ = _use
+	__lt__ = __le__ = __gt__ = __ge__ = _use
+	__nonzero__ = __float__ = __int__ = __long__ = __index__ = _use
+	__len__ = __iter__ = __getitem__ = __contains__ = _use
+
+
+def collapsedParent(childErp, params):
+	"""
+	The collapsed variable that is the conjugate parent of a random choice
+	with these parameters, or None if there is none.
+	Raises UncollapsibleUse if a collapsed variable appears in the
+	parameters in any other way.
+	"""
+	if isinstance(params, CollapsedVariable):
+		parent = params
+		if parent.erp.conjugateChild is not childErp:
+			raise UncollapsibleUse(parent)
+		return parent
+	parent = None
+	for p in params:
+		if isinstance(p, CollapsedVariable):
+			if parent is not None or len(params) != 1 or p.erp.conjugateChild is not childErp or \
+			   childErp is erp.multinomial:
+				raise UncollapsibleUse(p)
+			parent = p
+	return parent
+
+
+def collapsed(computation):
+	"""
+	Mark a probabilistic computation as one whose conjugate priors should be
+	integrated out of its traces. Each beta, gamma and dirichlet random choice
+	then returns a CollapsedVariable, unless (or until) the program is seen to
+	use it other than as the parameter of conditioned flip, poisson or
+	multinomial choices, or of observe(); such variables are sampled as usual
+	from then on.
+	"""
+	computation._collapseConjugates = True
+	return computation
@@ -1,3 +1,4 @@
+import trace
 
 def ntimes(times, block):
 	"""
@@ -14,6 +15,19 @@ def foreach(iterable, block):
 	for elem in iterable:
 		block(elem)
 
+def plate(data, block):
+	"""
+	'foreach' over conditionally independent items: block(item) may only
+	add to the log probability through conditioned random choices, 'observe'
+	and 'factor'. Subsampling kernels can then evaluate a random minibatch
+	of the items instead of all of them.
+	"""
+	t = trace.currentTrace()
+	if t is not None and getattr(t, "plateSelector", None) is not None and not t.inSubsampledPlate:
+		t.evaluatePlate(data, block)
+	else:
+		foreach(data, block)
+
 def until(condition, block):
 	"""
 	'while' loop control structure suitable for use inside probabilistic programs.
@@ -0,0 +1,85 @@
+import os
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class Dataset(object):
+	"""
+	A read-only sequence of observations stored in a NumPy (.npy) file.
+	The file is memory-mapped rather than loaded, so only the parts that are
+	touched get read, and every process that forks from (or unpickles) a
+	Dataset shares the same pages through the OS cache instead of a copy.
+	Items are returned as Python values; rows of a 2D array become lists.
+	Datasets can be passed to foreach, plate and observe; observe
+	summarizes them one chunk at a time.
+	"""
+
+	# Datasets are identified by their file (see resultcache.cacheKey)
+	_cacheKeyAttributes = ("path", "chunkSize")
+
+	def __init__(self, path, chunkSize=65536):
+		if numpy is None:
+			raise ImportError("Datasets require NumPy")
+		self.path = os.path.abspath(path)
+		self.chunkSize = chunkSize
+		self.array = numpy.load(self.path, mmap_mode="r")
+		self._stats = {}
+
+	def __reduce__(self):
+		# Pickled by path: the receiving process maps the same file
+		return (Dataset, (self.path, self.chunkSize), {"_stats": self._stats})
+
+	def __copy__(self):
+		return self
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __len__(self):
+		return len(self.array)
+
+	def __getitem__(self, index):
+		return self.array[index].tolist()
+
+	def __iter__(self):
+		for chunk in self.chunks():
+			for x in chunk.tolist():
+				yield x
+
+	def chunks(self):
+		"""
+		Iterate over the data in NumPy arrays of up to chunkSize items.
+		These are views of the mapped file, not copies.
+		"""
+		for start in xrange(0, len(self.array), self.chunkSize):
+			yield self.array[start:start+self.chunkSize]
+
+	def statistics(self, erp):
+		"""
+		Sufficient statistics of the data under an ERP, accumulated
+		one chunk at a time and cached
+		"""
+		stats = self._stats.get(erp)
+		if stats is None:
+			for chunk in self.chunks():
+				s = erp._sufficientStatistics(chunk.tolist())
+				stats = (s if stats is None else erp._combineStatistics(stats, s))
+			if stats is None:
+				stats = erp._sufficientStatistics([])
+			self._stats[erp] = stats
+		return stats
+
+
+def saveDataset(path, values, chunkSize=65536):
+	"""
+	Write a sequence of observations to a .npy file and
+	return a Dataset over it
+	"""
+	if numpy is None:
+		raise ImportError("Datasets require NumPy")
+	if not path.endswith(".npy"):
+		path += ".npy"
+	numpy.save(path, numpy.asarray(values))
+	return Dataset(path, chunkSize)
@@ -0,0 +1,194 @@
+import inference
+import math
+import time
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def _autocorrelations(xs):
+	"""
+	Autocorrelations of a sequence at lags 0, 1, 2, ...
+	(computed all at once with an FFT when NumPy is available,
+	otherwise one lag at a time as they are asked for)
+	"""
+	n = len(xs)
+	if numpy is not None:
+		x = numpy.asarray(xs, dtype=float) - numpy.mean(xs)
+		size = 1
+		while size < 2*n:
+			size *= 2
+		f = numpy.fft.rfft(x, size)
+		acov = numpy.fft.irfft(f * numpy.conjugate(f), size)[:n]
+		for r in (acov / acov[0]).tolist():
+			yield r
+	else:
+		m = sum(xs) / float(n)
+		x = [v - m for v in xs]
+		var = sum(v*v for v in x)
+		for k in xrange(n):
+			yield sum(x[i]*x[i+k] for i in xrange(n - k)) / var
+
+
+def effectiveSampleSize(xs):
+	"""
+	Effective sample size of a sequence of correlated numbers (e.g. a
+	statistic of successive MCMC samples), from Geyer's initial monotone
+	sequence estimate of its integrated autocorrelation time
+	"""
+	n = len(xs)
+	if n < 4 or min(xs) == max(xs):
+		return float(n)
+	rhos = _autocorrelations(xs)
+	tau = -1.0
+	prevPair = float('inf')
+	for m in xrange(n // 2):
+		pair = rhos.next() + rhos.next()
+		if pair <= 0.0:
+			break
+		pair = min(pair, prevPair)
+		tau += 2.0*pair
+		prevPair = pair
+	return n / max(tau, 1.0 / n)
+
+
+def monteCarloStandardError(xs):
+	"""
+	Standard error of the mean of a sequence of correlated numbers
+	"""
+	n = len(xs)
+	if n < 2:
+		return float('inf')
+	m = sum(xs) / float(n)
+	var = sum((x - m)**2 for x in xs) / (n - 1.0)
+	return math.sqrt(var / effectiveSampleSize(xs))
+
+
+def mserBurnIn(xs):
+	"""
+	Number of initial values of a sequence to discard as burn-in, chosen by
+	the marginal standard error rule (MSER): the cut, among the first half
+	of the sequence, that minimizes the squared standard error of the rest
+	"""
+	n = len(xs)
+	if n < 2:
+		return 0
+	# Suffix sums of the values and their squares
+	s = [0.0] * (n + 1)
+	ss = [0.0] * (n + 1)
+	for i in xrange(n - 1, -1, -1):
+		s[i] = s[i+1] + xs[i]
+		ss[i] = ss[i+1] + xs[i]*xs[i]
+	best = 0
+	bestScore = float('inf')
+	for d in xrange(n // 2 + 1):
+		k = float(n - d)
+		score = (ss[d] - s[d]*s[d]/k) / (k*k)
+		if score < bestScore:
+			best = d
+			bestScore = score
+	return best
+
+
+class SampleList(list):
+	"""
+	The samples returned by a budgeted sampler, along with how it stopped:
+	'stopReason' is 'ess' or 'mcse' if a target was reached, 'time' or
+	'iterations' if a budget ran out. Also records the number of samples
+	discarded as burn-in, the effective sample size and Monte Carlo standard
+	error of the monitored statistic over the samples kept, the number of
+	iterations run and the time taken.
+	"""
+
+	def __init__(self, samps, stopReason, burnIn, ess, mcse, iterations, elapsed):
+		list.__init__(self, samps)
+		self.stopReason = stopReason
+		self.burnIn = burnIn
+		self.ess = ess
+		self.mcse = mcse
+		self.iterations = iterations
+		self.elapsed = elapsed
+
+
+def _defaultStatistic(samp):
+	# Numeric return values are monitored directly; anything else through the log probability
+	val = samp[0]
+	return (float(val) if isinstance(val, (bool, int, long, float)) else samp[1])
+
+def _diagnose(values):
+	burnIn = mserBurnIn(values)
+	kept = values[burnIn:]
+	return burnIn, effectiveSampleSize(kept), monteCarloStandardError(kept)
+
+
+def budgetedMCMC(computation, kernel, targetESS=None, targetMCSE=None, timeBudget=None, maxIterations=None, \
+				 lag=1, statistic=None, verbose=False, recorder=None, seed=None, compiled=False, minSamples=100):
+	"""
+	Do MCMC using a given transition kernel until the samples drawn after
+	burn-in reach an effective sample size of 'targetESS' or a Monte Carlo
+	standard error of 'targetMCSE', or until 'timeBudget' seconds or
+	'maxIterations' iterations have been used, whichever comes first.
+	Convergence is judged on statistic(sample) for each (returnValue, logprob)
+	sample; by default, the return value if it is a number, and otherwise the
+	log probability. Burn-in is chosen with mserBurnIn and left out of the
+	returned SampleList (though not out of the recorder's records).
+	"""
+	if targetESS is None and targetMCSE is None and timeBudget is None and maxIterations is None:
+		raise ValueError("Budgeted MCMC needs a target or a budget")
+	statistic = (statistic if statistic else _defaultStatistic)
+	start = time.time()
+	deadline = (start + timeBudget if timeBudget is not None else None)
+	numsamps = ((maxIterations + lag - 1) // lag if maxIterations is not None else None)
+	samps = []
+	values = []
+	nextCheck = minSamples
+	stopReason = None
+	chain = inference.mcmcIterator(computation, kernel, numsamps, lag, False, recorder, seed, compiled, deadline)
+	try:
+		for samp in chain:
+			samps.append(samp)
+			values.append(statistic(samp))
+			if len(samps) >= nextCheck and (targetESS is not None or targetMCSE is not None):
+				burnIn, ess, mcse = _diagnose(values)
+				if verbose:
+					print "samples: {0}, burn-in: {1}, ESS: {2:.1f}, MCSE: {3:.4g}\r".format(len(samps), burnIn, ess, mcse),
+				if targetESS is not None and ess >= targetESS:
+					stopReason = "ess"
+					break
+				if targetMCSE is not None and mcse <= targetMCSE:
+					stopReason = "mcse"
+					break
+				# Checking at geometrically spaced sizes keeps the total cost of the checks linear
+				nextCheck = len(samps) + max(minSamples, len(samps) // 10)
+	finally:
+		chain.close()
+	if stopReason is None:
+		stopReason = ("iterations" if numsamps is not None and len(samps) >= numsamps else "time")
+	burnIn, ess, mcse = _diagnose(values)
+	result = SampleList(samps[burnIn:], stopReason, burnIn, ess, mcse, len(samps) * lag, time.time() - start)
+	if verbose:
+		print ""
+		print "Stopped by {0} after {1} iterations ({2:.3f}s): burn-in {3}, ESS {4:.1f}, MCSE {5:.4g}".format( \
+			stopReason, result.iterations, result.elapsed, burnIn, ess, mcse)
+		kernel.stats()
+	return result
+
+
+def budgetedTraceMH(computation, targetESS=None, targetMCSE=None, timeBudget=None, maxIterations=None, lag=1, \
+					statistic=None, verbose=False, recorder=None, seed=None, compiled=False):
+	"""
+	traceMH that runs until a target or a budget is reached (see budgetedMCMC)
+	"""
+	return budgetedMCMC(computation, inference.RandomWalkKernel(), targetESS, targetMCSE, timeBudget, maxIterations, \
+						lag, statistic, verbose, recorder, seed, compiled)
+
+
+def budgetedLARJMH(computation, annealSteps, jumpFreq=None, targetESS=None, targetMCSE=None, timeBudget=None, \
+				   maxIterations=None, lag=1, statistic=None, verbose=False, recorder=None, seed=None):
+	"""
+	LARJMH that runs until a target or a budget is reached (see budgetedMCMC)
+	"""
+	kernel = inference.LARJKernel(inference.RandomWalkKernel(structural=False), annealSteps, jumpFreq)
+	return budgetedMCMC(computation, kernel, targetESS, targetMCSE, timeBudget, maxIterations, \
+						lag, statistic, verbose, recorder, seed)
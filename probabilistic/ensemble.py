@@ -0,0 +1,121 @@
+import trace
+import compilation
+import randomstream
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def _select(mask, new, old):
+	"""
+	Per-chain choice between two results of a vectorized density
+	"""
+	if isinstance(new, (numpy.ndarray, numpy.generic)) or isinstance(old, (numpy.ndarray, numpy.generic)):
+		return numpy.where(mask, new, old)
+	if isinstance(new, (list, tuple)):
+		return type(new)(_select(mask, n, o) for n, o in zip(new, old))
+	return new
+
+def _unstack(value, n):
+	"""
+	Split a result of a vectorized density into one value per chain
+	"""
+	if isinstance(value, (numpy.ndarray, numpy.generic)):
+		return numpy.broadcast_to(value, (n,)).tolist()
+	if isinstance(value, (list, tuple)) and len(value) > 0:
+		return map(type(value), zip(*[_unstack(v, n) for v in value]))
+	return [value] * n
+
+
+class Ensemble:
+	"""
+	A set of Metropolis-Hastings chains over a fixed-structure program
+	that move in lockstep. The values of each free variable across all
+	chains are kept in one NumPy array, so a step evaluates proposals,
+	log probabilities and accept/reject decisions for every chain with a
+	handful of vectorized operations.
+	At each step, all chains propose a change to the same (randomly
+	chosen) variable.
+	"""
+
+	def __init__(self, computation, numChains, rng=None):
+		if numpy is None:
+			raise ImportError("Ensembles require NumPy")
+		self.rng = randomstream.makeStream(rng)
+		self.numChains = numChains
+		self.generator = numpy.random.RandomState([self.rng.getrandbits(32) for i in xrange(8)])
+		# Every chain gets its own independent starting point
+		traces = [trace.newTrace(computation, stream) for stream in self.rng.spawn(numChains)]
+		compiled = compilation.compileVectorized(traces[0])
+		if compiled is None:
+			raise ValueError("Ensembles require a fixed-structure program whose random choices all have vectorized ERPs")
+		self.density, records = compiled
+		self.names = [r.name for r in records]
+		self.erps = [r.erp for r in records]
+		if any(sorted(t.freeVarNames()) != sorted(self.names) for t in traces):
+			raise ValueError("Ensembles require a fixed-structure program")
+		self.values = [numpy.array([t.getRecord(name).val for t in traces]) for name in self.names]
+		lp, ok, self.returnValue, self.params = self.density(self.values)
+		self.logprob = lp + numpy.zeros(numChains)
+		self.proposalsMade = 0
+		self.proposalsAccepted = 0
+
+	def step(self):
+		"""
+		Advance every chain by one single-variable proposal
+		"""
+		if len(self.values) == 0:
+			return
+		n = self.numChains
+		j = self.generator.randint(len(self.values))
+		erp = self.erps[j]
+		params = self.params[j]
+		currvals = self.values[j]
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			propvals = erp._vproposal(currvals, params, self.generator)
+			fwdPropLP = erp._vlogProposalProb(currvals, propvals, params)
+			rvsPropLP = erp._vlogProposalProb(propvals, currvals, params)
+			values = list(self.values)
+			values[j] = propvals
+			lp, ok, ret, newparams = self.density(values)
+			acceptThresh = lp - self.logprob + rvsPropLP - fwdPropLP
+			accept = ok & (numpy.log1p(-self.generator.random_sample(n)) < acceptThresh)
+		self.values[j] = numpy.where(accept, propvals, currvals)
+		self.logprob = numpy.where(accept, lp, self.logprob)
+		self.returnValue = _select(accept, ret, self.returnValue)
+		self.params = _select(accept, newparams, self.params)
+		self.proposalsMade += n
+		self.proposalsAccepted += int(numpy.count_nonzero(accept))
+
+	def samples(self):
+		"""
+		The current (return value, log probability) of every chain
+		"""
+		return zip(_unstack(self.returnValue, self.numChains), self.logprob.tolist())
+
+	def stats(self):
+		print "Acceptance ratio: {0} ({1}/{2})".format(float(self.proposalsAccepted)/max(self.proposalsMade, 1), \
+													   self.proposalsAccepted, self.proposalsMade)
+
+
+def ensembleMH(computation, numsamps, numChains, lag=1, verbose=False, seed=None):
+	"""
+	Sample from a fixed-structure probabilistic computation using
+	'numChains' single-variable-proposal Metropolis-Hastings chains
+	that run in lockstep on a vectorized log-density.
+	Returns 'numsamps' samples from every chain.
+	"""
+	ensemble = Ensemble(computation, numChains, seed)
+	samps = []
+	iters = numsamps * lag
+	for i in xrange(iters):
+		ensemble.step()
+		if i % lag == 0:
+			if verbose:
+				print "iteration {0}\r".format(i),
+			samps.extend(ensemble.samples())
+	if verbose:
+		print ""
+		ensemble.stats()
+	return samps
@@ -1,19 +1,46 @@
 import random
 import trace
 import math
-import copy
+import bisect
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 """
 A bunch of sampling/pdf code adapted from jschurch:
 https://github.com/stuhlmueller/jschurch
 """
 
-class RandomPrimitive:
+
+"""
+Caches of parameter-dependent normalizing constants, keyed by parameters.
+ERP parameters seldom change between trace updates, so most log probability
+evaluations only look their normalizer up. A cache is emptied whenever it
+grows past normalizerCacheSize entries.
+"""
+normalizerCacheSize = 4096
+
+def _cacheNormalizer(cache, key, z):
+	if len(cache) >= normalizerCacheSize:
+		cache.clear()
+	cache[key] = z
+	return z
+
+class RandomPrimitive(object):
 	"""
 	Abstract base class for all ERPs
 	"""
 
-	def _sample_impl(self, params):
+	def __reduce__(self):
+		# The singleton ERPs pickle by name, so that traces sent to other
+		# processes still refer to the very same ERP objects
+		for name, value in globals().iteritems():
+			if value is self:
+				return name
+		return (self.__class__, (), self.__dict__)
+
+	def _sample_impl(self, params, rng=random):
 		pass
 
 	def _sample(self, params, isStructural, conditionedValue=None):
@@ -24,11 +51,11 @@ class RandomPrimitive:
 	def _logprob(self, val, params):
 		pass
 
-	def _proposal(self, currval, params):
+	def _proposal(self, currval, params, rng=random):
 		"""
 		Subclasses can override to do more efficient proposals
 		"""
-		return self._sample_impl(params)
+		return self._sample_impl(params, rng)
 
 	def _logProposalProb(self, currval, propval, params):
 		"""
@@ -36,6 +63,72 @@ class RandomPrimitive:
 		"""
 		return self._logprob(propval, params)
 
+	"""
+	Vectorized versions of the above, used by ensemble samplers.
+	Values are NumPy arrays with one entry per chain, parameters may be
+	arrays or scalars, and 'rs' is a numpy.random.RandomState.
+	Subclasses that implement them set 'vectorized' to True.
+	"""
+
+	vectorized = False
+
+	# The ERP of which this is a conjugate prior, if any
+	conjugateChild = None
+
+	# Only called on ERPs whose 'vectorized' is True
+	def _vsample(self, params, n, rs):
+		pass
+
+	# Only called on ERPs whose 'vectorized' is True
+	def _vlogprob(self, vals, params):
+		pass
+
+	def _vproposal(self, currvals, params, rs):
+		return self._vsample(params, len(currvals), rs)
+
+	def _vlogProposalProb(self, currvals, propvals, params):
+		return self._vlogprob(propvals, params)
+
+	"""
+	Scoring whole datasets of observations at once (see trace.observe).
+	Subclasses can override to summarize the data with sufficient
+	statistics, so rescoring it under new parameters takes O(1) time.
+	"""
+
+	def _sufficientStatistics(self, data):
+		return list(data)
+
+	def _logprobFromStatistics(self, stats, params):
+		return sum(self._logprob(x, params) for x in stats)
+
+	def _vlogprobFromStatistics(self, stats, params):
+		return sum(self._vlogprob(x, params) for x in stats)
+
+	def _combineStatistics(self, stats1, stats2):
+		"""
+		Statistics of the union of two datasets, from those of each
+		"""
+		return stats1 + stats2
+
+	"""
+	ERPs over the real numbers (or an interval of them), whose variables
+	can be moved by slice sampling, set 'continuous' to True and give the
+	interval their values lie in.
+	"""
+
+	continuous = False
+
+	def _support(self, params):
+		return (-float('inf'), float('inf'))
+
+	"""
+	Discrete ERPs list the values next to a given one,
+	which MAP search tries in turn.
+	"""
+
+	def _neighbors(self, val, params):
+		return []
+
 
 class FlipRandomPrimitive(RandomPrimitive):
 	"""
@@ -48,9 +141,9 @@ class FlipRandomPrimitive(RandomPrimitive):
 	def __call__(self, p=0.5, isStructural=False, conditionedValue=None):
 		return self._sample([p], isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
+	def _sample_impl(self, params, rng=random):
 		p = params[0]
-		randval = random.random()
+		randval = rng.random()
 		return randval < p
 
 	def _logprob(self, val, params):
@@ -59,12 +152,48 @@ class FlipRandomPrimitive(RandomPrimitive):
 		prob = (p if val else 1.0-p)
 		return math.log(prob)
 
-	def _proposal(self, currval, params):
+	def _proposal(self, currval, params, rng=random):
 		return not(currval)
 
 	def _logProposalProb(self, currval, propval, params):
 		return 0.0 		# There's only one way to flip a binary variable
 
+	def _neighbors(self, val, params):
+		return [not val]
+
+	vectorized = True
+
+	def _vsample(self, params, n, rs):
+		return rs.random_sample(n) < params[0]
+
+	def _vlogprob(self, vals, params):
+		p = params[0]
+		return numpy.log(numpy.where(vals, p, 1.0-p))
+
+	def _vproposal(self, currvals, params, rs):
+		return numpy.logical_not(currvals)
+
+	def _vlogProposalProb(self, currvals, propvals, params):
+		return 0.0
+
+	# Number of observations and number of them that are true
+	def _sufficientStatistics(self, data):
+		n = len(data)
+		return (n, sum(1 for x in data if x))
+
+	def _logprobFromStatistics(self, stats, params):
+		n, t = stats
+		p = params[0]
+		return (t*math.log(p) if t else 0.0) + ((n-t)*math.log(1.0-p) if n > t else 0.0)
+
+	def _vlogprobFromStatistics(self, stats, params):
+		n, t = stats
+		p = params[0]
+		return (t*numpy.log(p) if t else 0.0) + ((n-t)*numpy.log(1.0-p) if n > t else 0.0)
+
+	def _combineStatistics(self, stats1, stats2):
+		return (stats1[0] + stats2[0], stats1[1] + stats2[1])
+
 
 def gaussian_logprob(x, mu, sigma):
 	return -.5*(1.8378770664093453 + 2*math.log(sigma) + (x - mu)*(x - mu)/(sigma*sigma))
@@ -72,6 +201,9 @@ def gaussian_logprob(x, mu, sigma):
 def gaussian_logprob_sigmaSq(x, mu, sigmaSq):
 	return -.5*(1.8378770664093453 + math.log(sigmaSq) + (x - mu)*(x - mu)/sigmaSq)
 
+def vgaussian_logprob(x, mu, sigma):
+	return -.5*(1.8378770664093453 + 2*numpy.log(sigma) + (x - mu)*(x - mu)/(sigma*sigma))
+
 class GaussianRandomPrimitive(RandomPrimitive):
 	"""
 	ERP with Gaussian distribution
@@ -83,24 +215,64 @@ class GaussianRandomPrimitive(RandomPrimitive):
 	def __call__(self, mu, sigma, isStructural=False, conditionedValue=None):
 		return self._sample([mu,sigma], isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return random.gauss(params[0], params[1])
+	def _sample_impl(self, params, rng=random):
+		return rng.gauss(params[0], params[1])
 
 	def _logprob(self, val, params):
 		return gaussian_logprob(val, params[0], params[1])
 
 	# Drift kernel
-	def _proposal(self, currval, params):
-		return random.gauss(currval, params[1])
+	def _proposal(self, currval, params, rng=random):
+		return rng.gauss(currval, params[1])
 
 	# Drift kernel
 	def _logProposalProb(self, currval, propval, params):
 		return gaussian_logprob(propval, currval, params[1])
 
+	continuous = True
+
+	vectorized = True
+
+	def _vsample(self, params, n, rs):
+		return rs.normal(params[0], params[1], n)
+
+	def _vlogprob(self, vals, params):
+		return vgaussian_logprob(vals, params[0], params[1])
+
+	def _vproposal(self, currvals, params, rs):
+		return rs.normal(currvals, params[1])
+
+	def _vlogProposalProb(self, currvals, propvals, params):
+		return vgaussian_logprob(propvals, currvals, params[1])
+
+	# Number of observations, their mean and their sum of squared deviations from it
+	def _sufficientStatistics(self, data):
+		n = len(data)
+		m = math.fsum(data) / n if n > 0 else 0.0
+		return (n, m, math.fsum((x - m)*(x - m) for x in data))
+
+	def _logprobFromStatistics(self, stats, params):
+		n, m, ss = stats
+		mu, sigma = params
+		return -.5*(n*(1.8378770664093453 + 2*math.log(sigma)) + (ss + n*(m - mu)*(m - mu))/(sigma*sigma))
+
+	def _vlogprobFromStatistics(self, stats, params):
+		n, m, ss = stats
+		mu, sigma = params
+		return -.5*(n*(1.8378770664093453 + 2*numpy.log(sigma)) + (ss + n*(m - mu)*(m - mu))/(sigma*sigma))
+
+	def _combineStatistics(self, stats1, stats2):
+		n1, m1, ss1 = stats1
+		n2, m2, ss2 = stats2
+		n = n1 + n2
+		if n == 0:
+			return stats1
+		d = m2 - m1
+		return (n, m1 + d*n2/n, ss1 + ss2 + d*d*n1*n2/n)
+
 
 gamma_cof = [76.18009172947146, -86.50532032941677, 24.01409824083091, -1.231739572450155, 0.1208650973866179e-2, -0.5395239384953e-5]
-def log_gamma(xx):
-	global gamma_cof
+def _log_gamma(xx):
 	x = xx - 1.0
 	tmp = x + 5.5
 	tmp -= (x + 0.5)*math.log(tmp)
@@ -110,8 +282,45 @@ def log_gamma(xx):
 		ser += gamma_cof[j] / x
 	return -tmp + math.log(2.5066282746310005*ser)
 
+# log_gamma of small non-negative integers, by table lookup
+specialFunctionTableSize = 1024
+_logGammaTable = [float('inf')] + [_log_gamma(i) for i in xrange(1, specialFunctionTableSize)]
+
+def log_gamma(xx):
+	if type(xx) is int and 0 <= xx < specialFunctionTableSize:
+		return _logGammaTable[xx]
+	return _log_gamma(xx)
+
+def vlog_gamma(xx):
+	x = xx - 1.0
+	tmp = x + 5.5
+	tmp = tmp - (x + 0.5)*numpy.log(tmp)
+	ser = 1.000000000190015
+	for j in xrange(5):
+		x = x + 1
+		ser = ser + gamma_cof[j] / x
+	return -tmp + numpy.log(2.5066282746310005*ser)
+
+_gammaNormalizers = {}
+def gamma_normalizer(a, b):
+	"""
+	log_gamma(a) + a*log(b)
+	"""
+	z = _gammaNormalizers.get((a, b))
+	if z is None:
+		z = _cacheNormalizer(_gammaNormalizers, (a, b), log_gamma(a) + a*math.log(b))
+	return z
+
+def vgamma_normalizer(a, b):
+	if numpy.isscalar(a) and numpy.isscalar(b):
+		return gamma_normalizer(a, b)
+	return vlog_gamma(a) + a*numpy.log(b)
+
 def gamma_logprob(x, a, b):
-	return (a - 1)*math.log(x) - float(x)/b - log_gamma(a) - a*math.log(b);
+	return (a - 1)*math.log(x) - float(x)/b - gamma_normalizer(a, b)
+
+def vgamma_logprob(x, a, b):
+	return (a - 1)*numpy.log(x) - x/numpy.asarray(b, float) - vgamma_normalizer(a, b)
 
 class GammaRandomPrimitive(RandomPrimitive):
 	"""
@@ -124,16 +333,55 @@ class GammaRandomPrimitive(RandomPrimitive):
 	def __call__(self, a, b, isStructural=False, conditionedValue=None):
 		return self._sample([a,b], isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return random.gammavariate(params[0], params[1])
+	def _sample_impl(self, params, rng=random):
+		return rng.gammavariate(params[0], params[1])
 
 	def _logprob(self, val, params):
 		return gamma_logprob(val, params[0], params[1])
-	
+
 	# TODO: Custom proposal kernel?
-	
+
+	continuous = True
+
+	def _support(self, params):
+		return (0.0, float('inf'))
+
+	vectorized = True
+
+	def _vsample(self, params, n, rs):
+		return rs.gamma(params[0], params[1], n)
+
+	def _vlogprob(self, vals, params):
+		return vgamma_logprob(vals, params[0], params[1])
+
+	# Number of observations, their sum and the sum of their logs
+	def _sufficientStatistics(self, data):
+		return (len(data), math.fsum(data), math.fsum(math.log(x) for x in data))
+
+	def _logprobFromStatistics(self, stats, params):
+		n, s, sl = stats
+		a, b = params
+		return (a - 1)*sl - float(s)/b - n*(log_gamma(a) + a*math.log(b))
+
+	def _vlogprobFromStatistics(self, stats, params):
+		n, s, sl = stats
+		a, b = params
+		return (a - 1)*sl - s/numpy.asarray(b, float) - n*vgamma_normalizer(a, b)
+
+	def _combineStatistics(self, stats1, stats2):
+		return tuple(map(lambda a, b: a + b, stats1, stats2))
+
+_betaNormalizers = {}
 def log_beta(a, b):
-	return log_gamma(a) + log_gamma(b) - log_gamma(a+b)
+	z = _betaNormalizers.get((a, b))
+	if z is None:
+		z = _cacheNormalizer(_betaNormalizers, (a, b), log_gamma(a) + log_gamma(b) - log_gamma(a+b))
+	return z
+
+def vlog_beta(a, b):
+	if numpy.isscalar(a) and numpy.isscalar(b):
+		return log_beta(a, b)
+	return vlog_gamma(a) + vlog_gamma(b) - vlog_gamma(a+b)
 
 def beta_logprob(x, a, b):
 	if x > 0 and x < 1:
@@ -141,6 +389,12 @@ def beta_logprob(x, a, b):
 	else:
 		return -float('inf')
 
+def vbeta_logprob(x, a, b):
+	inside = (x > 0) & (x < 1)
+	x = numpy.where(inside, x, 0.5)
+	lp = (a-1)*numpy.log(x) + (b-1)*numpy.log(1-x) - vlog_beta(a, b)
+	return numpy.where(inside, lp, -float('inf'))
+
 class BetaRandomPrimitive(RandomPrimitive):
 	"""
 	ERP with Beta distribution
@@ -152,15 +406,28 @@ class BetaRandomPrimitive(RandomPrimitive):
 	def __call__(self, a, b, isStructural=False, conditionedValue=None):
 		return self._sample([a,b], isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return random.betavariate(params[0], params[1])
+	def _sample_impl(self, params, rng=random):
+		return rng.betavariate(params[0], params[1])
 
 	def _logprob(self, val, params):
 		return beta_logprob(val, params[0], params[1])
 
 	# TODO: Custom proposal kernel?
 
-def binomial_sample(p, n):
+	continuous = True
+
+	def _support(self, params):
+		return (0.0, 1.0)
+
+	vectorized = True
+
+	def _vsample(self, params, n, rs):
+		return rs.beta(params[0], params[1], n)
+
+	def _vlogprob(self, vals, params):
+		return vbeta_logprob(vals, params[0], params[1])
+
+def binomial_sample(p, n, rng=random):
 	k = 0
 	N = 10
 	a = 0
@@ -168,7 +435,7 @@ def binomial_sample(p, n):
 	while n > N:
 		a = 1 + n/2
 		b = 1 + n-a
-		x = random.betavariate(a, b)
+		x = rng.betavariate(a, b)
 		if x >= p:
 			n = a-1
 			p /= x
@@ -178,7 +445,7 @@ def binomial_sample(p, n):
 			p = (p-x) / (1.0-x)
 	u = 0
 	for i in xrange(n):
-		u = random.random()
+		u = rng.random()
 		if u < p:
 			k += 1
 	return int(k)
@@ -221,28 +488,31 @@ class BinomialRandomPrimitive(RandomPrimitive):
 	def __call__(self, p, n, isStructural=False, conditionedValue=None):
 		return self._sample([p,n], isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return binomial_sample(params[0], params[1])
+	def _sample_impl(self, params, rng=random):
+		return binomial_sample(params[0], params[1], rng)
 
 	def _logprob(self, val, params):
 		return binomial_logprob(val, params[0], params[1])
 
 	# TODO: Custom proposal kernel?
 
-def poisson_sample(mu):
+	def _neighbors(self, val, params):
+		return [v for v in (val-1, val+1) if v >= 0 and v <= params[1]]
+
+def poisson_sample(mu, rng=random):
 	k = 0
 	while mu > 10:
 		m = 7.0/8*mu
-		x = random.gammavariate(m, 1)
+		x = rng.gammavariate(m, 1)
 		if x > mu:
-			return int(k + binomial_sample(mu/x, int(m-1)))
+			return int(k + binomial_sample(mu/x, int(m-1), rng))
 		else:
 			mu -= x
 			k += m
 	emu = math.exp(-mu)
 	p = 1
 	while p > emu:
-		p *= random.random()
+		p *= rng.random()
 		k += 1
 	return int(k-1)
 
@@ -253,7 +523,7 @@ def fact(x):
 		x -= 1
 	return t
 
-def lnfact(x):
+def _lnfact(x):
 	if x < 1:
 		x = 1
 	if x < 12:
@@ -265,13 +535,40 @@ def lnfact(x):
 	invx7 = invx5*invx2
 	ssum = ((x + 0.5) * math.log(x)) - x
 	ssum += math.log(2*math.pi) / 2.0
-	ssum += (invx / 12) - (invx / 360)
+	ssum += (invx / 12) - (invx3 / 360)
 	ssum += (invx5 / 1260) - (invx7 / 1680)
 	return ssum
 
+# lnfact of small non-negative integers, by table lookup
+def _makeLnfactTable(size):
+	table = [0.0]
+	for i in xrange(1, size):
+		table.append(table[-1] + math.log(i))
+	return table
+
+_lnfactTable = _makeLnfactTable(specialFunctionTableSize)
+_vlnfactTable = (numpy.array(_lnfactTable) if numpy is not None else None)
+
+def lnfact(x):
+	if type(x) is int and 0 <= x < specialFunctionTableSize:
+		return _lnfactTable[x]
+	return _lnfact(x)
+
+def vlnfact(x):
+	"""
+	lnfact of an array of integers
+	"""
+	x = numpy.maximum(numpy.asarray(x), 1)
+	if x.size > 0 and x.dtype.kind in "iu" and x.max() < specialFunctionTableSize:
+		return _vlnfactTable[x]
+	return vlog_gamma(x + 1.0)
+
 def poisson_logprob(k, mu):
 	return k * math.log(mu) - mu - lnfact(k)
 
+def vpoisson_logprob(k, mu):
+	return k * numpy.log(mu) - mu - vlnfact(k)
+
 class PoissonRandomPrimitive(RandomPrimitive):
 	"""
 	ERP with poisson distribution
@@ -283,30 +580,68 @@ class PoissonRandomPrimitive(RandomPrimitive):
 	def __call__(self, mu, isStructural=False, conditionedValue=None):
 		return self._sample([mu], isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return poisson_sample(params[0])
+	def _sample_impl(self, params, rng=random):
+		return poisson_sample(params[0], rng)
 
 	def _logprob(self, val, params):
 		return poisson_logprob(val, params[0])
 
 	# TODO: Custom proposal kernel?
 
-def dirichlet_sample(alpha):
+	def _neighbors(self, val, params):
+		return [v for v in (val-1, val+1) if v >= 0]
+
+	vectorized = True
+
+	def _vsample(self, params, n, rs):
+		return rs.poisson(params[0], n)
+
+	def _vlogprob(self, vals, params):
+		return vpoisson_logprob(vals, params[0])
+
+	# Number of observations, their sum and the sum of their log factorials
+	def _sufficientStatistics(self, data):
+		return (len(data), sum(data), math.fsum(lnfact(k) for k in data))
+
+	def _logprobFromStatistics(self, stats, params):
+		n, s, slf = stats
+		mu = params[0]
+		return s*math.log(mu) - n*mu - slf
+
+	def _vlogprobFromStatistics(self, stats, params):
+		n, s, slf = stats
+		mu = params[0]
+		return s*numpy.log(mu) - n*mu - slf
+
+	def _combineStatistics(self, stats1, stats2):
+		return tuple(map(lambda a, b: a + b, stats1, stats2))
+
+def dirichlet_sample(alpha, rng=random):
 	ssum = 0
 	theta = []
 	for a in alpha:
-		t = random.gammavariate(a, 1)
+		t = rng.gammavariate(a, 1)
 		theta.append(t)
 		ssum += t
 	for i in xrange(len(theta)):
 		theta[i] /= ssum
 	return theta
 
+_dirichletNormalizers = {}
+def dirichlet_normalizer(alpha):
+	"""
+	The log of the multivariate beta function of alpha
+	"""
+	key = tuple(alpha)
+	z = _dirichletNormalizers.get(key)
+	if z is None:
+		z = _cacheNormalizer(_dirichletNormalizers, key, sum(map(log_gamma, alpha)) - log_gamma(sum(alpha)))
+	return z
+
 def dirichlet_logprob(theta, alpha):
-	lopg = log_gamma(sum(alpha))
+	logp = -dirichlet_normalizer(alpha)
 	for i in xrange(len(alpha)):
 		logp += (alpha[i] - 1)*math.log(theta[i])
-		logp -= log_gamma(alpha[i])
 	return logp
 
 class DirichletRandomPrimitive(RandomPrimitive):
@@ -320,8 +655,8 @@ class DirichletRandomPrimitive(RandomPrimitive):
 	def __call__(self, alpha, isStructural=False, conditionedValue=None):
 		return self._sample(alpha, isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return dirichlet_sample(params)
+	def _sample_impl(self, params, rng=random):
+		return dirichlet_sample(params, rng)
 
 	def _logprob(self, val, params):
 		return dirichlet_logprob(val, params)
@@ -329,21 +664,136 @@ class DirichletRandomPrimitive(RandomPrimitive):
 	# TODO: Custom proposal kernel?
 
 
-def multinomial_sample(theta):
-	result = 0
-	x = random.random() * sum(theta)
-	probAccum = 1e-6
-	k = len(theta)
-	while result < k and x > probAccum:
-		probAccum += theta[result]
-		result += 1
-	return result - 1
+class MultinomialWeights(tuple):
+	"""
+	An immutable list of multinomial weights, for distributions that are
+	drawn from many times. It keeps its total, an alias table for O(1)
+	draws, and (once needed) cumulative sums that draw with one of its
+	values projected out in O(log K). Pass it anywhere a list of weights
+	is expected.
+	"""
+
+	def __new__(cls, theta):
+		self = tuple.__new__(cls, theta)
+		self.total = math.fsum(self)
+		if not self.total > 0.0:
+			raise ValueError("Multinomial weights must have a positive total")
+		self._cumulative = None
+		# Vose's alias method
+		k = len(self)
+		self._prob = [0.0]*k
+		self._alias = range(k)
+		scaled = [w * k / self.total for w in self]
+		small = [i for i in xrange(k) if scaled[i] < 1.0]
+		large = [i for i in xrange(k) if scaled[i] >= 1.0]
+		while small and large:
+			s = small.pop()
+			l = large.pop()
+			self._prob[s] = scaled[s]
+			self._alias[s] = l
+			scaled[l] -= 1.0 - scaled[s]
+			(small if scaled[l] < 1.0 else large).append(l)
+		for i in small + large:
+			self._prob[i] = 1.0
+		return self
+
+	def __reduce__(self):
+		return (MultinomialWeights, (tuple(self),))
+
+	def __eq__(self, other):
+		return self is other or tuple.__eq__(self, other)
+
+	def __ne__(self, other):
+		return self is not other and tuple.__ne__(self, other)
+
+	def __hash__(self):
+		return tuple.__hash__(self)
+
+	def sample(self, rng=random, excluded=None):
+		if excluded is None:
+			u = rng.random() * len(self)
+			i = int(u)
+			return (i if u - i < self._prob[i] else self._alias[i])
+		if self._cumulative is None:
+			self._cumulative = [0.0]*len(self)
+			accum = 0.0
+			for i in xrange(len(self)):
+				accum += self[i]
+				self._cumulative[i] = accum
+		remaining = self.total - self[excluded]
+		if remaining <= 0.0:
+			return excluded
+		# Skip over the excluded value's share of the cumulative sums
+		x = rng.random() * remaining
+		if x >= self._cumulative[excluded] - self[excluded]:
+			x += self[excluded]
+		i = min(bisect.bisect_right(self._cumulative, x), len(self)-1)
+		# Rounding error can land on the excluded value or one with no weight:
+		# take the nearest value below that has weight, or else above
+		j = i
+		while j >= 0 and (j == excluded or self[j] <= 0.0):
+			j -= 1
+		if j < 0:
+			j = i
+			while j == excluded or self[j] <= 0.0:
+				j += 1
+		return j
+
+def multinomial_sample(theta, rng=random, excluded=None):
+	"""
+	Draw an index with probability proportional to its weight in theta,
+	optionally with the index 'excluded' projected out. If no other index
+	has any weight, 'excluded' itself is returned.
+	"""
+	if type(theta) is MultinomialWeights:
+		return theta.sample(rng, excluded)
+	total = sum(theta)
+	if excluded is not None:
+		total -= theta[excluded]
+		if total <= 0.0:
+			return excluded
+	x = rng.random() * total
+	if excluded is None:
+		i = 0
+		for w in theta:
+			x -= w
+			if x < 0.0:
+				return i
+			i += 1
+	else:
+		for i in xrange(len(theta)):
+			if i != excluded:
+				x -= theta[i]
+				if x < 0.0:
+					return i
+	# Rounding error can leave x just short of zero
+	i = len(theta) - 1
+	while i == excluded or theta[i] <= 0.0:
+		i -= 1
+	return i
+
+def logsumexp(xs):
+	"""
+	log(sum(exp(x) for x in xs)), without overflow
+	"""
+	m = max(xs)
+	if m == -float('inf'):
+		return m
+	return m + math.log(sum(math.exp(x - m) for x in xs))
 
-def multinomial_logprob(n, theta):
+def multinomial_logprob(n, theta, excluded=None):
 	if n < 0 or n >= len(theta):
 		return -float('inf')
 	n = int(round(n))
-	return math.log(theta[n]/sum(theta))
+	total = (theta.total if type(theta) is MultinomialWeights else sum(theta))
+	if excluded is not None:
+		total -= theta[excluded]
+		if total <= 0.0:
+			return (0.0 if n == excluded else -float('inf'))
+		if n == excluded:
+			return -float('inf')
+	w = theta[n]
+	return (math.log(w/total) if w > 0.0 else -float('inf'))
 
 class MultinomialRandomPrimitive(RandomPrimitive):
 	"""
@@ -356,23 +806,38 @@ class MultinomialRandomPrimitive(RandomPrimitive):
 	def __call__(self, theta, isStructural=False, conditionedValue=None):
 		return self._sample(theta, isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return multinomial_sample(params)
+	def _sample_impl(self, params, rng=random):
+		return multinomial_sample(params, rng)
 
 	def _logprob(self, val, params):
 		return multinomial_logprob(val, params)
 
 	# Multinomial with currval projected out
-	def _proposal(self, currval, params):
-		newparams = copy.copy(params)
-		newparams[currval] = 0.0
-		return multinomial_sample(newparams)
+	def _proposal(self, currval, params, rng=random):
+		return multinomial_sample(params, rng, currval)
 
 	# Multinomial with currval projected out
 	def _logProposalProb(self, currval, propval, params):
-		newparams = copy.copy(params)
-		newparams[currval] = 0.0
-		return multinomial_logprob(propval, newparams)
+		return multinomial_logprob(propval, params, currval)
+
+	def _neighbors(self, val, params):
+		return [i for i in xrange(len(params)) if i != val]
+
+	# Number of observations of each distinct value
+	def _sufficientStatistics(self, data):
+		counts = {}
+		for x in data:
+			counts[x] = counts.get(x, 0) + 1
+		return counts.items()
+
+	def _logprobFromStatistics(self, stats, params):
+		return sum(c*multinomial_logprob(x, params) for x, c in stats)
+
+	def _combineStatistics(self, stats1, stats2):
+		counts = dict(stats1)
+		for x, c in stats2:
+			counts[x] = counts.get(x, 0) + c
+		return counts.items()
 
 
 class UniformRandomPrimitive(RandomPrimitive):
@@ -386,8 +851,8 @@ class UniformRandomPrimitive(RandomPrimitive):
 	def __call__(self, lo, hi, isStructural=False, conditionedValue=None):
 		return self._sample([lo, hi], isStructural, conditionedValue)
 
-	def _sample_impl(self, params):
-		return random.uniform(params[0], params[1])
+	def _sample_impl(self, params, rng=random):
+		return rng.uniform(params[0], params[1])
 
 	def _logprob(self, val, params):
 		if val < params[0] or val > params[1]:
@@ -397,6 +862,80 @@ class UniformRandomPrimitive(RandomPrimitive):
 
 	# TODO: Custom proposal kernel?
 
+	continuous = True
+
+	def _support(self, params):
+		return (params[0], params[1])
+
+	vectorized = True
+
+	def _vsample(self, params, n, rs):
+		return rs.uniform(params[0], params[1], n)
+
+	def _vlogprob(self, vals, params):
+		lo, hi = params
+		return numpy.where((vals < lo) | (vals > hi), -float('inf'), -numpy.log(numpy.asarray(hi, float) - lo))
+
+
+class RandomIntegerRandomPrimitive(RandomPrimitive):
+	"""
+	ERP with uniform distribution over the integers 0 to n-1
+	"""
+
+	def __init__(self):
+		pass
+
+	def __call__(self, n, isStructural=False, conditionedValue=None):
+		return self._sample([n], isStructural, conditionedValue)
+
+	def _sample_impl(self, params, rng=random):
+		return int(rng.random() * params[0])
+
+	def _logprob(self, val, params):
+		n = params[0]
+		if val < 0 or val >= n or val != int(val):
+			return -float('inf')
+		return -math.log(n)
+
+	# Uniform over all the other integers
+	def _proposal(self, currval, params, rng=random):
+		n = params[0]
+		if n < 2:
+			return currval
+		i = int(rng.random() * (n-1))
+		return (i+1 if i >= currval else i)
+
+	def _logProposalProb(self, currval, propval, params):
+		n = params[0]
+		if n < 2:
+			return 0.0
+		return (-math.log(n-1) if propval != currval else -float('inf'))
+
+	def _neighbors(self, val, params):
+		return [i for i in xrange(params[0]) if i != val]
+
+	vectorized = True
+
+	def _vsample(self, params, n, rs):
+		return rs.randint(0, params[0], n)
+
+	def _vlogprob(self, vals, params):
+		n = params[0]
+		return numpy.where((vals < 0) | (vals >= n), -float('inf'), -numpy.log(numpy.asarray(n, float)))
+
+	def _vproposal(self, currvals, params, rs):
+		n = params[0]
+		if n < 2:
+			return currvals
+		i = rs.randint(0, n-1, len(currvals))
+		return i + (i >= currvals)
+
+	def _vlogProposalProb(self, currvals, propvals, params):
+		n = params[0]
+		if n < 2:
+			return numpy.zeros(len(currvals))
+		return numpy.where(propvals != currvals, -math.log(n-1), -float('inf'))
+
 
 
 """
@@ -412,6 +951,13 @@ poisson = PoissonRandomPrimitive()
 dirichlet = DirichletRandomPrimitive()
 multinomial = MultinomialRandomPrimitive()
 uniform = UniformRandomPrimitive()
+randomInteger = RandomIntegerRandomPrimitive()
+
+# Conjugate priors name the child ERP they are conjugate to;
+# collapsed programs integrate them out (see conjugacy.py)
+beta.conjugateChild = flip
+gamma.conjugateChild = poisson
+dirichlet.conjugateChild = multinomial
 
 
 """
@@ -422,5 +968,4 @@ def multinomialDraw(items, probs, isStructural=False):
 	return items[multinomial(probs, isStructural=isStructural)]
 
 def uniformDraw(items, isStructural=False):
-	n = len(items)
-	return items[multinomial(map(lambda x: 1.0/n, range(n)), isStructural=isStructural)]
\ No newline at end of file
+	return items[randomInteger(len(items), isStructural=isStructural)]
\ No newline at end of file
@@ -1,7 +1,15 @@
 import trace
+import erp
+import program
+import compilation
+import randomstream
 import copy
-import random
 import math
+import dis
+import multiprocessing
+import threading
+import time
+import cPickle
 from collections import Counter
 
 
@@ -57,14 +65,71 @@ def rejectionSample(computation):
 	return tr.returnValue
 
 
-def _randomChoice(items):
+class _AmortizedQuery:
+	"""
+	Nested query whose posterior samples are pooled per argument list.
+	Each argument list keeps its own inner Markov chain; when its pool
+	runs dry, the chain is advanced from where it left off to refill it.
+	"""
+
+	# The pools and chains do not change what the query computes (see resultcache.cacheKey)
+	_cacheKeyAttributes = ("query", "poolSize", "lag")
+
+	def __init__(self, query, poolSize, lag, kernel):
+		self.query = query
+		self.poolSize = poolSize
+		self.lag = lag
+		self.kernel = kernel
+		self.pools = {}
+		self.chains = {}
+		self.queriesMade = 0
+		self.refills = 0
+		# Queries running in other threads may share the pools
+		self.lock = threading.RLock()
+
+	def __call__(self, *args, **kwargs):
+		# Inner chains draw from the stream of whatever trace is asking.
+		# (Asking also keeps compiled traces from freezing query results into constants.)
+		t = trace.currentTrace()
+		rng = (t.rng if t else randomstream.RandomStream())
+		key = cPickle.dumps(args, 1) + cPickle.dumps(kwargs, 1)
+		with self.lock:
+			self.queriesMade += 1
+			pool = self.pools.setdefault(key, [])
+			if not pool:
+				self.refills += 1
+				currTrace = self.chains.get(key)
+				if currTrace is None:
+					currTrace = trace.newTrace(lambda: self.query(*args, **kwargs), rng)
+				else:
+					currTrace.reattach(currTrace.computation, rng)
+				for i in xrange(self.poolSize * self.lag):
+					currTrace = self.kernel.next(currTrace)
+					if (i+1) % self.lag == 0:
+						pool.append(currTrace.returnValue)
+				self.chains[key] = currTrace
+			return pool.pop()
+
+def amortizedQuery(query, poolSize=20, lag=1, kernel=None):
+	"""
+	Wrap a probabilistic function for use as a nested query: calling the
+	result returns a sample from the function's posterior given its arguments.
+	Samples are drawn 'poolSize' at a time from a warm MH chain (or the given
+	kernel) kept for each distinct argument list, so repeated calls with the
+	same arguments rarely run any inference at all.
+	The wrapper must be created outside the program that calls it.
+	"""
+	return _AmortizedQuery(query, poolSize, lag, kernel if kernel else RandomWalkKernel())
+
+
+def _randomChoice(items, rng):
 	"""
 	Like random.choice, but returns None if items is empty
 	"""
 	if len(items) == 0:
 		return None
 	else:
-		return random.choice(items)
+		return rng.choice(items)
 
 
 class RandomWalkKernel:
@@ -80,15 +145,20 @@ class RandomWalkKernel:
 		self.proposalsAccepted = 0
 
 	def next(self, currTrace):
+		return self.update(currTrace, _randomChoice(currTrace.freeVarNames(self.structural, self.nonstructural), currTrace.rng))
+
+	def update(self, currTrace, name):
+		"""
+		Make a proposal for the variable 'name'
+		"""
 
 		self.proposalsMade += 1
-		name = _randomChoice(currTrace.freeVarNames(self.structural, self.nonstructural))
 
 		# If we have no free random variables, then just run the computation
 		# and generate another sample (this may not actually be deterministic,
 		# in the case of nested query)
 		if name == None:
-			currTrace.traceUpdate(not structural)
+			currTrace.traceUpdate(not self.structural)
 			return currTrace
 		# Otherwise, make a proposal for a randomly-chosen variable, probabilistically
 		# accept it
@@ -97,7 +167,7 @@ class RandomWalkKernel:
 			fwdPropLP -= math.log(len(currTrace.freeVarNames(self.structural, self.nonstructural)))
 			rvsPropLP -= math.log(len(nextTrace.freeVarNames(self.structural, self.nonstructural)))
 			acceptThresh = nextTrace.logprob - currTrace.logprob + rvsPropLP - fwdPropLP
-			if nextTrace.conditionsSatisfied and math.log(random.random()) < acceptThresh:
+			if nextTrace.conditionsSatisfied and currTrace.rng.logrand() < acceptThresh:
 				self.proposalsAccepted += 1
 				return nextTrace
 			else:
@@ -108,6 +178,85 @@ class RandomWalkKernel:
 													   self.proposalsAccepted, self.proposalsMade)
 
 
+class SliceSamplingKernel(RandomWalkKernel):
+	"""
+	MCMC transition kernel that updates a single variable at a time:
+	free non-structural continuous variables by univariate slice sampling
+	(stepping out from an interval of size 'width', then shrinking it),
+	and all others by random-walk proposals.
+	A slice update never rejects its new value and needs no proposal scale;
+	it re-executes the computation at most maxStepsOut + maxShrinks times,
+	staying put only if the shrinkage runs out first.
+	"""
+
+	def __init__(self, width=1.0, maxStepsOut=10, maxShrinks=20, structural=True, nonstructural=True):
+		RandomWalkKernel.__init__(self, structural, nonstructural)
+		self.width = width
+		self.maxStepsOut = maxStepsOut
+		self.maxShrinks = maxShrinks
+		self.sliceUpdates = 0
+		self.executions = 0
+
+	def update(self, currTrace, name):
+		if name != None:
+			var = currTrace.getRecord(name)
+			if var.erp.continuous and not var.structural:
+				return self.sliceUpdate(currTrace, name, var)
+		self.executions += 1
+		return RandomWalkKernel.update(self, currTrace, name)
+
+	def inSlice(self, currTrace, name, val, logy):
+		"""
+		The trace with 'name' set to 'val', if it lies in the slice at height logy
+		"""
+		self.executions += 1
+		nextTrace = currTrace.changeValue(name, val)
+		return (nextTrace if nextTrace.conditionsSatisfied and nextTrace.logprob > logy else None)
+
+	def sliceUpdate(self, currTrace, name, var):
+		self.proposalsMade += 1
+		self.sliceUpdates += 1
+		rng = currTrace.rng
+		lo, hi = var.erp._support(var.params)
+		x0 = var.val
+		logy = currTrace.logprob + rng.logrand()
+
+		# Step out from a randomly placed interval, splitting the steps
+		# between its ends at random (Neal 2003, fig. 3); ends that leave
+		# the support are outside the slice
+		left = x0 - self.width*rng.random()
+		right = left + self.width
+		stepsLeft = int(self.maxStepsOut*rng.random())
+		stepsRight = self.maxStepsOut - 1 - stepsLeft
+		while stepsLeft > 0 and left > lo and self.inSlice(currTrace, name, left, logy) is not None:
+			left -= self.width
+			stepsLeft -= 1
+		while stepsRight > 0 and right < hi and self.inSlice(currTrace, name, right, logy) is not None:
+			right += self.width
+			stepsRight -= 1
+		left = max(left, lo)
+		right = min(right, hi)
+
+		# Shrink the interval towards x0 until a value in it lies in the slice
+		for i in xrange(self.maxShrinks):
+			x1 = left + rng.random()*(right - left)
+			if lo < x1 < hi:
+				nextTrace = self.inSlice(currTrace, name, x1, logy)
+				if nextTrace is not None:
+					self.proposalsAccepted += 1
+					return nextTrace
+			if x1 < x0:
+				left = x1
+			else:
+				right = x1
+		return currTrace
+
+	def stats(self):
+		RandomWalkKernel.stats(self)
+		print "Executions per step: {0:.2f} ({1} slice updates)".format(float(self.executions)/self.proposalsMade, \
+																	   self.sliceUpdates)
+
+
 class LARJInterpolationTrace(object):
 	"""
 	Abstraction for the linear interpolation of two execution traces
@@ -128,34 +277,343 @@ class LARJInterpolationTrace(object):
 
 	@property
 	def returnValue(self):
-		return trace2.returnValue
+		return self.trace2.returnValue
+
+	@property
+	def rng(self):
+		return self.trace1.rng
+
+	@property
+	def computation(self):
+		return self.trace1.computation
+
+	def reattach(self, computation, rng):
+		self.trace1.reattach(computation, rng)
+		self.trace2.reattach(computation, rng)
 
 	def freeVarNames(self, structural=True, nonstructural=True):
-		return list(set(self.trace1.freeVarNames(structural, nonstructural) + \
-						self.trace2.freeVarNames(structural, nonstructural)))
+		names1 = self.trace1.freeVarNames(structural, nonstructural)
+		inTrace1 = set(names1)
+		return names1 + [name for name in self.trace2.freeVarNames(structural, nonstructural) if name not in inTrace1]
+
+	def getRecord(self, varname):
+		var = self.trace1.getRecord(varname)
+		return (var if var else self.trace2.getRecord(varname))
 
 	def proposeChange(self, varname):
-		var1 = self.trace1.getRecord(varname)
-		var2 = self.trace2.getRecord(varname)
-		nextTrace = LARJInterpolationTrace(copy.deepcopy(self.trace1) if var1 else self.trace1, \
-										   copy.deepcopy(self.trace2) if var2 else self.trace2, \
-										   self.alpha)
-		var1 = nextTrace.trace1.getRecord(varname)
-		var2 = nextTrace.trace2.getRecord(varname)
-		var = (var1 if var1 else var2)
+		var = self.getRecord(varname)
 		assert(not var.structural)		# We're only supposed to be making changes to non-structurals here
-		propval = var.erp._proposal(var.val, var.params)
+		propval = var.erp._proposal(var.val, var.params, self.rng)
 		fwdPropLP = var.erp._logProposalProb(var.val, propval, var.params)
 		rvsPropLP = var.erp._logProposalProb(propval, var.val, var.params)
-		if var1:
-			var1.val = propval
-			var1.logprob = var1.erp._logprob(var1.val, var1.params)
-			nextTrace.trace1.traceUpdate(not var1.structural)
-		if var2:
-			var2.val = propval
-			var2.logprob = var2.erp._logprob(var2.val, var2.params)
-			nextTrace.trace2.traceUpdate(not var2.structural)
-		return nextTrace, fwdPropLP, rvsPropLP
+		return self.changeValue(varname, propval), fwdPropLP, rvsPropLP
+
+	def changeValue(self, varname, val):
+		return self.__class__(self.trace1.changeValue(varname, val) if self.trace1.getRecord(varname) else self.trace1, \
+							  self.trace2.changeValue(varname, val) if self.trace2.getRecord(varname) else self.trace2, \
+							  self.alpha)
+
+
+class TemperedTrace(object):
+	"""
+	Abstraction for an execution trace whose log density is
+	scaled by an inverse temperature
+	"""
+
+	def __init__(self, trace, temperature=1.0):
+		self.trace = trace
+		self.temperature = temperature
+
+	@property
+	def logprob(self):
+		return self.trace.logprob / self.temperature
+
+	@property
+	def conditionsSatisfied(self):
+		return self.trace.conditionsSatisfied
+
+	@property
+	def returnValue(self):
+		return self.trace.returnValue
+
+	@property
+	def rng(self):
+		return self.trace.rng
+
+	@property
+	def computation(self):
+		return self.trace.computation
+
+	def reattach(self, computation, rng):
+		self.trace.reattach(computation, rng)
+
+	def freeVarNames(self, structural=True, nonstructural=True):
+		return self.trace.freeVarNames(structural, nonstructural)
+
+	def traceUpdate(self, structureIsFixed=False):
+		self.trace.traceUpdate(structureIsFixed)
+
+	def getRecord(self, varname):
+		return self.trace.getRecord(varname)
+
+	def proposeChange(self, varname):
+		nextTrace, fwdPropLP, rvsPropLP = self.trace.proposeChange(varname)
+		return TemperedTrace(nextTrace, self.temperature), fwdPropLP, rvsPropLP
+
+	def changeValue(self, varname, val):
+		return TemperedTrace(self.trace.changeValue(varname, val), self.temperature)
+
+
+_workerComputation = None
+
+def _initWorker(computation):
+	global _workerComputation
+	_workerComputation = computation
+
+def _tryProposals(currTrace, name, numTries, structural, nonstructural, keepTraces):
+	"""
+	Make 'numTries' independent proposals to the variable 'name'
+	Returns the (trace, log weight, forward proposal log probability)
+	of each; the traces themselves are only kept if 'keepTraces' is set
+	"""
+	tries = []
+	for i in xrange(numTries):
+		nextTrace, fwdPropLP, rvsPropLP = currTrace.proposeChange(name)
+		if nextTrace.conditionsSatisfied:
+			logw = nextTrace.logprob - math.log(len(nextTrace.freeVarNames(structural, nonstructural))) + rvsPropLP
+		else:
+			logw = -float('inf')
+		tries.append((nextTrace if keepTraces else None, logw, fwdPropLP))
+	return tries
+
+def _tryProposalsInWorker(job):
+	currTrace, name, seed, numTries, structural, nonstructural, keepTraces = job
+	currTrace.reattach(_workerComputation, randomstream.RandomStream(seed))
+	return _tryProposals(currTrace, name, numTries, structural, nonstructural, keepTraces)
+
+
+class MultipleTryKernel:
+	"""
+	MCMC transition kernel that makes several proposals to a single
+	variable at once and chooses among them using multiple-try Metropolis.
+	With 'numWorkers' > 0, the proposals are evaluated in parallel by a pool
+	of worker processes; the computation's return values must then be
+	picklable, and 'close' should be called once the kernel is done.
+	"""
+
+	def __init__(self, numTries=4, numWorkers=0, structural=True, nonstructural=True):
+		self.numTries = numTries
+		self.numWorkers = numWorkers
+		self.structural = structural
+		self.nonstructural = nonstructural
+		self.proposalsMade = 0
+		self.proposalsAccepted = 0
+		self.pool = None
+		self.poolComputation = None
+
+	def tries(self, currTrace, name, numTries, keepTraces):
+		computation = getattr(currTrace, "computation", None)
+		# Compiled traces are always evaluated in-process
+		if self.numWorkers == 0 or computation is None or numTries == 0:
+			return _tryProposals(currTrace, name, numTries, self.structural, self.nonstructural, keepTraces)
+		if self.pool is None or self.poolComputation is not computation:
+			self.close()
+			self.pool = multiprocessing.Pool(self.numWorkers, _initWorker, (computation,))
+			self.poolComputation = computation
+		numJobs = min(self.numWorkers, numTries)
+		jobs = [(currTrace, name, currTrace.rng.getrandbits(64), numTries/numJobs + (1 if j < numTries % numJobs else 0), \
+				 self.structural, self.nonstructural, keepTraces) for j in xrange(numJobs)]
+		tries = sum(self.pool.map(_tryProposalsInWorker, jobs), [])
+		for tr, logw, fwdPropLP in tries:
+			if tr is not None:
+				tr.reattach(computation, currTrace.rng)
+		return tries
+
+	def next(self, currTrace):
+
+		self.proposalsMade += 1
+		names = currTrace.freeVarNames(self.structural, self.nonstructural)
+		name = _randomChoice(names, currTrace.rng)
+
+		# If we have no free random variables, then just run the computation
+		# and generate another sample (this may not actually be deterministic,
+		# in the case of nested query)
+		if name == None:
+			currTrace.traceUpdate(not self.structural)
+			return currTrace
+
+		# Choose one of the proposals in proportion to its weight
+		candidates = self.tries(currTrace, name, self.numTries, True)
+		logws = map(lambda c: c[1], candidates)
+		total = erp.logsumexp(logws)
+		if total == -float('inf'):
+			return currTrace
+		x = currTrace.rng.random()
+		probAccum = 0.0
+		for nextTrace, logw, fwdPropLP in candidates:
+			probAccum += math.exp(logw - total)
+			if x < probAccum:
+				break
+
+		# Weigh it against a reference set of proposals made from the chosen trace,
+		# which includes the current trace
+		references = self.tries(nextTrace, name, self.numTries-1, False)
+		rvslogws = map(lambda r: r[1], references) + [currTrace.logprob - math.log(len(names)) + fwdPropLP]
+		if currTrace.rng.logrand() < total - erp.logsumexp(rvslogws):
+			self.proposalsAccepted += 1
+			return nextTrace
+		else:
+			return currTrace
+
+	def close(self):
+		"""
+		Shut down the worker pool, if there is one
+		"""
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+			self.poolComputation = None
+
+	def stats(self):
+		print "Acceptance ratio: {0} ({1}/{2})".format(float(self.proposalsAccepted)/self.proposalsMade, \
+													   self.proposalsAccepted, self.proposalsMade)
+
+
+class SubsampledMHKernel:
+	"""
+	MCMC transition kernel for programs whose likelihood comes from plates.
+	Proposals change a single non-structural variable, and the accept/reject
+	decision is made by a sequential test on growing random minibatches of
+	the plates' items (the 'austerity' test), stopping as soon as the
+	decision is confident at level 'epsilon'. The test only decides once
+	it has seen at least 'minItems' items (or all of them), since it relies
+	on a normal approximation to their mean.
+	The log probabilities of the traces it returns are minibatch estimates.
+	"""
+
+	def __init__(self, batchSize=100, epsilon=0.05, minItems=30):
+		self.batchSize = batchSize
+		self.epsilon = epsilon
+		self.minItems = minItems
+		self.proposalsMade = 0
+		self.proposalsAccepted = 0
+		self.itemsEvaluated = 0
+
+	def _evaluate(self, tr, selector):
+		"""
+		Re-run a trace on the plate items picked by 'selector'
+		Returns the log probability from outside the plates and those of the picked items
+		"""
+		tr.plateSelector = selector
+		tr.traceUpdate()
+		itemlps = sum(map(lambda p: p[2], tr.plateLogprobs), [])
+		return tr.logprob - sum(itemlps), itemlps
+
+	def _drawBatch(self, used, numItems, rng):
+		"""
+		Pick up to 'batchSize' plate items that have not been used yet
+		"""
+		n = min(self.batchSize, numItems - len(used))
+		if 2*(len(used) + n) < numItems:
+			batch = set()
+			while len(batch) < n:
+				i = rng.randrange(numItems)
+				if i not in used:
+					batch.add(i)
+			batch = list(batch)
+		else:
+			batch = rng.sample([i for i in xrange(numItems) if i not in used], n)
+		used.update(batch)
+		return sorted(batch)
+
+	def _selector(self, tr, batch):
+		"""
+		A plate selector for the items of a trace's plates whose indices,
+		counted across all of its plates, are in 'batch'
+		"""
+		sizes = map(lambda p: p[0], tr.plateLogprobs)
+		offsets = [sum(sizes[:k]) for k in xrange(len(sizes))]
+		return lambda plate, size: [i - offsets[plate] for i in batch if offsets[plate] <= i < offsets[plate] + size]
+
+	def _finish(self, tr, lp0, rng):
+		"""
+		Estimate the log probability of a trace whose plate items have not
+		been scored from a minibatch of them (lp0 being the log probability
+		from outside the plates), and stop it from subsampling its plates
+		"""
+		numItems = sum(map(lambda p: p[0], tr.plateLogprobs))
+		if numItems > 0:
+			ignore, lps = self._evaluate(tr, self._selector(tr, self._drawBatch(set(), numItems, rng)))
+			tr.logprob = lp0 + numItems * sum(lps) / len(lps)
+		tr.plateSelector = None
+		return tr
+
+	def next(self, currTrace):
+
+		self.proposalsMade += 1
+		rng = currTrace.rng
+		name = _randomChoice(currTrace.freeVarNames(structural=False), rng)
+		noItems = lambda plate, size: []
+		lp0, ignore = self._evaluate(currTrace, noItems)
+		if name == None:
+			return self._finish(currTrace, lp0, rng)
+		# The proposal inherits the selector, so this evaluates no plate items either
+		nextTrace, fwdPropLP, rvsPropLP = currTrace.proposeChange(name)
+		nextlp0 = nextTrace.logprob
+		if not nextTrace.conditionsSatisfied:
+			return self._finish(currTrace, lp0, rng)
+		numItems = sum(map(lambda p: p[0], nextTrace.plateLogprobs))
+
+		# Accept iff the mean log likelihood ratio of all items exceeds mu0
+		logu = rng.logrand()
+		if numItems == 0:
+			accept = (logu < nextlp0 - lp0 + rvsPropLP - fwdPropLP)
+		else:
+			mu0 = (logu + lp0 - nextlp0 + fwdPropLP - rvsPropLP) / numItems
+			used = set()
+			diffs = []
+			while True:
+				selector = self._selector(nextTrace, self._drawBatch(used, numItems, rng))
+				ignore, currlps = self._evaluate(currTrace, selector)
+				ignore, nextlps = self._evaluate(nextTrace, selector)
+				if not nextTrace.conditionsSatisfied:
+					accept = False
+					break
+				diffs.extend(map(lambda a, b: a - b, nextlps, currlps))
+				n = len(diffs)
+				diffmean = sum(diffs) / n
+				if n == numItems:
+					accept = (diffmean > mu0)
+					break
+				if n < self.minItems:
+					continue
+				sd = math.sqrt(sum((d - diffmean)*(d - diffmean) for d in diffs) / max(n - 1, 1))
+				# Standard error of the mean, with finite population correction
+				se = sd / math.sqrt(n) * math.sqrt(1.0 - float(n - 1)/(numItems - 1))
+				if se == 0.0:
+					accept = (diffmean > mu0)
+					break
+				t = abs(diffmean - mu0) / se
+				if 0.5*math.erfc(t / math.sqrt(2.0)) < self.epsilon:
+					accept = (diffmean > mu0)
+					break
+			self.itemsEvaluated += n
+			# Report the minibatch estimate of each trace's log probability
+			currTrace.logprob = lp0 + numItems * sum(currlps) / len(currlps)
+			nextTrace.logprob = nextlp0 + numItems * sum(nextlps) / len(nextlps)
+		currTrace.plateSelector = None
+		nextTrace.plateSelector = None
+		if accept:
+			self.proposalsAccepted += 1
+			return nextTrace
+		else:
+			return currTrace
+
+	def stats(self):
+		print "Acceptance ratio: {0} ({1}/{2})".format(float(self.proposalsAccepted)/self.proposalsMade, \
+													   self.proposalsAccepted, self.proposalsMade)
+		print "Plate items evaluated per proposal: {0}".format(float(self.itemsEvaluated)/self.proposalsMade)
 
 
 class LARJKernel:
@@ -188,7 +646,7 @@ class LARJKernel:
 			return currTrace
 		# Decide whether to jump or diffuse
 		structChoiceProb = (self.jumpFreq if self.jumpFreq else float(numStruct)/(numStruct + numNonStruct))
-		if random.random() < structChoiceProb:
+		if currTrace.rng.random() < structChoiceProb:
 			# Make a structural proposal
 			return self.jumpStep(currTrace)
 		else:
@@ -207,10 +665,10 @@ class LARJKernel:
 
 		# Randomly choose a structural variable to change
 		structVars = newStructTrace.freeVarNames(nonstructural=False)
-		name = _randomChoice(structVars)
+		name = _randomChoice(structVars, currTrace.rng)
 		var = newStructTrace.getRecord(name)
 		origval = var.val
-		propval = var.erp._proposal(var.val, var.params)
+		propval = var.erp._proposal(var.val, var.params, currTrace.rng)
 		fwdPropLP = var.erp._logProposalProb(var.val, propval, var.params)
 		var.val = propval
 		var.logprob = var.erp._logprob(var.val, var.params)
@@ -242,7 +700,7 @@ class LARJKernel:
 		var = newStructTrace.getRecord(name)
 		rvsPropLP = var.erp._logProposalProb(propval, origval, var.params) + oldStructTrace.lpDiff(newStructTrace) - math.log(newNumVars)
 		acceptanceProb = newStructTrace.logprob - currTrace.logprob + rvsPropLP - fwdPropLP + annealingLpRatio
-		if newStructTrace.conditionsSatisfied and math.log(random.random()) < acceptanceProb:
+		if newStructTrace.conditionsSatisfied and currTrace.rng.logrand() < acceptanceProb:
 			self.jumpProposalsAccepted += 1
 			return newStructTrace
 		else:
@@ -264,42 +722,294 @@ class LARJKernel:
 													 		   overallProposalsAccepted, overallProposalsMade)
 
 
-def mcmc(computation, kernel, numsamps, lag=1, verbose=False):
+class VariableRecorder:
 	"""
-	Do MCMC for 'numsamps' iterations using a given transition kernel
+	Records the values of selected random variables as MCMC runs, column-wise,
+	straight from the variable records of the current trace.
+	Variables can be selected by address ('names') or by the ERP call
+	sites that create them ('sites'). A site is either a function (every ERP
+	called directly from that function) or a (function, lineno) pair.
+	For @program functions, calls in nested functions and lambdas count as
+	calls from the decorated function.
+	"""
+
+	def __init__(self, names=None, sites=None):
+		self.names = set(names if names else [])
+		self.sites = []
+		for site in (sites if sites else []):
+			func, lineno = (site if isinstance(site, tuple) else (site, None))
+			code = getattr(func, "func_code", func)
+			self.sites.append((str(id(code)), code, lineno))
+		self.matches = {}
+		self.columns = {}
+		self.indices = {}
+		self.numsamps = 0
+
+	def _match(self, name):
+		if name in self.names:
+			return True
+		site = program.staticCallSite(name)
+		if site:
+			codeid, line = site
+		else:
+			# The innermost component of a frame-based address is 'codeid:lasti:loopnum'
+			codeid, lasti = name[:-1].rsplit("|", 1)[-1].split(":")[0:2]
+		for siteid, code, lineno in self.sites:
+			if codeid == siteid and (lineno is None or lineno == (line if site else _lineOf(code, int(lasti)))):
+				return True
+		return False
+
+	def record(self, currTrace):
+		"""
+		Append the values of all selected variables in currTrace
+		"""
+		for name, record in currTrace._vars.iteritems():
+			matched = self.matches.get(name)
+			if matched is None:
+				matched = self._match(name)
+				self.matches[name] = matched
+			if matched:
+				column = self.columns.get(name)
+				if column is None:
+					column = []
+					self.columns[name] = column
+					self.indices[name] = []
+				column.append(record.val)
+				self.indices[name].append(self.numsamps)
+		self.numsamps += 1
+
+	def recordedNames(self):
+		return self.columns.keys()
+
+	def values(self, name):
+		"""
+		The recorded values of variable 'name', in sample order
+		"""
+		return self.columns.get(name, [])
+
+	def sampleIndices(self, name):
+		"""
+		The indices of the samples in which variable 'name' existed
+		"""
+		return self.indices.get(name, [])
+
+	def marginal(self, name):
+		"""
+		Discrete marginal distribution of variable 'name'
+		"""
+		hist = Counter(self.values(name))
+		flnumvals = float(len(self.values(name)))
+		for v in hist:
+			hist[v] /= flnumvals
+		return hist
+
+	def expectation(self, name):
+		"""
+		Marginal expected value of variable 'name'
+		"""
+		return mean(self.values(name))
+
+
+class TraceRecorder:
 	"""
-	currentTrace = trace.newTrace(computation)
-	samps = []
+	Keeps the traces of the last 'keep' samples drawn by MCMC
+	(or of every sample, if 'keep' is None), e.g. to continue the
+	chain later with warmStart or smcUpdate
+	"""
+
+	def __init__(self, keep=1):
+		self.keep = keep
+		self.traces = []
+
+	def record(self, currTrace):
+		self.traces.append(currTrace)
+		if self.keep is not None and len(self.traces) > self.keep:
+			del self.traces[0]
+
+	def last(self):
+		"""
+		The most recently recorded trace
+		"""
+		return self.traces[-1]
+
+
+_linecache = {}
+def _lineOf(code, lasti):
+	"""
+	Source line number of the bytecode at offset 'lasti' in 'code'
+	"""
+	starts = _linecache.get(code)
+	if starts is None:
+		starts = list(dis.findlinestarts(code))
+		_linecache[code] = starts
+	lineno = code.co_firstlineno
+	for offset, line in starts:
+		if offset > lasti:
+			break
+		lineno = line
+	return lineno
+
+
+def mcmcIterator(computation, kernel, numsamps=None, lag=1, verbose=False, recorder=None, seed=None, compiled=False, \
+				 deadline=None, yieldEvery=None, initialTrace=None):
+	"""
+	Do MCMC using a given transition kernel, yielding each sample as soon as it is
+	drawn, so a caller can consume samples as they arrive, interleave other work
+	with the chain, or stop it at any point by closing the generator.
+	If 'yieldEvery' is given, the chain instead yields the list of samples drawn in
+	each run of 'yieldEvery' iterations (possibly empty), which bounds the time
+	between yields however large 'lag' is.
+	Runs until 'numsamps' samples have been drawn (forever, if None) or until
+	time.time() passes 'deadline'.
+	The chain starts from 'initialTrace' (and its stream) if one is given.
+	"""
+	if initialTrace is not None:
+		currentTrace = initialTrace
+	else:
+		currentTrace = trace.newTrace(computation, randomstream.makeStream(seed))
+	if compiled:
+		compiledTrace = compilation.compileTrace(currentTrace)
+		if verbose:
+			print "Using {0}".format("compiled log-density" if compiledTrace else "interpreter (program could not be compiled)")
+		currentTrace = compiledTrace or currentTrace
+	batch = []
+	numdrawn = 0
 	i = 0
-	iters = numsamps * lag
-	while i < iters:
+	while numsamps is None or numdrawn < numsamps:
+		if deadline is not None and time.time() >= deadline:
+			break
 		currentTrace = kernel.next(currentTrace)
 		if i % lag == 0:
 			if verbose:
 				print "iteration {0}\r".format(i),
-			samps.append((currentTrace.returnValue, currentTrace.logprob))
+			samp = (currentTrace.returnValue, currentTrace.logprob)
+			numdrawn += 1
+			if recorder:
+				recorder.record(currentTrace)
+			if yieldEvery is None:
+				yield samp
+			else:
+				batch.append(samp)
 		i += 1
+		if yieldEvery is not None and i % yieldEvery == 0:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+def mcmc(computation, kernel, numsamps, lag=1, verbose=False, recorder=None, seed=None, compiled=False, deadline=None, \
+		 initialTrace=None):
+	"""
+	Do MCMC for 'numsamps' iterations using a given transition kernel
+	If a VariableRecorder is given, it records the selected variables of every sample
+	'seed' may be a number or a RandomStream; the chain draws all of its randomness from it
+	If 'compiled' is set and the program has a fixed structure, the chain runs on a
+	compiled log-density instead of re-running the program at every step
+	If a 'deadline' (in time.time() seconds) is given, the chain stops there and
+	returns the samples drawn so far
+	The chain starts from 'initialTrace' (and its stream) if one is given
+	"""
+	samps = list(mcmcIterator(computation, kernel, numsamps, lag, verbose, recorder, seed, compiled, deadline, \
+							  None, initialTrace))
 	if verbose:
 		print ""
 		kernel.stats()
 	return samps
 
 
-def traceMH(computation, numsamps, lag=1, verbose=False):
+def traceMH(computation, numsamps, lag=1, verbose=False, recorder=None, seed=None, compiled=False, deadline=None):
 	"""
 	Sample from a probabilistic computation for some
 	number of iterations using single-variable-proposal
 	Metropolis-Hastings
 	"""
-	return mcmc(computation, RandomWalkKernel(), numsamps, lag, verbose)
+	return mcmc(computation, RandomWalkKernel(), numsamps, lag, verbose, recorder, seed, compiled, deadline)
+
+
+def sliceMH(computation, numsamps, width=1.0, lag=1, verbose=False, recorder=None, seed=None, compiled=False, deadline=None):
+	"""
+	Sample from a probabilistic computation using single-variable
+	slice sampling for its continuous variables (see SliceSamplingKernel)
+	"""
+	return mcmc(computation, SliceSamplingKernel(width), numsamps, lag, verbose, recorder, seed, compiled, deadline)
+
+
+def traceMHIterator(computation, numsamps=None, lag=1, verbose=False, recorder=None, seed=None, compiled=False, \
+					deadline=None, yieldEvery=None):
+	"""
+	traceMH as a stream of samples (see mcmcIterator)
+	"""
+	return mcmcIterator(computation, RandomWalkKernel(), numsamps, lag, verbose, recorder, seed, compiled, \
+						deadline, yieldEvery)
+
+
+def multipleTryMH(computation, numsamps, numTries=4, numWorkers=0, lag=1, verbose=False, recorder=None, seed=None):
+	"""
+	Sample from a probabilistic computation using multiple-try
+	Metropolis, optionally evaluating the tries in 'numWorkers' processes
+	"""
+	kernel = MultipleTryKernel(numTries, numWorkers)
+	try:
+		return mcmc(computation, kernel, numsamps, lag, verbose, recorder, seed)
+	finally:
+		kernel.close()
+
+
+def subsampledMH(computation, numsamps, batchSize=100, epsilon=0.05, lag=1, verbose=False, recorder=None, seed=None, minItems=30):
+	"""
+	Sample from a probabilistic computation whose likelihood comes
+	from plates, using minibatches of their items (see SubsampledMHKernel)
+	"""
+	return mcmc(computation, SubsampledMHKernel(batchSize, epsilon, minItems), numsamps, lag, verbose, recorder, seed)
 
 
-def LARJMH(computation, numsamps, annealSteps, jumpFreq=None, lag=1, verbose=False):
+def LARJMH(computation, numsamps, annealSteps, jumpFreq=None, lag=1, verbose=False, recorder=None, seed=None, deadline=None):
 	"""
 	Sample from a probabilistic computation using locally annealed
 	reversible jump mcmc
 	"""
 	return mcmc(computation, \
 				LARJKernel(RandomWalkKernel(structural=False), annealSteps, jumpFreq), \
-				numsamps, lag, verbose)
+				numsamps, lag, verbose, recorder, seed, False, deadline)
+
+
+def LARJMHIterator(computation, numsamps, annealSteps, jumpFreq=None, lag=1, verbose=False, recorder=None, seed=None, \
+				   deadline=None, yieldEvery=None):
+	"""
+	LARJMH as a stream of samples (see mcmcIterator)
+	"""
+	return mcmcIterator(computation, \
+						LARJKernel(RandomWalkKernel(structural=False), annealSteps, jumpFreq), \
+						numsamps, lag, verbose, recorder, seed, False, deadline, yieldEvery)
+
+
+def _runQueryInWorker(job):
+	samplingFn, samplerArgs = job
+	return samplingFn(_workerComputation, *samplerArgs)
+
+class QueryPool:
+	"""
+	A pool of worker processes that run whole queries of one computation
+	in the background, so the calling process stays free to do other work
+	"""
 
+	def __init__(self, computation, numWorkers=None):
+		self.pool = multiprocessing.Pool(numWorkers, _initWorker, (computation,))
+
+	def submit(self, samplingFn, *samplerArgs):
+		"""
+		Start samplingFn(computation, *samplerArgs) in a worker, e.g.
+		submit(traceMH, 1000, 1, False, None, seed, False, deadline).
+		The sampling function must be defined at module level, and its
+		samples must be picklable.
+		Returns a multiprocessing AsyncResult; its get() waits for the samples.
+		"""
+		return self.pool.apply_async(_runQueryInWorker, ((samplingFn, samplerArgs),))
+
+	def close(self):
+		"""
+		Shut down the workers, abandoning any queries still running
+		"""
+		self.pool.terminate()
+		self.pool.join()
@@ -0,0 +1,130 @@
+import trace
+import operator
+
+
+class StaleLazyValue(Exception):
+	"""
+	Raised when a lazy random value is first used after the
+	execution of the program that made it has finished
+	"""
+	pass
+
+
+def _force(value):
+	return (value.force() if isinstance(value, LazyValue) else value)
+
+def forced(value):
+	"""
+	A value with any lazy random values in it (at the top level, or
+	inside lists and tuples) replaced by their values. Lists and tuples
+	without any are returned as they are, and subclasses of them (such as
+	MultinomialWeights, which are reused across executions and so cannot
+	hold lazy values) are never rebuilt.
+	"""
+	if isinstance(value, LazyValue):
+		return value.force()
+	if type(value) is list or type(value) is tuple:
+		for i, v in enumerate(value):
+			if isinstance(v, _mayHoldLazy):
+				f = forced(v)
+				if f is not v:
+					items = list(value[:i])
+					items.append(f)
+					items.extend(forced(w) for w in value[i+1:])
+					return (items if type(value) is list else tuple(items))
+	return value
+
+
+class LazyValue(object):
+	"""
+	Stand-in for a random choice made by a lazy ERP (see lazy), whose value
+	is drawn, scored and recorded in its trace only when the program first
+	uses it. Its address is fixed when it is made, so it names the same
+	variable in every execution, whenever it is used.
+	"""
+
+	__slots__ = ["trace", "run", "erp", "params", "isStructural", "name", "value", "isForced"]
+
+	def __init__(self, tr, erp, params, isStructural, name):
+		self.trace = tr
+		self.run = tr.runToken
+		self.erp = erp
+		self.params = params
+		self.isStructural = isStructural
+		self.name = name
+		self.value = None
+		self.isForced = False
+
+	def force(self):
+		"""
+		The value of the random choice, which is made the first time it is asked for
+		"""
+		if not self.isForced:
+			if self.trace.runToken is not self.run:
+				raise StaleLazyValue("Lazy random value used after its program finished running")
+			self.value = self.trace.materialize(self)
+			self.isForced = True
+		return self.value
+
+	def __getattr__(self, name):
+		return getattr(self.force(), name)
+
+	def __repr__(self):
+		return repr(self.force())
+
+
+def _binop(op):
+	return lambda self, other: op(self.force(), _force(other))
+
+def _rbinop(op):
+	return lambda self, other: op(other, self.force())
+
+def _unop(op):
+	return lambda self, *args: op(self.force(), *args)
+
+for _name, _op in [("add", operator.add), ("sub", operator.sub), ("mul", operator.mul), ("div", operator.div), \
+				   ("truediv", operator.truediv), ("floordiv", operator.floordiv), ("mod", operator.mod), \
+				   ("pow", operator.pow), ("and", operator.and_), ("or", operator.or_), ("xor", operator.xor), \
+				   ("lshift", operator.lshift), ("rshift", operator.rshift)]:
+	setattr(LazyValue, "__{0}__".format(_name), _binop(_op))
+	setattr(LazyValue, "__r{0}__".format(_name), _rbinop(_op))
+for _name, _op in [("lt", operator.lt), ("le", operator.le), ("gt", operator.gt), ("ge", operator.ge), \
+				   ("eq", operator.eq), ("ne", operator.ne)]:
+	setattr(LazyValue, "__{0}__".format(_name), _binop(_op))
+for _name, _op in [("neg", operator.neg), ("pos", operator.pos), ("abs", operator.abs), ("invert", operator.invert), \
+				   ("nonzero", bool), ("float", float), ("int", int), ("long", long), ("index", operator.index), \
+				   ("hash", hash), ("str", str), ("len", len), ("iter", iter), ("getitem", operator.getitem), \
+				   ("contains", operator.contains)]:
+	setattr(LazyValue, "__{0}__".format(_name), _unop(_op))
+del _name, _op
+
+_mayHoldLazy = (LazyValue, list, tuple)
+
+
+class _LazyERP(object):
+
+	def __init__(self, erp):
+		self.erp = erp
+
+	def __call__(self, *args, **kwargs):
+		t = trace.currentTrace()
+		if not isinstance(t, trace.RandomExecutionTrace):
+			return self.erp(*args, **kwargs)
+		t.deferNext = True
+		try:
+			return self.erp(*args, **kwargs)
+		finally:
+			t.deferNext = False
+
+
+def lazy(erp):
+	"""
+	A lazy version of an ERP, e.g. lazy(gaussian)(0.0, 1.0). Its free random
+	choices return LazyValues, which are only sampled, scored and recorded in
+	the trace when the program first uses their value (in arithmetic,
+	comparisons, tests, as the parameter of another random choice, etc.).
+	Choices that an execution never uses cost little more than their address,
+	and are not free variables of its trace. Conditioned choices are made
+	as usual.
+	"""
+	return _LazyERP(erp)
@@ -9,6 +9,9 @@ class _MemoizedFunction:
 	However, it is slower for simple argument types such as numbers or strings.
 	"""
 
+	# Only the function decides results (see resultcache.cacheKey)
+	_cacheKeyAttributes = ("func",)
+
 	def __init__(self, func):
 		self.func = func
 		self.cache = {}
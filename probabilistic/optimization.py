@@ -0,0 +1,175 @@
+import trace
+import inference
+import randomstream
+import math
+import multiprocessing
+
+
+def _better(candidate, currTrace):
+	return candidate.conditionsSatisfied and (not currTrace.conditionsSatisfied or candidate.logprob > currTrace.logprob)
+
+def _kernelExecutions(kernel):
+	# Kernels that re-execute more than once per step count their executions
+	return getattr(kernel, "executions", kernel.proposalsMade)
+
+
+class MAPOptimizer:
+	"""
+	Searches for the most probable execution of a computation.
+	A chain of 'annealSteps' kernel steps (single-variable MH by default)
+	runs on its log density as it is cooled geometrically from 'startTemp'
+	to 'endTemp'; then the best trace the chain visited is improved by at
+	most 'ascentSteps' rounds of hill climbing. Each round tries the
+	neighbouring values of every discrete variable in turn (coordinate
+	ascent), then steps along the finite-difference gradient of the log
+	density in the free non-structural continuous variables.
+	Counts the executions of the computation that it makes.
+	"""
+
+	def __init__(self, annealSteps=1000, startTemp=10.0, endTemp=0.1, ascentSteps=100, kernel=None, \
+				 stepSize=1.0, tolerance=1e-8):
+		self.annealSteps = annealSteps
+		self.startTemp = startTemp
+		self.endTemp = endTemp
+		self.ascentSteps = ascentSteps
+		self.kernel = (kernel if kernel else inference.RandomWalkKernel())
+		self.stepSize = stepSize
+		self.tolerance = tolerance
+		self.executions = 0
+
+	def run(self, computation, rng):
+		"""
+		The best trace found by one search, from a rejection-initialized trace
+		"""
+		currTrace = trace.newTrace(computation, rng)
+		self.executions += 1
+		return self.ascend(self.anneal(currTrace))
+
+	def anneal(self, currTrace):
+		"""
+		The most probable trace visited by the annealed chain
+		"""
+		best = currTrace
+		tempered = inference.TemperedTrace(currTrace)
+		prevExecutions = _kernelExecutions(self.kernel)
+		for step in xrange(self.annealSteps):
+			tempered.temperature = self.startTemp * math.pow(self.endTemp / self.startTemp, \
+															 float(step) / max(self.annealSteps - 1, 1))
+			tempered = self.kernel.next(tempered)
+			if _better(tempered.trace, best):
+				best = tempered.trace
+		self.executions += _kernelExecutions(self.kernel) - prevExecutions
+		return best
+
+	def ascend(self, currTrace):
+		"""
+		Hill climb from a trace until a round no longer improves it
+		"""
+		step = self.stepSize
+		for i in xrange(self.ascentSteps):
+			prevlp = currTrace.logprob
+			currTrace = self.coordinateAscent(currTrace)
+			currTrace, step = self.gradientStep(currTrace, step)
+			if not currTrace.logprob - prevlp > self.tolerance:
+				break
+		return currTrace
+
+	def coordinateAscent(self, currTrace):
+		"""
+		Move each free discrete variable to whichever of its neighbouring values
+		most improves the trace (changes to structural variables draw any new
+		choices they lead to from their priors)
+		"""
+		for name in currTrace.freeVarNames():
+			var = currTrace.getRecord(name)
+			# An earlier change in this sweep may have removed the variable
+			if var is None:
+				continue
+			for val in var.erp._neighbors(var.val, var.params):
+				candidate = currTrace.changeValue(name, val)
+				self.executions += 1
+				if _better(candidate, currTrace):
+					currTrace = candidate
+		return currTrace
+
+	def gradientStep(self, currTrace, step):
+		"""
+		One step of gradient ascent in the free non-structural continuous
+		variables, from a forward-difference gradient and with a backtracking
+		line search, which never leaves a variable's support.
+		Returns the new trace and the step size to try next time.
+		"""
+		grad = {}
+		for name in currTrace.freeVarNames(structural=False):
+			var = currTrace.getRecord(name)
+			if not var.erp.continuous:
+				continue
+			lo, hi = var.erp._support(var.params)
+			h = 1e-6 * max(1.0, abs(var.val))
+			if var.val + h >= hi:
+				h = -h
+			nextTrace = currTrace.changeValue(name, var.val + h)
+			self.executions += 1
+			if nextTrace.conditionsSatisfied:
+				g = (nextTrace.logprob - currTrace.logprob) / h
+				if not (math.isinf(g) or math.isnan(g)):
+					grad[name] = (var.val, g, lo, hi)
+		if not grad:
+			return currTrace, step
+		gradNorm = max(abs(g) for x, g, lo, hi in grad.itervalues())
+		while step * gradNorm > self.tolerance:
+			# Moving at most halfway to the edge of the support keeps each value inside it
+			candidate = currTrace.changeValues(dict((name, min(max(x + step*g, 0.5*(x + lo)), 0.5*(x + hi))) \
+												   for name, (x, g, lo, hi) in grad.iteritems()))
+			self.executions += 1
+			if _better(candidate, currTrace):
+				return candidate, 2*step
+			step *= 0.5
+		return currTrace, self.stepSize
+
+
+def _searchInWorker(job):
+	optimizer, seed = job
+	bestTrace = optimizer.run(inference._workerComputation, randomstream.RandomStream(seed))
+	return bestTrace, optimizer.executions
+
+def annealedMAPTrace(computation, annealSteps=1000, restarts=1, numWorkers=0, startTemp=10.0, endTemp=0.1, \
+					 ascentSteps=100, kernel=None, verbose=False, seed=None):
+	"""
+	The most probable trace found by 'restarts' independent searches (see
+	MAPOptimizer), which are spread over 'numWorkers' worker processes if
+	it is more than 0; the computation's return values must then be picklable.
+	"""
+	rng = randomstream.makeStream(seed)
+	jobs = [(MAPOptimizer(annealSteps, startTemp, endTemp, ascentSteps, kernel), rng.getrandbits(64)) \
+			for r in xrange(restarts)]
+	if numWorkers > 0:
+		pool = multiprocessing.Pool(numWorkers, inference._initWorker, (computation,))
+		try:
+			results = pool.map(_searchInWorker, jobs)
+		finally:
+			pool.terminate()
+			pool.join()
+		for bestTrace, executions in results:
+			bestTrace.reattach(computation, rng)
+	else:
+		results = [(optimizer.run(computation, randomstream.RandomStream(s)), optimizer.executions) \
+				   for optimizer, s in jobs]
+	best = results[0][0]
+	for r, (bestTrace, executions) in enumerate(results):
+		if verbose:
+			print "restart {0}: log probability {1}, {2} executions".format(r, bestTrace.logprob, executions)
+		if _better(bestTrace, best):
+			best = bestTrace
+	if verbose:
+		print "Best log probability: {0} ({1} executions)".format(best.logprob, sum(e for t, e in results))
+	return best
+
+def annealedMAP(computation, annealSteps=1000, restarts=1, numWorkers=0, startTemp=10.0, endTemp=0.1, \
+				ascentSteps=100, kernel=None, verbose=False, seed=None):
+	"""
+	Maximum a posteriori inference by search rather than by sampling:
+	returns the return value of the trace found by annealedMAPTrace
+	"""
+	return annealedMAPTrace(computation, annealSteps, restarts, numWorkers, startTemp, endTemp, \
+							ascentSteps, kernel, verbose, seed).returnValue
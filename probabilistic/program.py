@@ -0,0 +1,146 @@
+import trace
+import ast
+import __builtin__
+import inspect
+import textwrap
+import types
+
+
+"""
+Static call-site information for all decorated programs:
+maps site ids to the (code id, line number) of the call
+"""
+siteInfo = {}
+
+
+def _call(site, func, *args, **kwargs):
+	"""
+	Every call in a decorated program is rewritten into a call to this
+	function, which pushes the call's static site id onto the address
+	stack of the current trace for the duration of the call
+	"""
+	t = trace._current.trace
+	if t is None or not t.staticAddressing:
+		return func(*args, **kwargs)
+	# Repeated calls from the same site get distinct addresses.
+	# This runs on every call, so it works on the trace's stack directly
+	stack = t.addressStack
+	key = stack[-1] + site
+	callnum = t.loopcounters.get(key, 0)
+	t.loopcounters[key] = callnum + 1
+	stack.append(key + ":" + str(callnum) + "|")
+	try:
+		return func(*args, **kwargs)
+	finally:
+		stack.pop()
+
+def _makeCell(value):
+	return (lambda: value).func_closure[0]
+
+_callCell = _makeCell(_call)
+
+
+class _CallSiteTransformer(ast.NodeTransformer):
+	"""
+	Rewrites every call 'f(args)' into '_call(siteid, f, args)'.
+	Calls to builtins are left alone: they cannot make random choices
+	themselves, and any decorated code they call back into still
+	pushes its own call sites.
+	"""
+
+	def __init__(self, prefix, builtins):
+		self.prefix = prefix
+		self.builtins = builtins
+		self.numSites = 0
+		self.sites = []
+
+	def visit_Call(self, node):
+		self.generic_visit(node)
+		if isinstance(node.func, ast.Name) and node.func.id in self.builtins:
+			return node
+		site = "{0}#{1}".format(self.prefix, self.numSites)
+		self.numSites += 1
+		self.sites.append((site, node.lineno))
+		return ast.copy_location(ast.Call(func=ast.Name(id="__pp_call__", ctx=ast.Load()), \
+										  args=[ast.Str(s=site), node.func] + node.args, \
+										  keywords=node.keywords, starargs=node.starargs, kwargs=node.kwargs), \
+								 node)
+
+
+def _boundNames(tree):
+	"""
+	All names that are assigned or defined anywhere within an AST
+	"""
+	names = set()
+	for node in ast.walk(tree):
+		if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+			names.add(node.id)
+		elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+			names.add(node.name)
+		elif isinstance(node, ast.alias):
+			names.add((node.asname if node.asname else node.name).split(".")[0])
+	return names
+
+
+def program(func):
+	"""
+	Decorator that gives a probabilistic program static addresses.
+	The function's source is rewritten so that every call site carries a
+	static id and passes an explicit address down the call stack, so traces
+	of the program never need to inspect interpreter frames.
+	Functions it calls should be decorated as well; random choices made in
+	undecorated functions are told apart by the order in which they are made.
+	"""
+	if not isinstance(func, types.FunctionType) or func.__name__ == "<lambda>":
+		raise TypeError("@program can only be applied to functions defined with 'def'")
+	code = func.func_code
+	tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+	funcdef = tree.body[0]
+	funcdef.decorator_list = []
+	ast.increment_lineno(funcdef, code.co_firstlineno - funcdef.lineno)
+	builtins = set(dir(__builtin__)) - set(func.func_globals.keys()) - _boundNames(funcdef)
+	transformer = _CallSiteTransformer("{0}.{1}".format(func.__module__, func.__name__), builtins)
+	transformer.visit(funcdef)
+
+	# Compile the rewritten function inside a factory whose parameters
+	# stand in for the original function's free variables. It is renamed so
+	# that references to its own name still resolve the way they did originally.
+	funcdef.name = "__pp_program__"
+	freevars = ("__pp_call__",) + code.co_freevars
+	factory = ast.FunctionDef(name="__pp_factory__", \
+							  args=ast.arguments(args=[ast.Name(id=v, ctx=ast.Param()) for v in freevars], \
+												 vararg=None, kwarg=None, defaults=[]), \
+							  body=[funcdef], decorator_list=[])
+	ast.copy_location(factory, funcdef)
+	module = ast.fix_missing_locations(ast.Module(body=[factory]))
+	modcode = compile(module, code.co_filename, "exec")
+	factorycode = filter(lambda c: isinstance(c, types.CodeType), modcode.co_consts)[0]
+	c = filter(lambda c: isinstance(c, types.CodeType) and c.co_name == funcdef.name, factorycode.co_consts)[0]
+	newcode = types.CodeType(c.co_argcount, c.co_nlocals, c.co_stacksize, c.co_flags, c.co_code, c.co_consts, \
+							 c.co_names, c.co_varnames, c.co_filename, func.__name__, c.co_firstlineno, \
+							 c.co_lnotab, c.co_freevars, c.co_cellvars)
+
+	# Share the original closure cells, so later rebinding of free variables
+	# (e.g. recursive inner functions) is seen by the new function
+	cells = dict(zip(code.co_freevars, func.func_closure or ()))
+	cells["__pp_call__"] = _callCell
+	closure = tuple(cells[v] for v in newcode.co_freevars)
+	newfunc = types.FunctionType(newcode, func.func_globals, func.__name__, func.func_defaults, closure)
+	newfunc.__doc__ = func.__doc__
+	newfunc.__dict__.update(func.__dict__)
+	newfunc._staticAddressing = True
+
+	for site, lineno in transformer.sites:
+		siteInfo[site] = (str(id(newcode)), lineno)
+	return newfunc
+
+
+def staticCallSite(name):
+	"""
+	The (code id, line number) of the call site that created the variable
+	at a static address, or None if 'name' is not a static address
+	"""
+	if "#" not in name:
+		return None
+	segment = name.rsplit("|", 2)[-2]
+	return siteInfo.get(segment.rsplit(":", 1)[0])
@@ -0,0 +1,138 @@
+import random
+import hashlib
+import math
+import itertools
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def _hashSeed(entropy, spawnKey):
+	"""
+	Mix a root seed and a spawn key into a 256-bit generator seed
+	"""
+	digest = hashlib.sha256(repr((entropy, spawnKey))).hexdigest()
+	return long(digest, 16)
+
+
+class RandomStream(random.Random):
+	"""
+	A random number stream belonging to a single chain (and the traces it creates).
+	Independent child streams are derived with 'spawn' using a seed sequence:
+	each child is seeded with a hash of the root seed and the child's spawn key,
+	so a root seed always produces the same family of independent streams.
+	"""
+
+	def __new__(cls, *args, **kwargs):
+		return random.Random.__new__(cls)
+
+	def __init__(self, seed=None, spawnKey=()):
+		# Unseeded streams draw their seed from the global generator, so
+		# random.seed still makes whole programs reproducible
+		if seed is None:
+			seed = random.getrandbits(64)
+		self.entropy = seed
+		self.spawnKey = spawnKey
+		self.numSpawned = 0
+		random.Random.__init__(self, _hashSeed(seed, spawnKey))
+
+	def spawn(self, n):
+		"""
+		Create n new streams that are independent of this one and of each other
+		"""
+		children = [self._child(self.spawnKey + (self.numSpawned + i,)) for i in xrange(n)]
+		self.numSpawned += n
+		return children
+
+	def _child(self, spawnKey):
+		return RandomStream(self.entropy, spawnKey)
+
+	def logrand(self):
+		"""
+		Log of a uniform variate, as used in accept/reject tests
+		"""
+		return math.log(1.0 - self.random())
+
+	def __reduce__(self):
+		return (RandomStream, (self.entropy, self.spawnKey), (self.getstate(), self.numSpawned))
+
+	def __setstate__(self, state):
+		self.setstate(state[0])
+		self.numSpawned = state[1]
+
+
+class BufferedRandomStream(RandomStream):
+	"""
+	A RandomStream that pre-draws blocks of uniforms, log-uniforms and
+	standard normals with NumPy and hands them out one at a time, refilling
+	in bulk when a block runs out.
+	Gamma (and so beta) variates are assembled from the buffered draws
+	with the Marsaglia-Tsang method.
+	"""
+
+	def __init__(self, seed=None, spawnKey=(), blockSize=4096):
+		if numpy is None:
+			raise ImportError("BufferedRandomStream requires NumPy")
+		RandomStream.__init__(self, seed, spawnKey)
+		self.blockSize = blockSize
+		self.generator = numpy.random.RandomState([self.getrandbits(32) for i in xrange(8)])
+		# Each supply is the C-level 'next' of an iterator over lazily drawn blocks,
+		# so handing out a number never runs any Python code
+		self.random = self._supply(self.generator.random_sample)
+		self.logrand = self._supply(lambda n: numpy.log1p(-self.generator.random_sample(n)))
+		self.normal = self._supply(self.generator.standard_normal)
+
+	def _supply(self, draw):
+		def blocks():
+			while True:
+				yield draw(self.blockSize).tolist()
+		return itertools.chain.from_iterable(blocks()).next
+
+	def _child(self, spawnKey):
+		return BufferedRandomStream(self.entropy, spawnKey, self.blockSize)
+
+	def gauss(self, mu=0.0, sigma=1.0):
+		return mu + sigma*self.normal()
+
+	normalvariate = gauss
+
+	def gammavariate(self, alpha, beta):
+		if alpha < 1.0:
+			return self.gammavariate(alpha + 1.0, beta) * math.exp(self.logrand() / alpha)
+		d = alpha - 1.0/3
+		c = 1.0 / math.sqrt(9.0*d)
+		while True:
+			x = self.normal()
+			v = 1.0 + c*x
+			if v <= 0.0:
+				continue
+			v = v*v*v
+			if self.logrand() < 0.5*x*x + d - d*v + d*math.log(v):
+				return d*v*beta
+
+	def betavariate(self, alpha, beta):
+		y = self.gammavariate(alpha, 1.0)
+		if y == 0.0:
+			return 0.0
+		return y / (y + self.gammavariate(beta, 1.0))
+
+	def __reduce__(self):
+		# Numbers already drawn into the current blocks are not preserved
+		return (BufferedRandomStream, (self.entropy, self.spawnKey, self.blockSize), \
+				(self.getstate(), self.numSpawned, self.generator.get_state()))
+
+	def __setstate__(self, state):
+		self.setstate(state[0])
+		self.numSpawned = state[1]
+		self.generator.set_state(state[2])
+
+
+def makeStream(seed=None):
+	"""
+	Turn a 'seed' argument into a stream: streams are used as-is,
+	anything else (including None) seeds a new RandomStream
+	"""
+	if isinstance(seed, random.Random):
+		return seed
+	return RandomStream(seed)
@@ -0,0 +1,256 @@
+import inference
+import randomstream
+import hashlib
+import cPickle
+import types
+import functools
+import tempfile
+import os
+import sys
+
+
+_libraryDir = os.path.dirname(os.path.abspath(__file__))
+
+def _inLibrary(obj):
+	# Scripts run from the library's directory (such as its tests) are not part of it
+	name = getattr(obj, "__module__", None)
+	module = sys.modules.get(name)
+	return name != "__main__" and os.path.dirname(os.path.abspath(getattr(module, "__file__", ""))) == _libraryDir
+
+def _fingerprint(obj, out, seen):
+	"""
+	Append a description of a value to the list 'out' that only changes when
+	the value, or the code it runs, changes: functions are described by their
+	code, defaults, closures and the globals they refer to, rather than by
+	their identity. Instances are described by their class and their
+	attributes (only the ones named by the class's _cacheKeyAttributes, if
+	it has any). Functions and methods of this library are described by
+	name alone, since their globals include caches that change as they run.
+	"""
+	if isinstance(obj, (types.NoneType, bool, int, long, float, complex, str, unicode)):
+		out.append(repr(obj))
+		return
+	if id(obj) in seen:
+		out.append("<cycle>")
+		return
+	# Holding on to the object keeps its id from being reused by a temporary
+	seen[id(obj)] = obj
+	if isinstance(obj, (list, tuple)):
+		out.append("{0}[".format(type(obj).__name__))
+		for x in obj:
+			_fingerprint(x, out, seen)
+		out.append("]")
+	elif isinstance(obj, dict):
+		out.append("dict{")
+		items = []
+		for k, v in obj.iteritems():
+			entry = []
+			_fingerprint(k, entry, seen)
+			_fingerprint(v, entry, seen)
+			items.append(entry)
+		for entry in sorted(items):
+			out.extend(entry)
+		out.append("}")
+	elif isinstance(obj, types.FunctionType):
+		out.append("function {0}.{1}".format(obj.__module__, obj.__name__))
+		if _inLibrary(obj):
+			return
+		_fingerprintCode(obj.func_code, obj.func_globals, out, seen)
+		_fingerprint(obj.func_defaults, out, seen)
+		_fingerprint([cell.cell_contents for cell in (obj.func_closure or ())], out, seen)
+	elif isinstance(obj, types.MethodType):
+		out.append("method")
+		_fingerprint(obj.im_func, out, seen)
+		_fingerprint(obj.im_self, out, seen)
+	elif isinstance(obj, functools.partial):
+		out.append("partial")
+		_fingerprint((obj.func, obj.args, obj.keywords), out, seen)
+	elif isinstance(obj, (types.BuiltinFunctionType, types.ModuleType, types.ClassType, type)):
+		out.append("{0} {1}.{2}".format(type(obj).__name__, getattr(obj, "__module__", None), obj.__name__))
+	elif isinstance(obj, randomstream.RandomStream):
+		out.append(cPickle.dumps(obj, 2))
+	elif hasattr(obj, "__dict__"):
+		cls = obj.__class__
+		out.append("instance {0}.{1}".format(cls.__module__, cls.__name__))
+		if not _inLibrary(cls):
+			for name in sorted(dir(cls)):
+				method = getattr(cls, name)
+				if isinstance(method, types.MethodType):
+					_fingerprint(method.im_func, out, seen)
+		attrs = getattr(cls, "_cacheKeyAttributes", None)
+		state = obj.__dict__
+		_fingerprint(state if attrs is None else dict((a, state.get(a)) for a in attrs), out, seen)
+	else:
+		try:
+			out.append(cPickle.dumps(obj, 2))
+		except Exception:
+			# Unpicklable and opaque: no better than its identity
+			out.append(repr(obj))
+
+def _fingerprintCode(code, globs, out, seen):
+	out.extend([code.co_code, repr(code.co_names), repr(code.co_varnames), repr(code.co_freevars)])
+	for const in code.co_consts:
+		if isinstance(const, types.CodeType):
+			_fingerprintCode(const, globs, out, seen)
+		else:
+			_fingerprint(const, out, seen)
+	for name in code.co_names:
+		if name in globs:
+			out.append("global " + name)
+			_fingerprint(globs[name], out, seen)
+
+def cacheKey(*values):
+	"""
+	A stable hash of some values (computations, inference procedures
+	and their arguments), which is the same in every process and every run
+	of the program so long as the code involved does not change
+	"""
+	out = []
+	_fingerprint(values, out, {})
+	return hashlib.sha1("\0".join(out)).hexdigest()
+
+
+class ResultCache:
+	"""
+	On-disk cache of inference results, so that repeating a query (in this or
+	any later run of the program) returns the stored answer instead of
+	sampling again. Results are keyed by the code of the computation (see
+	cacheKey), the inference procedure and all of its arguments, including
+	the seed; unseeded queries are cached too, and return the same samples
+	each time.
+	The directory is kept under 'maxBytes' by deleting the least recently
+	used results.
+	"""
+
+	def __init__(self, directory, maxBytes=2**30):
+		self.directory = directory
+		self.maxBytes = maxBytes
+		self.hits = 0
+		self.misses = 0
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def _path(self, key):
+		return os.path.join(self.directory, key + ".pkl")
+
+	def load(self, key):
+		"""
+		The result stored under a key, or None
+		"""
+		path = self._path(key)
+		try:
+			with open(path, "rb") as f:
+				result = cPickle.load(f)
+			os.utime(path, None)
+			return result
+		except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+			return None
+
+	def store(self, key, result):
+		"""
+		Store a result under a key, then evict old results as needed.
+		Results that cannot be pickled are not stored.
+		Returns whether the result was stored.
+		"""
+		try:
+			data = cPickle.dumps(result, 2)
+		except (cPickle.PicklingError, TypeError, AttributeError):
+			return False
+		# Written to a temporary file first, so readers never see a partial result
+		fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.rename(tmppath, self._path(key))
+		self.evict()
+		return True
+
+	def evict(self):
+		"""
+		Delete least recently used results until the cache fits in maxBytes
+		"""
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith(".pkl"):
+				try:
+					st = os.stat(os.path.join(self.directory, name))
+					entries.append((st.st_mtime, st.st_size, name))
+				except OSError:
+					pass
+		total = sum(size for mtime, size, name in entries)
+		for mtime, size, name in sorted(entries):
+			if total <= self.maxBytes:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except OSError:
+				pass
+			total -= size
+
+	def _query(self, kind, summarize, computation, samplingFn, samplerArgs):
+		key = cacheKey(kind, computation, samplingFn, samplerArgs)
+		entry = self.load(key)
+		if entry is None:
+			self.misses += 1
+			entry = (summarize(samplingFn(computation, *samplerArgs)),)
+			self.store(key, entry)
+		else:
+			self.hits += 1
+		return entry[0]
+
+	def samples(self, computation, samplingFn, *samplerArgs):
+		"""
+		Cached samplingFn(computation, *samplerArgs)
+		"""
+		return self._query("samples", lambda samps: samps, computation, samplingFn, samplerArgs)
+
+	def distrib(self, computation, samplingFn, *samplerArgs):
+		"""
+		Cached inference.distrib
+		"""
+		return self._query("distrib", lambda samps: inference.distrib(None, lambda c: samps), \
+						   computation, samplingFn, samplerArgs)
+
+	def expectation(self, computation, samplingFn, *samplerArgs):
+		"""
+		Cached inference.expectation
+		"""
+		return self._query("expectation", lambda samps: inference.expectation(None, lambda c: samps), \
+						   computation, samplingFn, samplerArgs)
+
+	def MAP(self, computation, samplingFn, *samplerArgs):
+		"""
+		Cached inference.MAP
+		"""
+		return self._query("MAP", lambda samps: inference.MAP(None, lambda c: samps), \
+						   computation, samplingFn, samplerArgs)
+
+	def traceMH(self, computation, numsamps, lag=1, seed=None):
+		"""
+		Cached inference.traceMH, which also stores the end of the chain:
+		asking for more samples than are stored resumes the chain to draw
+		only the extra ones. The samples are the same as those of
+		traceMH(computation, numsamps, lag, seed=seed), however many
+		steps they were drawn in.
+		"""
+		key = cacheKey("traceMH chain", computation, lag, seed)
+		entry = self.load(key)
+		if entry is not None and len(entry[0]) >= numsamps:
+			self.hits += 1
+			return entry[0][:numsamps]
+		self.misses += 1
+		kernel = inference.RandomWalkKernel()
+		if entry is None or entry[1] is None:
+			end = inference.TraceRecorder()
+			samps = list(inference.mcmcIterator(computation, kernel, numsamps, lag, False, end, seed))
+			currTrace = end.last()
+		else:
+			samps, currTrace, rng = entry
+			currTrace.reattach(computation, rng)
+			for i in xrange((numsamps - len(samps)) * lag):
+				currTrace = kernel.next(currTrace)
+				if (i+1) % lag == 0:
+					samps.append((currTrace.returnValue, currTrace.logprob))
+		# Traces pickle without their computation and stream, so the stream goes alongside
+		if not self.store(key, (samps, currTrace, currTrace.rng)):
+			self.store(key, (samps, None, None))
+		return samps
@@ -0,0 +1,323 @@
+import inference
+import trace
+import randomstream
+import BaseHTTPServer
+import SocketServer
+import multiprocessing
+import threading
+import Queue
+import urlparse
+import random
+import json
+import time
+from collections import Counter, deque
+
+
+_workerChains = {}
+_workerKernel = None
+
+def _initServerWorker(models, burnIn, seed, workerCount):
+	"""
+	Start a warm chain for every model in this worker process
+	"""
+	global _workerKernel
+	_workerKernel = inference.RandomWalkKernel()
+	# Workers are forked with the same global state, so each gets its own
+	# stream, spawned from the seed by the order in which workers start
+	with workerCount.get_lock():
+		index = workerCount.value
+		workerCount.value += 1
+	rng = randomstream.RandomStream(seed, (index,))
+	for name, (computation, lag) in models.iteritems():
+		currTrace = trace.newTrace(computation, rng)
+		for i in xrange(burnIn):
+			currTrace = _workerKernel.next(currTrace)
+		_workerChains[name] = currTrace
+
+def _serveBatch(job):
+	"""
+	Draw consecutive runs of samples, one per request in the batch,
+	from this worker's chain for a model.
+	Returns the runs, or the error that stopped the chain.
+	"""
+	name, lag, sizes = job
+	currTrace = _workerChains[name]
+	batches = []
+	try:
+		for numsamps in sizes:
+			samps = []
+			for i in xrange(numsamps * lag):
+				currTrace = _workerKernel.next(currTrace)
+				if (i+1) % lag == 0:
+					samps.append((currTrace.returnValue, currTrace.logprob))
+			batches.append(samps)
+	except Exception as e:
+		return None, "{0}: {1}".format(type(e).__name__, e)
+	_workerChains[name] = currTrace
+	return batches, None
+
+
+def _summarize(kind, samps):
+	"""
+	Answer a query of the given kind from its samples, in a form that
+	can be sent as JSON
+	"""
+	if kind == "samples":
+		return map(list, samps)
+	if kind == "distrib":
+		hist = Counter(s[0] for s in samps)
+		return [[val, count / float(len(samps))] for val, count in hist.most_common()]
+	if kind == "expectation":
+		return inference.mean(map(lambda s: s[0], samps))
+	if kind == "MAP":
+		return max(samps, key=lambda s: s[1])[0]
+	raise ValueError("Unknown query kind '{0}'".format(kind))
+
+
+class _PendingQuery:
+
+	def __init__(self, numsamps):
+		self.numsamps = numsamps
+		self.start = time.time()
+		self.done = threading.Event()
+		self.samps = None
+		self.error = None
+
+
+class _QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	GET /query?model=<name>&kind=<samples|distrib|expectation|MAP>&samples=<n>
+	GET /metrics
+	GET /models
+	"""
+
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		args = dict(urlparse.parse_qsl(url.query))
+		server = self.server.inferenceServer
+		try:
+			if url.path == "/query":
+				if args.get("model") not in server.models:
+					return self.respond(404, {"error": "Unknown model '{0}'".format(args.get("model"))})
+				result = server.query(args["model"], args.get("kind", "samples"), int(args.get("samples", 100)))
+				self.respond(200, {"result": result})
+			elif url.path == "/metrics":
+				self.respond(200, server.metrics())
+			elif url.path == "/models":
+				self.respond(200, sorted(server.models.keys()))
+			else:
+				self.respond(404, {"error": "Unknown path '{0}'".format(url.path)})
+		except ValueError as e:
+			self.respond(400, {"error": str(e)})
+		except Exception as e:
+			self.respond(500, {"error": str(e)})
+
+	def respond(self, code, obj):
+		body = json.dumps(obj)
+		self.send_response(code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+class InferenceServer:
+	"""
+	Answers repeated small queries against a fixed set of registered
+	computations. A pool of worker processes keeps a burned-in MH chain
+	for every model, so a query only pays for the samples it asks for.
+	Queries for the same model that arrive within 'batchWindow' seconds of
+	each other (up to 'maxBatch' of them) are sent to a worker together and
+	drawn from consecutive stretches of the same chain.
+	Queries can be made directly with query(), or over HTTP on localhost
+	once serve() has been called. A query that gets no answer within
+	'queryTimeout' seconds (e.g. because its worker died) raises an error.
+	"""
+
+	def __init__(self, numWorkers=None, burnIn=1000, batchWindow=0.002, maxBatch=16, seed=None, latencyWindow=10000, \
+				 queryTimeout=60.0):
+		self.numWorkers = numWorkers
+		self.burnIn = burnIn
+		self.batchWindow = batchWindow
+		self.maxBatch = maxBatch
+		self.seed = (seed if seed is not None else random.getrandbits(64))
+		self.models = {}
+		self.queues = {}
+		self.latencies = {}
+		self.numQueries = {}
+		self.numBatches = {}
+		self.lock = threading.Lock()
+		self.inflight = {}
+		self.batchers = []
+		self.pool = None
+		self.httpServer = None
+		self.latencyWindow = latencyWindow
+		self.queryTimeout = queryTimeout
+
+	def register(self, name, computation, lag=1):
+		"""
+		Register a computation under a name; must be done before start()
+		"""
+		if self.pool is not None:
+			raise RuntimeError("Models must be registered before the server starts")
+		self.models[name] = (computation, lag)
+		self.queues[name] = Queue.Queue()
+		self.latencies[name] = deque(maxlen=self.latencyWindow)
+		self.numQueries[name] = 0
+		self.numBatches[name] = 0
+
+	def start(self):
+		"""
+		Start the workers and burn in their chains
+		"""
+		self.pool = multiprocessing.Pool(self.numWorkers, _initServerWorker, \
+										 (self.models, self.burnIn, self.seed, multiprocessing.Value("i", 0)))
+		self.batchers = []
+		for name in self.models:
+			batcher = threading.Thread(target=self._batch, args=(name,))
+			batcher.daemon = True
+			batcher.start()
+			self.batchers.append(batcher)
+
+	def serve(self, port=0):
+		"""
+		Answer queries over HTTP on localhost, from a background thread.
+		Returns the port (an unused one, if 'port' is 0).
+		"""
+		if self.pool is None:
+			self.start()
+		self.httpServer = _HTTPServer(("127.0.0.1", port), _QueryHandler)
+		self.httpServer.inferenceServer = self
+		serverThread = threading.Thread(target=self.httpServer.serve_forever)
+		serverThread.daemon = True
+		serverThread.start()
+		return self.httpServer.server_address[1]
+
+	def query(self, name, kind="samples", numsamps=100):
+		"""
+		Draw 'numsamps' samples from a registered model and summarize
+		them as 'samples', 'distrib', 'expectation' or 'MAP'.
+		Blocks until the answer is ready; safe to call from many threads.
+		"""
+		if self.pool is None:
+			raise RuntimeError("The server is not running")
+		if name not in self.models:
+			raise ValueError("Unknown model '{0}'".format(name))
+		if kind not in ("samples", "distrib", "expectation", "MAP"):
+			raise ValueError("Unknown query kind '{0}'".format(kind))
+		if numsamps < 1:
+			raise ValueError("Queries need at least one sample")
+		pending = _PendingQuery(numsamps)
+		self.queues[name].put(pending)
+		if not pending.done.wait(self.queryTimeout):
+			raise RuntimeError("Query for model '{0}' got no answer within {1} seconds".format(name, self.queryTimeout))
+		if pending.error is not None:
+			raise pending.error
+		return _summarize(kind, pending.samps)
+
+	def _batch(self, name):
+		"""
+		Collect queries for one model into batches and hand them to the workers
+		"""
+		queue = self.queues[name]
+		lag = self.models[name][1]
+		while True:
+			pending = queue.get()
+			# close() puts None on every queue to stop its batcher
+			if pending is None:
+				return
+			batch = [pending]
+			deadline = time.time() + self.batchWindow
+			while len(batch) < self.maxBatch:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					pending = queue.get(True, timeout)
+				except Queue.Empty:
+					break
+				if pending is None:
+					self._fail(batch, RuntimeError("The server was closed"))
+					return
+				batch.append(pending)
+			job = (name, lag, [p.numsamps for p in batch])
+			with self.lock:
+				self.inflight[id(batch)] = batch
+			try:
+				self.pool.apply_async(_serveBatch, (job,), callback=lambda result, batch=batch: self._finish(name, batch, result))
+			except Exception:
+				# The pool has been shut down
+				self._fail(batch, RuntimeError("The server was closed"))
+				return
+
+	def _finish(self, name, batch, result):
+		results, error = result
+		now = time.time()
+		with self.lock:
+			self.inflight.pop(id(batch), None)
+			self.numBatches[name] += 1
+			for pending in batch:
+				self.numQueries[name] += 1
+				self.latencies[name].append(now - pending.start)
+		if error is not None:
+			return self._fail(batch, RuntimeError(error))
+		for pending, samps in zip(batch, results):
+			pending.samps = samps
+			pending.done.set()
+
+	def _fail(self, batch, error):
+		with self.lock:
+			self.inflight.pop(id(batch), None)
+		for pending in batch:
+			pending.error = error
+			pending.done.set()
+
+	def metrics(self):
+		"""
+		Per-model query and batch counts, with the median and 99th
+		percentile latency (in milliseconds) of recent queries
+		"""
+		stats = {}
+		with self.lock:
+			for name in self.models:
+				lats = sorted(self.latencies[name])
+				stats[name] = {"queries": self.numQueries[name], "batches": self.numBatches[name], \
+							   "p50": (1000 * lats[int(0.5 * (len(lats) - 1))] if lats else None), \
+							   "p99": (1000 * lats[int(0.99 * (len(lats) - 1))] if lats else None)}
+		return stats
+
+	def close(self):
+		"""
+		Stop answering queries and shut down the workers;
+		queries still waiting for an answer raise RuntimeError
+		"""
+		if self.httpServer is not None:
+			self.httpServer.shutdown()
+			self.httpServer.server_close()
+			self.httpServer = None
+		if self.pool is not None:
+			pool = self.pool
+			self.pool = None
+			pool.terminate()
+			pool.join()
+			with self.lock:
+				abandoned = self.inflight.values()
+			for name, queue in self.queues.iteritems():
+				while True:
+					try:
+						abandoned.append([queue.get(False)])
+					except Queue.Empty:
+						break
+			for batch in abandoned:
+				self._fail(batch, RuntimeError("The server was closed"))
+			for queue in self.queues.itervalues():
+				queue.put(None)
+			for batcher in self.batchers:
+				batcher.join()
@@ -0,0 +1,189 @@
+import trace
+import inference
+import randomstream
+import math
+import traceback
+import multiprocessing
+
+
+def _chainWorker(conn, computation, rng):
+	"""
+	Body of a replica-exchange worker process.
+	Owns a single chain and advances it at whatever temperature
+	the master assigns to it for the current round.
+	"""
+	try:
+		kernel = inference.RandomWalkKernel()
+		currTrace = inference.TemperedTrace(trace.newTrace(computation, rng))
+		while True:
+			msg = conn.recv()
+			if msg[0] == "stop":
+				conn.send((kernel.proposalsAccepted, kernel.proposalsMade))
+				break
+			temperature, numsteps, firstStep, lag, collect = msg[1:]
+			currTrace.temperature = temperature
+			samps = []
+			for i in xrange(firstStep, firstStep + numsteps):
+				currTrace = kernel.next(currTrace)
+				if collect and i % lag == 0:
+					samps.append((currTrace.returnValue, currTrace.trace.logprob))
+			conn.send((currTrace.trace.logprob, samps))
+	except Exception:
+		conn.send(("error", traceback.format_exc()))
+
+
+class ReplicaExchange:
+	"""
+	Runs a ladder of tempered chains, one per worker process, and
+	periodically proposes exchanges between adjacent temperatures.
+	Chains only ever report their log probabilities; an accepted exchange
+	swaps the temperatures of the two workers rather than their traces, which
+	leaves the joint distribution over (temperature, state) pairs unchanged.
+	"""
+
+	def __init__(self, computation, numChains, maxTemp, targetSwapRate=0.234, rng=None):
+		self.numChains = numChains
+		self.rng = randomstream.makeStream(rng)
+		self.targetSwapRate = targetSwapRate
+		# Geometric ladder to start; the gaps are tuned during adaptation
+		self.temperatures = [math.pow(maxTemp, float(k)/max(numChains-1, 1)) for k in xrange(numChains)]
+		self.logGaps = [math.log(self.temperatures[k+1] - self.temperatures[k]) for k in xrange(numChains-1)]
+		# rungs[k] is the index of the worker currently at temperature k
+		self.rungs = range(numChains)
+		self.logprobs = [0.0] * numChains
+		self.swapsProposed = [0] * (numChains-1)
+		self.swapsAccepted = [0] * (numChains-1)
+		self.rounds = 0
+		self.conns = []
+		self.workers = []
+		# Replies each worker owes for rounds it has been sent
+		self.pending = [0] * numChains
+		# Every chain gets its own independent stream
+		streams = self.rng.spawn(numChains)
+		for k in xrange(numChains):
+			parentConn, childConn = multiprocessing.Pipe()
+			worker = multiprocessing.Process(target=_chainWorker, args=(childConn, computation, streams[k]))
+			worker.daemon = True
+			worker.start()
+			self.conns.append(parentConn)
+			self.workers.append(worker)
+
+	def _recv(self, w):
+		msg = self.conns[w].recv()
+		self.pending[w] -= 1
+		if msg[0] == "error":
+			raise RuntimeError("Replica exchange worker failed:\n" + msg[1])
+		return msg
+
+	def advance(self, numsteps, firstStep=0, lag=1, collect=False):
+		"""
+		Advance every chain by 'numsteps' kernel steps at its current temperature
+		Returns the samples collected by the coldest chain
+		"""
+		for k, w in enumerate(self.rungs):
+			self.conns[w].send(("run", self.temperatures[k], numsteps, firstStep, lag, collect and k == 0))
+			self.pending[w] += 1
+		samps = []
+		for k, w in enumerate(self.rungs):
+			self.logprobs[w], wsamps = self._recv(w)
+			samps.extend(wsamps)
+		return samps
+
+	def exchange(self, adapt=False):
+		"""
+		Propose swaps between adjacent temperatures, alternating between
+		even and odd pairs from one round to the next
+		"""
+		for k in xrange(self.rounds % 2, self.numChains-1, 2):
+			w1 = self.rungs[k]
+			w2 = self.rungs[k+1]
+			dbeta = 1.0/self.temperatures[k] - 1.0/self.temperatures[k+1]
+			logAccept = dbeta * (self.logprobs[w2] - self.logprobs[w1])
+			acceptProb = (1.0 if logAccept >= 0 else math.exp(logAccept))
+			self.swapsProposed[k] += 1
+			if self.rng.random() < acceptProb:
+				self.swapsAccepted[k] += 1
+				self.rungs[k] = w2
+				self.rungs[k+1] = w1
+			if adapt:
+				# Widen gaps whose swaps are accepted too often, shrink the rest
+				gain = 1.0 / math.pow(self.rounds + 1, 0.6)
+				self.logGaps[k] += gain * (acceptProb - self.targetSwapRate)
+		if adapt:
+			for k in xrange(self.numChains-1):
+				self.temperatures[k+1] = self.temperatures[k] + math.exp(self.logGaps[k])
+		self.rounds += 1
+
+	def close(self, timeout=10.0):
+		"""
+		Shut down the worker processes. Workers that have failed, or that
+		do not answer within 'timeout' seconds, are terminated.
+		Returns the (accepted, proposed) kernel statistics of each worker
+		that stopped cleanly
+		"""
+		stats = []
+		for w in xrange(self.numChains):
+			conn = self.conns[w]
+			try:
+				# Discard the replies to a round that was cut short by another worker's failure
+				while self.pending[w] > 0:
+					if not conn.poll(timeout) or conn.recv()[0] == "error":
+						raise EOFError
+					self.pending[w] -= 1
+				if self.workers[w].is_alive():
+					conn.send(("stop",))
+					if conn.poll(timeout):
+						msg = conn.recv()
+						if msg[0] != "error":
+							stats.append(msg)
+			except (IOError, EOFError):
+				pass
+			self.pending[w] = 0
+			self.workers[w].join(timeout)
+			if self.workers[w].is_alive():
+				self.workers[w].terminate()
+				self.workers[w].join()
+			conn.close()
+		return stats
+
+	def stats(self):
+		for k in xrange(self.numChains-1):
+			proposed = max(self.swapsProposed[k], 1)
+			print "Swap acceptance ratio, T={0:.3f} <-> T={1:.3f}: {2} ({3}/{4})".format(self.temperatures[k], \
+								self.temperatures[k+1], float(self.swapsAccepted[k])/proposed, \
+								self.swapsAccepted[k], self.swapsProposed[k])
+
+
+def temperedMH(computation, numsamps, numChains=4, maxTemp=10.0, swapInterval=10, adaptRounds=10, lag=1, verbose=False, seed=None):
+	"""
+	Sample from a probabilistic computation using parallel tempering
+	(replica exchange) over 'numChains' single-variable-proposal
+	Metropolis-Hastings chains, each running in its own process.
+	The temperature ladder is adapted during 'adaptRounds' rounds of
+	burn-in, whose samples are discarded.
+	The computation's return values must be picklable.
+	"""
+	ladder = ReplicaExchange(computation, numChains, maxTemp, rng=seed)
+	try:
+		for r in xrange(adaptRounds):
+			ladder.advance(swapInterval)
+			ladder.exchange(adapt=True)
+		samps = []
+		i = 0
+		iters = numsamps * lag
+		while i < iters:
+			numsteps = min(swapInterval, iters - i)
+			samps.extend(ladder.advance(numsteps, i, lag, collect=True))
+			ladder.exchange()
+			i += numsteps
+			if verbose:
+				print "iteration {0}\r".format(i),
+	finally:
+		workerStats = ladder.close()
+	if verbose:
+		print ""
+		ladder.stats()
+		accepted = sum(map(lambda s: s[0], workerStats))
+		proposed = sum(map(lambda s: s[1], workerStats))
+		print "Overall acceptance ratio: {0} ({1}/{2})".format(float(accepted)/max(proposed, 1), accepted, proposed)
+	return samps
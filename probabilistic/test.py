@@ -4,6 +4,29 @@ from control import *
 from trace import *
 from erp import *
 from memoize import *
+from tempering import *
+from randomstream import *
+from program import *
+from compilation import *
+from ensemble import *
+from variational import *
+from dataset import *
+from conjugacy import *
+from server import *
+from resultcache import *
+from diagnostics import *
+from warmstart import *
+from lazy import *
+from optimization import *
+import tempfile
+import shutil
+import threading
+import time
+import os
+import json
+import urllib2
+import subprocess
+import sys
 
 from datetime import datetime
 
@@ -82,6 +105,29 @@ if __name__ == "__main__":
 		 multinomial_logprob(2, [0.2, 0.6, 0.2])], \
 		[math.log(0.2), math.log(0.6), math.log(0.2)])
 
+	aliasWeights = MultinomialWeights([0.2, 0.6, 0.2])
+	test("multinomial sample, alias table", \
+		  repeat(runs, lambda: mean(repeat(samples, lambda: multinomialDraw([.2,.3,.4], aliasWeights)))), \
+		  0.2*.2 + 0.6*.3 + 0.2*.4)
+
+	mhtest("multinomial query, alias table", \
+			lambda: multinomialDraw([.2,.3,.4], aliasWeights), \
+			0.2*.2 + 0.6*.3 + 0.2*.4)
+
+	try:
+		MultinomialWeights([0.0, 0.0])
+		zeroWeightsRejected = False
+	except ValueError:
+		zeroWeightsRejected = True
+	eqtest("multinomial weights with no total are rejected", \
+		[zeroWeightsRejected], \
+		[True], \
+		0)
+
+	mhtest("uniformDraw query", \
+			lambda: uniformDraw([.2,.3,.4,.9]), \
+			0.45)
+
 	test("gaussian sample", \
 		  repeat(runs, lambda: mean(repeat(samples, lambda: gaussian(0.1, 0.5)))), \
 		  0.1)
@@ -314,6 +360,18 @@ if __name__ == "__main__":
 			0.903225806451613)
 
 
+	def amortizedInnerQuery(fidelity):
+		a = flip(0.7)
+		condition(flip(fidelity if a else (1-fidelity)))
+		return a
+	amortizedBitFlip = amortizedQuery(amortizedInnerQuery)
+	def mhOverAmortizedQueryTest():
+		return amortizedBitFlip(0.8)
+	mhtest("mh-query over amortized query for conditioned flip", \
+			mhOverAmortizedQueryTest, \
+			0.903225806451613)
+
+
 	def transDimensionalTest():
 		a = beta(1, 5) if flip(0.9, isStructural=True) else 0.7
 		b = flip(a)
@@ -372,6 +430,626 @@ if __name__ == "__main__":
 			0.75)
 
 
+	def recordedLatentTest():
+		a = flip(0.7)
+		b = flip(0.2)
+		return a
+	def recordedLatentEstimate():
+		site = (recordedLatentTest, recordedLatentTest.func_code.co_firstlineno + 2)
+		recorder = VariableRecorder(sites=[site])
+		traceMH(recordedLatentTest, samples, lag, False, recorder)
+		assert(len(recorder.recordedNames()) == 1)
+		return recorder.expectation(recorder.recordedNames()[0])
+	test("recording an intermediate variable by call site", \
+		  repeat(runs, recordedLatentEstimate), \
+		  0.2)
+
+
+	def temperedFlipTest():
+		hyp = flip(0.7)
+		condition(flip(0.8 if hyp else 0.2))
+		return hyp
+	test("conditioned flip, parallel tempering", \
+		  repeat(runs, lambda: expectation(temperedFlipTest, temperedMH, samples, 3, 5.0, lag, 5, 1)), \
+		  (0.7*0.8) / (0.7*0.8 + 0.3*0.2))
+	def failingTemperedRuns():
+		failures = 0
+		for r in xrange(4):
+			executions = [0]
+			def failingTest():
+				executions[0] += 1
+				if executions[0] > 50:
+					raise ValueError("failingTest gave up")
+				return flip(0.5)
+			try:
+				temperedMH(failingTest, samples, 4, 5.0)
+			except RuntimeError as e:
+				failures += int("failingTest gave up" in str(e))
+		return failures
+	eqtest("replica exchange reports the failures of its workers", \
+		   [failingTemperedRuns()], \
+		   [4], \
+		   0)
+
+
+	def seededRunLogprobs(seed):
+		return map(lambda s: s[1], traceMH(transDimensionalTest, samples, 1, False, None, seed))
+	eqtest("seeded traceMH is reproducible", \
+		   seededRunLogprobs(1234), \
+		   seededRunLogprobs(1234), \
+		   tolerance=0.0)
+
+	def spawnedStreamsEstimate():
+		streams = RandomStream(1234).spawn(runs)
+		return map(lambda stream: expectation(andConditionedOnOrTest, traceMH, samples, lag, False, None, stream), streams)
+	eqtest("spawned streams are reproducible", \
+		   spawnedStreamsEstimate(), \
+		   spawnedStreamsEstimate(), \
+		   tolerance=0.0)
+	test("spawned streams are independent", \
+		  spawnedStreamsEstimate(), \
+		  1.0/3)
+
+	def inSubprocess(code):
+		"""
+		The JSON printed by some code run in a fresh interpreter, whose code objects
+		(and so whose frame-based addresses) differ from this one's
+		"""
+		here = os.path.dirname(os.path.abspath(__file__))
+		return json.loads(subprocess.check_output([sys.executable, "-c", code], cwd=here))
+	seededProcessCode = """
+import json
+from inference import *
+from erp import *
+def flipsAndGaussians():
+	total = 0.0
+	for i in xrange(6):
+		if flip(0.5):
+			total += 1
+	for i in xrange(6):
+		total += gaussian(0, 1)
+	return total
+print json.dumps(map(lambda s: s[0], traceMH(flipsAndGaussians, 300, seed=42)))
+"""
+	eqtest("seeded traceMH is reproducible across processes", \
+		   inSubprocess(seededProcessCode), \
+		   inSubprocess(seededProcessCode), \
+		   tolerance=0.0)
+
+
+	bufferedStream = BufferedRandomStream(1234)
+	test("buffered gaussian sample", \
+		  repeat(runs, lambda: mean(repeat(samples, lambda: gaussian._sample_impl([0.1, 0.5], bufferedStream)))), \
+		  0.1)
+	test("buffered gamma sample", \
+		  repeat(runs, lambda: mean(repeat(samples, lambda: gamma._sample_impl([2, 2], bufferedStream)/10))), \
+		  0.4)
+	test("buffered beta sample", \
+		  repeat(runs, lambda: mean(repeat(samples, lambda: beta._sample_impl([2, 5], bufferedStream)))), \
+		  2.0/(2+5))
+	test("buffered poisson sample", \
+		  repeat(runs, lambda: mean(repeat(samples, lambda: poisson._sample_impl([4], bufferedStream)/10.0))), \
+		  0.4)
+	test("conditioned flip, buffered stream", \
+		  repeat(runs, lambda: expectation(conditionedFlipTest, traceMH, samples, lag, False, None, BufferedRandomStream())), \
+		  (0.7*0.8) / (0.7*0.8 + 0.3*0.2))
+
+
+	@program
+	def staticRecursiveTest():
+		def powerLaw(prob, x):
+			if flip(prob, isStructural=True):
+				return x
+			else:
+				return 0 + powerLaw(prob, x+1)
+		a = powerLaw(0.3, 1)
+		return a < 5
+	mhtest("recursive stochastic fn, static addresses", \
+			staticRecursiveTest, \
+			0.7599)
+
+	@program
+	def staticLoopTest():
+		accum = [0]
+		def block(i):
+			if i < 5:
+				accum[0] += flip(0.5, conditionedValue=True)
+			else:
+				accum[0] += flip(0.5)
+		ntimes(10, block)
+		for i in xrange(4):
+			accum[0] += flip(0.5)
+		return accum[0] / 14.0
+	mhtest("loops, static addresses", \
+			staticLoopTest, \
+			(5 + 4.5) / 14.0)
+
+	@program
+	def staticTransDimensionalTest():
+		a = beta(1, 5) if flip(0.9, isStructural=True) else 0.7
+		b = flip(a)
+		condition(b)
+		return a
+	larjtest("trans-dimensional (LARJ), static addresses", \
+			  staticTransDimensionalTest, \
+			  0.417)
+
+	def staticRecordedEstimate():
+		@program
+		def model():
+			a = flip(0.7)
+			b = flip(0.2)
+			return a
+		recorder = VariableRecorder(sites=[(model, model.func_code.co_firstlineno + 3)])
+		traceMH(model, samples, lag, False, recorder)
+		assert(len(recorder.recordedNames()) == 1)
+		return recorder.expectation(recorder.recordedNames()[0])
+	test("recording an intermediate variable by call site, static addresses", \
+		  repeat(runs, staticRecordedEstimate), \
+		  0.2)
+
+	def compiledGaussianMixtureTest():
+		a = gaussian(0.0, 1.0)
+		b = gaussian(0.0, 1.0)
+		factor(gaussian_logprob(a + b, 1.0, 0.5))
+		condition(b < 2.0)
+		return [a, b]
+	test("compiled fixed-structure program", \
+		  repeat(runs, lambda: expectation(lambda: compiledGaussianMixtureTest()[0], traceMH, samples, lag, False, None, None, True)), \
+		  0.45, 0.15)
+
+	def compiledTraceLogprobs(compiled):
+		return map(lambda s: s[0][1], traceMH(compiledGaussianMixtureTest, samples, 1, False, None, 99, compiled))
+	eqtest("compiled traceMH matches interpreted traceMH", \
+		   compiledTraceLogprobs(True), \
+		   compiledTraceLogprobs(False), \
+		   1e-9)
+
+	def branchingTest():
+		if flip(0.5):
+			return gaussian(0.0, 1.0)
+		return 0.0
+	test("programs with random control flow are not compiled", \
+		  [float(compileTrace(newTrace(branchingTest)) is None)], \
+		  1.0)
+	def formattingTest():
+		a = gaussian(0.0, 1.0)
+		gaussian(a, 0.5, conditionedValue=1.0)
+		return float("%.3f" % a)
+	eqtest("programs that fail on symbols are interpreted", \
+		   map(lambda s: s[1], traceMH(formattingTest, samples, 1, False, None, 99, True)), \
+		   map(lambda s: s[1], traceMH(formattingTest, samples, 1, False, None, 99, False)), \
+		   1e-9)
+
+	def ensembleTest():
+		p = beta(1, 1)
+		flip(p, conditionedValue=True)
+		flip(p, conditionedValue=True)
+		flip(p, conditionedValue=True)
+		return p
+	test("lockstep ensemble of vectorized chains", \
+		  repeat(runs, lambda: expectation(ensembleTest, ensembleMH, samples, 50, lag)), \
+		  0.8)
+
+	def gaussianMeanTest():
+		mu = gaussian(0.0, 10.0)
+		for y in [2.1, 1.9, 2.5, 1.7, 2.2]:
+			gaussian(mu, 1.0, conditionedValue=y)
+		return mu
+	test("mean-field variational inference, continuous", \
+		  repeat(runs, lambda: expectation(gaussianMeanTest, meanFieldVI, samples, 500)), \
+		  10.4 / 5.01)
+
+	def discreteFactorTest():
+		k = multinomial([0.2, 0.3, 0.5])
+		factor(-2.0 * k)
+		return k == 0
+	test("mean-field variational inference, discrete", \
+		  repeat(runs, lambda: expectation(discreteFactorTest, meanFieldVI, samples, 500)), \
+		  0.2 / (0.2 + 0.3*math.exp(-2) + 0.5*math.exp(-4)))
+
+	test("trans-dimensional, multiple-try Metropolis", \
+		  repeat(runs, lambda: expectation(transDimensionalTest, multipleTryMH, samples, 3, 0, lag)), \
+		  0.417)
+
+	test("conditioned flip, multiple-try Metropolis in worker processes", \
+		  repeat(runs, lambda: expectation(temperedFlipTest, multipleTryMH, samples, 3, 2, 2)), \
+		  (0.7*0.8) / (0.7*0.8 + 0.3*0.2))
+
+	def larjMultipleTryEstimate():
+		kernel = LARJKernel(MultipleTryKernel(3, 2, structural=False), 5)
+		try:
+			return mean(map(lambda s: s[0], mcmc(transDimensionalTest, kernel, samples, 5)))
+		finally:
+			kernel.diffusionKernel.close()
+	test("trans-dimensional (LARJ), multiple-try diffusion in worker processes", \
+		  repeat(runs, larjMultipleTryEstimate), \
+		  0.417)
+
+	observedData = [1.2, 0.4, 2.2, 1.9, 0.8, 1.4, 1.1, 2.5]
+	def individuallyConditionedTest():
+		mu = gaussian(0.0, 2.0)
+		for y in observedData:
+			gaussian(mu, 0.7, conditionedValue=y)
+		return mu
+	def observedTest():
+		mu = gaussian(0.0, 2.0)
+		observe(gaussian, [mu, 0.7], observedData)
+		return mu
+	eqtest("observing a dataset matches conditioning on each point", \
+		   map(lambda s: s[1], traceMH(observedTest, samples, 1, False, None, 77)), \
+		   map(lambda s: s[1], traceMH(individuallyConditionedTest, samples, 1, False, None, 77)), \
+		   1e-9)
+	growingData = list(observedData)
+	def growingDataTest():
+		mu = gaussian(0.0, 2.0)
+		observe(gaussian, [mu, 0.7], growingData)
+		return mu
+	growingTrace = newTrace(growingDataTest)
+	growingData.extend([50.0] * 5)
+	growingTrace.traceUpdate(True)
+	eqtest("observed lists that grow in place are rescored", \
+		   [growingTrace.logprob], \
+		   [gaussian_logprob(growingTrace.returnValue, 0.0, 2.0) + \
+			sum(gaussian_logprob(y, growingTrace.returnValue, 0.7) for y in growingData)], \
+		   1e-9)
+
+	def observedCountsTest():
+		rate = gamma(2.0, 1.0)
+		observe(poisson, [rate], [3, 5, 4, 6, 2])
+		return rate
+	test("observing counts, compiled", \
+		  repeat(runs, lambda: expectation(observedCountsTest, traceMH, samples, lag, False, None, None, True)), \
+		  22.0 / 6.0, 0.15)
+
+	plateData = [0.55 + 0.1*((i*7) % 11 - 5) for i in xrange(100)]
+	def subsampledPlateTest():
+		m = gaussian(0.0, 0.3)
+		plate(plateData, lambda y: gaussian(m, 1.0, conditionedValue=y))
+		return m
+	test("plate likelihood, subsampled MH", \
+		  repeat(runs, lambda: expectation(subsampledPlateTest, subsampledMH, samples, 10, 0.05, 5)), \
+		  sum(plateData) / (len(plateData) + 1/0.09))
+	def fixedPlateTest():
+		plate(plateData, lambda y: gaussian(0.5, 1.0, conditionedValue=y))
+		return 0.5
+	plateRecorder = TraceRecorder()
+	eqtest("subsampled MH returns fully scored traces that no longer subsample", \
+		   [subsampledMH(fixedPlateTest, 1, 100, 0.05, 1, False, plateRecorder)[0][1], \
+			plateRecorder.last().plateSelector is None], \
+		   [newTrace(fixedPlateTest).logprob, True], \
+		   1e-9)
+
+	datasetDir = tempfile.mkdtemp()
+	try:
+		observedDataset = saveDataset(os.path.join(datasetDir, "observed"), observedData, 3)
+		def datasetTest():
+			mu = gaussian(0.0, 2.0)
+			observe(gaussian, [mu, 0.7], observedDataset)
+			return mu
+		eqtest("observing a memory-mapped dataset in chunks matches observing a list", \
+			   map(lambda s: s[1], traceMH(datasetTest, samples, 1, False, None, 77)), \
+			   map(lambda s: s[1], traceMH(observedTest, samples, 1, False, None, 77)), \
+			   1e-9)
+	finally:
+		shutil.rmtree(datasetDir)
+
+	coinFlips = [True, True, False, True, True, True, False, True]
+	@collapsed
+	def collapsedBetaTest():
+		fair = flip(0.5)
+		p = (beta(1.0, 1.0) if fair else beta(2.0, 8.0))
+		for c in coinFlips:
+			flip(p, conditionedValue=c)
+		return fair
+	test("collapsed beta-flip, choosing between priors", \
+		  repeat(runs, lambda: expectation(collapsedBetaTest, traceMH, samples, lag)), \
+		  0.9147)
+
+	@collapsed
+	def uncollapsibleBetaTest():
+		p = beta(2.0, 2.0)
+		for c in coinFlips:
+			flip(p, conditionedValue=c)
+		return p + 0.0
+	test("collapsed beta used in arithmetic falls back to sampling", \
+		  repeat(runs, lambda: expectation(uncollapsibleBetaTest, traceMH, samples, lag)), \
+		  8.0 / 12.0)
+
+	@collapsed
+	def collapsedCountsTest():
+		rate = gamma(2.0, 1.0)
+		observe(poisson, [rate], [3, 5, 4, 6, 2])
+		return rate.mean()
+	test("collapsed gamma-poisson, observed counts", \
+		  repeat(runs, lambda: expectation(collapsedCountsTest, traceMH, samples, lag)), \
+		  22.0 / 6.0, 1e-9)
+
+	normalizerParams = [(0.5, 2.0), (2, 3), (9.0, 0.5), (2, 3), (0.5, 2.0)]
+	eqtest("cached normalizers and tables match direct evaluation", \
+		   [gamma_logprob(1.7, a, b) for a, b in normalizerParams] + \
+		   [beta_logprob(0.3, a, b) for a, b in normalizerParams] + \
+		   [poisson_logprob(k, 4.5) for k in [0, 3, 11, 12, 40, 2000]] + \
+		   [dirichlet_logprob([0.2, 0.3, 0.5], [1.0, 2.0, 3.0]), dirichlet_logprob([0.2, 0.3, 0.5], [1.0, 2.0, 3.0])], \
+		   [(a - 1)*math.log(1.7) - 1.7/b - math.lgamma(a) - a*math.log(b) for a, b in normalizerParams] + \
+		   [(a - 1)*math.log(0.3) + (b - 1)*math.log(0.7) - math.lgamma(a) - math.lgamma(b) + math.lgamma(a + b) \
+		    for a, b in normalizerParams] + \
+		   [k*math.log(4.5) - 4.5 - math.lgamma(k + 1) for k in [0, 3, 11, 12, 40, 2000]] + \
+		   [math.log(60.0*0.3*0.25), math.log(60.0*0.3*0.25)], \
+		   1e-6)
+
+	def sleepyTest():
+		# Sleeping releases the GIL, so the threads below interleave
+		a = gaussian(0.0, 1.0)
+		time.sleep(0.001)
+		b = gaussian(a, 1.0)
+		time.sleep(0.001)
+		gaussian(a + b, 0.5, conditionedValue=1.0)
+		return a
+	def concurrentChains():
+		results = {}
+		def run(seed):
+			results[seed] = map(lambda s: s[1], traceMH(sleepyTest, 50, 1, False, None, seed))
+		threads = [threading.Thread(target=run, args=(seed,)) for seed in xrange(4)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		return sum([results[seed] for seed in xrange(4)], [])
+	eqtest("queries in concurrent threads match sequential queries", \
+		   concurrentChains(), \
+		   sum([map(lambda s: s[1], traceMH(sleepyTest, 50, 1, False, None, seed)) for seed in xrange(4)], []), \
+		   1e-9)
+
+	def streamedChains():
+		stream = traceMHIterator(sleepyTest, None, 2, False, None, 7, False, None, 5)
+		batches = [stream.next() for i in xrange(6)]
+		stream.close()
+		pool = QueryPool(sleepyTest, 2)
+		try:
+			pooled = pool.submit(traceMH, 15, 2, False, None, 7).get()
+		finally:
+			pool.close()
+		expired = traceMH(sleepyTest, 1000, 1, False, None, 7, False, time.time() + 0.05)
+		return map(len, batches) + map(lambda s: s[1], sum(batches, []) + pooled) + [int(len(expired) < 1000)]
+	eqtest("streamed, pooled and deadline-bounded queries match traceMH", \
+		   streamedChains(), \
+		   [3, 2, 3, 2, 3, 2] + map(lambda s: s[1], traceMH(sleepyTest, 15, 2, False, None, 7) * 2) + [1], \
+		   1e-9)
+
+	def servedFlips():
+		a = flip(0.5)
+		b = flip(0.5)
+		condition(a or b)
+		return int(a)
+	def servedQueries():
+		server = InferenceServer(2, 100, seed=3)
+		server.register("flips", servedFlips, lag)
+		port = server.serve()
+		try:
+			url = "http://127.0.0.1:{0}/query?model=flips&kind=expectation&samples={1}".format(port, samples)
+			results = []
+			def ask():
+				results.append(json.loads(urllib2.urlopen(url).read())["result"])
+			threads = [threading.Thread(target=ask) for i in xrange(runs)]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			metrics = json.loads(urllib2.urlopen("http://127.0.0.1:{0}/metrics".format(port)).read())["flips"]
+			return results + [float(metrics["queries"] == runs and metrics["p99"] >= metrics["p50"])]
+		finally:
+			server.close()
+	results = servedQueries()
+	test("queries answered by the inference server", results[:-1], 2.0 / 3.0)
+	eqtest("inference server metrics", results[-1:], [1.0])
+
+	def closedServerQueries():
+		server = InferenceServer(1, 100, seed=5)
+		server.register("flips", servedFlips, lag)
+		threadsBefore = threading.active_count()
+		server.start()
+		try:
+			try:
+				server.query("noSuchModel", "samples", 1)
+				unknown = 0
+			except ValueError:
+				unknown = 1
+		finally:
+			server.close()
+		return [unknown, threading.active_count() - threadsBefore]
+	eqtest("inference server rejects unknown models and stops its threads on close", \
+		   closedServerQueries(), \
+		   [1, 0], \
+		   0)
+	seededServerCode = """
+import json
+from server import *
+from erp import *
+def servedModel():
+	total = 0.0
+	for i in xrange(3):
+		if flip(0.5):
+			total += 1
+	for i in xrange(3):
+		total += gaussian(0, 1)
+	return total
+server = InferenceServer(1, 100, seed=5)
+server.register("model", servedModel, 5)
+server.start()
+try:
+	print json.dumps(map(lambda s: s[0], server.query("model", "samples", 20) + server.query("model", "samples", 20)))
+finally:
+	server.close()
+"""
+	eqtest("seeded inference servers are reproducible across processes", \
+		   inSubprocess(seededServerCode), \
+		   inSubprocess(seededServerCode), \
+		   0)
+
+	def cachedQueries():
+		cacheDir = tempfile.mkdtemp()
+		try:
+			cache = ResultCache(cacheDir)
+			weight = [0.5]
+			def cachedFlips():
+				a = flip(weight[0])
+				b = flip(weight[0])
+				condition(a or b)
+				return int(a)
+			first = cache.expectation(cachedFlips, traceMH, samples, lag)
+			again = ResultCache(cacheDir).expectation(cachedFlips, traceMH, samples, lag)
+			weight[0] = 0.9
+			changed = cache.expectation(cachedFlips, traceMH, samples, lag)
+			cache.traceMH(cachedFlips, 10, 3, 5)
+			resumed = cache.traceMH(cachedFlips, 40, 3, 5)
+			return [first, again, first, changed] + map(lambda s: s[1], resumed) + [cache.hits, cache.misses]
+		finally:
+			shutil.rmtree(cacheDir)
+	def uncachedFlips():
+		a = flip(0.9)
+		b = flip(0.9)
+		condition(a or b)
+		return int(a)
+	results = cachedQueries()
+	eqtest("cached queries hit, miss and resume chains", \
+		   results[1:3] + results[4:], \
+		   results[:2] + map(lambda s: s[1], traceMH(uncachedFlips, 40, 3, False, None, 5)) + [0, 4], \
+		   1e-9)
+	test("cached query of a changed computation", [results[3]], 0.9 / 0.99)
+
+	def autoregressive(rho, n):
+		rng = RandomStream(4)
+		xs = [0.0]
+		for i in xrange(n - 1):
+			xs.append(rho*xs[-1] + rng.gauss(0.0, 1.0))
+		return xs
+	eqtest("effective sample size of an AR(1) sequence, relative to its true value", \
+		   [effectiveSampleSize(autoregressive(rho, 20000)) / (20000 * (1 - rho) / (1 + rho)) for rho in [0.0, 0.5, 0.9]], \
+		   [1.0, 1.0, 1.0], \
+		   0.15)
+	eqtest("MSER burn-in of a sequence with a transient", \
+		   [mserBurnIn(map(lambda x: x + 20.0, autoregressive(0.5, 100)) + autoregressive(0.5, 2000))], \
+		   [100], \
+		   5)
+
+	def budgetedTest():
+		mu = gaussian(0.0, 1.0)
+		for x in [1.0, 1.5, 0.5, 1.2]:
+			gaussian(mu, 1.0, conditionedValue=x)
+		return mu
+	budgetedRuns = repeat(runs, lambda: budgetedTraceMH(budgetedTest, targetESS=samples))
+	test("budgeted traceMH, until an effective sample size", \
+		 map(lambda samps: mean(map(lambda s: s[0], samps)), budgetedRuns), \
+		 4.2 / 5)
+	eqtest("budgeted traceMH stops by target or budget", \
+		   [int(all(samps.stopReason == "ess" and samps.ess >= samples for samps in budgetedRuns)), \
+			budgetedTraceMH(budgetedTest, maxIterations=50).iterations, \
+			int(budgetedTraceMH(budgetedTest, targetMCSE=0.0, timeBudget=0.05).stopReason == "time")], \
+		   [1, 50, 1], \
+		   0)
+
+	def makeUpdatedModel(data):
+		def updatedModel():
+			mu = gaussian(0.0, 1.0)
+			for x in data:
+				gaussian(mu, 1.0, conditionedValue=x)
+			return mu
+		return updatedModel
+	oldModel = makeUpdatedModel([1.0, 1.5])
+	newModel = makeUpdatedModel([1.0, 1.5, 3.0, 3.2, 2.8, 3.1, 2.9, 3.3])
+	def oldChain():
+		recorder = TraceRecorder(keep=samples)
+		traceMH(oldModel, samples, lag, False, recorder)
+		return recorder
+	test("warm start after new observations", \
+		 repeat(runs, lambda: expectation(newModel, lambda c: warmStart(oldChain().last(), c, samples, lag))), \
+		 20.8 / 9)
+	test("warm start with an annealing bridge", \
+		 repeat(runs, lambda: expectation(newModel, lambda c: warmStart(oldChain().last(), c, samples, lag, 20))), \
+		 20.8 / 9)
+	test("SMC update of posterior traces after new observations", \
+		 repeat(runs, lambda: mean(map(lambda t: t.returnValue, smcUpdate(oldChain().traces, newModel)))), \
+		 20.8 / 9)
+	recorder = oldChain()
+	eqtest("reattached traces keep matching choices", \
+		   [reattachTrace(recorder.last(), newModel, RandomStream()).returnValue], \
+		   [recorder.last().returnValue], \
+		   0)
+
+	lazyGaussian = lazy(gaussian)
+	lazyFlip = lazy(flip)
+	def lazyWideTest():
+		xs = [lazyGaussian(0.0, 1.0) for i in xrange(50)]
+		k = randomInteger(50)
+		gaussian(xs[k], 0.5, conditionedValue=1.0)
+		return xs[k]
+	mhtest("lazy ERPs, only one of many used", lazyWideTest, 0.8)
+	def lazyBranchTest():
+		a = lazyFlip(0.3)
+		b = lazyFlip(0.6)
+		c = lazyFlip(0.9)
+		condition(a or b)
+		return (c if a else b)
+	mhtest("lazy ERPs in control flow and conditions", lazyBranchTest, (0.3*0.9 + 0.7*0.6) / (1 - 0.7*0.4))
+	eqtest("unused lazy choices are not free variables", \
+		   [len(newTrace(lazyWideTest).freeVarNames())], \
+		   [2], \
+		   0)
+	lazyWeights = MultinomialWeights([0.2, 0.6, 0.2])
+	def lazyParamsTest():
+		lazyGaussian(0.0, 1.0)
+		a = multinomial(lazyWeights)
+		b = multinomial([lazyGaussian(1.0, 0.1), 1.0])
+		return a + b
+	lazyParamsTrace = newTrace(lazyParamsTest)
+	lazyParams = [r.params for r in lazyParamsTrace.varlist if r.erp is multinomial]
+	eqtest("lazy programs keep the parameters of other choices as they are", \
+		   [lazyParams[0] is lazyWeights, type(lazyParams[1][0]) is float], \
+		   [True, True], \
+		   0)
+
+	def sliceGaussianTest():
+		mu = gaussian(0.0, 1.0)
+		gaussian(mu, 0.5, conditionedValue=2.0)
+		return mu
+	test("gaussian posterior, slice sampling", \
+		 repeat(runs, lambda: expectation(sliceGaussianTest, sliceMH, samples, 1.0, 5)), \
+		 1.6)
+	def sliceBetaTest():
+		a = beta(2, 2)
+		flip(a, conditionedValue=True)
+		return a
+	test("bounded support, slice sampling", \
+		 repeat(runs, lambda: expectation(sliceBetaTest, sliceMH, samples, 1.0, 5)), \
+		 0.6)
+	def larjSliceEstimate():
+		return mean(map(lambda s: s[0], mcmc(transDimensionalLARJTest, LARJKernel(SliceSamplingKernel(structural=False), 10), \
+											 samples, lag)))
+	test("trans-dimensional (LARJ), slice sampling diffusion", \
+		 repeat(runs, larjSliceEstimate), \
+		 0.417)
+	sliceKernel = SliceSamplingKernel(0.1, 4, 6)
+	mcmc(sliceGaussianTest, sliceKernel, samples)
+	eqtest("slice sampling executions per step are bounded", \
+		   [sliceKernel.executions <= 10 * sliceKernel.proposalsMade], \
+		   [True], \
+		   0)
+
+	def mixtureMAPTest():
+		c = flip(0.5)
+		mu = gaussian(3.0 if c else -3.0, 1.0)
+		gaussian(mu, 0.5, conditionedValue=2.0)
+		return mu
+	eqtest("annealed MAP, discrete and continuous variables", \
+		   [annealedMAP(mixtureMAPTest, 200), annealedMAP(sliceBetaTest, 100), annealedMAP(lambda: binomial(0.3, 10), 50)], \
+		   [2.2, 2.0/3, 3], \
+		   1e-3)
+	eqtest("annealed MAP, restarts in worker processes", \
+		   [annealedMAP(mixtureMAPTest, 200, 4, 2, seed=5)], \
+		   [annealedMAP(mixtureMAPTest, 200, 4, 0, seed=5)], \
+		   0)
+
 	print "tests done!"
 
 	d2 = datetime.now()
@@ -1,5 +1,10 @@
 import sys
 import copy
+import random
+import threading
+import randomstream
+import conjugacy
+import lazy
 from collections import Counter
 
 class RandomVariableRecord:
@@ -17,6 +22,10 @@ class RandomVariableRecord:
 		self.active = True
 		self.conditioned = conditioned
 		self.structural = structural
+		# Sufficient statistics, for records of observed datasets
+		self.stats = None
+		# Length of an observed list when its statistics were computed
+		self.dataLength = None
 
 class RandomExecutionTrace:
 	"""
@@ -24,8 +33,14 @@ class RandomExecutionTrace:
 	Tracks the random choices made and accumulates probabilities
 	"""
 
-	def __init__(self, computation, doRejectionInit=True):
+	def __init__(self, computation, doRejectionInit=True, rng=None):
 		self.computation = computation
+		# Traces created inside another trace's execution (nested queries)
+		# draw from the enclosing trace's stream
+		if rng is None:
+			t = _current.trace
+			rng = (t.rng if t else randomstream.RandomStream())
+		self.rng = rng
 		self._vars = {}
 		self.varlist = []
 		self.currVarIndex = 0
@@ -34,6 +49,27 @@ class RandomExecutionTrace:
 		self.oldlogprob = 0		# From unreachable variables
 		self.rootframe = None
 		self.loopcounters = Counter()
+		# Programs decorated with @program supply their own addresses
+		self.staticAddressing = getattr(computation, "_staticAddressing", False)
+		# Programs marked as collapsed integrate out their conjugate priors,
+		# except those seen to be used in ways that have no closed form
+		self.collapse = getattr(computation, "_collapseConjugates", False)
+		self.uncollapsible = set()
+		self.addressStack = [""]
+		# An optional guide draws new free variables in place of their ERPs
+		self.guide = None
+		self.guidelogprob = 0.0
+		# An optional plate selector picks which items of each plate to evaluate
+		self.plateSelector = None
+		self.plateLogprobs = []
+		self.inSubsampledPlate = False
+		# Lazy ERPs ask for their next choice to be deferred; the values they
+		# return are only valid during the run that made them
+		self.deferNext = False
+		self.numDeferred = 0
+		self.lazyNames = []
+		self.lazyNamesFixed = False
+		self.runToken = None
 		self.conditionsSatisfied = False
 		self.returnValue = None
 		if doRejectionInit:
@@ -42,21 +78,55 @@ class RandomExecutionTrace:
 				self.traceUpdate()
 
 	def __deepcopy__(self, memo):
-		newdb = RandomExecutionTrace(self.computation, doRejectionInit=False)
+		newdb = RandomExecutionTrace(self.computation, False, self.rng)
 		newdb.logprob = self.logprob
 		newdb.oldlogprob = self.oldlogprob
 		newdb.newlogprob = self.newlogprob
 		newdb.varlist = [copy.copy(record) for record in self.varlist]
 		newdb._vars = {record.name:record for record in newdb.varlist}
+		if len(newdb._vars) != len(self._vars):
+			# Choices of lazy ERPs are recorded without being in the flat list
+			for name, record in self._vars.iteritems():
+				if name not in newdb._vars:
+					newdb._vars[name] = copy.copy(record)
 		newdb.conditionsSatisfied = self.conditionsSatisfied
 		newdb.returnValue = self.returnValue
+		newdb.plateSelector = self.plateSelector
+		newdb.lazyNames = self.lazyNames
+		newdb.uncollapsible = self.uncollapsible
 		return newdb
 
+	def __getstate__(self):
+		"""
+		Traces are pickled without their computation and random
+		stream, which must be reattached before the trace is used again
+		"""
+		state = self.__dict__.copy()
+		del state["computation"]
+		del state["rng"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.computation = None
+		self.rng = None
+
+	def reattach(self, computation, rng):
+		self.computation = computation
+		self.rng = rng
+		self.staticAddressing = getattr(computation, "_staticAddressing", False)
+		self.collapse = getattr(computation, "_collapseConjugates", False)
+
 	def freeVarNames(self, structural=True, nonstructural=True):
-		return map(lambda tup: tup[0], \
-				   filter(lambda tup: not tup[1].conditioned and \
-				   					  ((structural and tup[1].structural) or (nonstructural and not tup[1].structural)), \
-						  self._vars.iteritems()))
+		# Kernels pick variables by their position in this list, so it is in order of
+		# creation: addresses contain code object ids, which differ between processes,
+		# so the order of the dictionary of variables would too
+		records = self.varlist
+		if len(records) != len(self._vars):
+			# Choices of lazy ERPs are recorded without being in the flat list
+			records = records + [self._vars[name] for name in self.lazyNames if name in self._vars]
+		return [record.name for record in records \
+				if not record.conditioned and ((structural and record.structural) or (nonstructural and not record.structural))]
 
 	def varDiff(self, other):
 		"""
@@ -76,20 +146,27 @@ class RandomExecutionTrace:
 		Run computation and update this trace accordingly
 		"""
 
-		global _trace
-		originalTrace = _trace
-		_trace = self
+		originalTrace = _current.trace
+		_current.trace = self
 
 		self.logprob = 0.0
 		self.newlogprob = 0.0
+		self.guidelogprob = 0.0
+		self.plateLogprobs = []
 		self.loopcounters.clear()
+		del self.addressStack[1:]
 		self.conditionsSatisfied = True
 		self.currVarIndex = 0
+		self.numDeferred = 0
+		self.runToken = object()
 
 		# If updating this trace can change the variable structure, then we
 		# clear out the flat list of variables beforehand
 		if not structureIsFixed:
 			self.varlist = []
+			self.lazyNames = []
+		# (The list of lazy addresses may be shared with copies of this trace)
+		self.lazyNamesFixed = structureIsFixed
 
 		# First, mark all random values as 'inactive'; only
 		# those reeached by the computation will become 'active'
@@ -97,10 +174,28 @@ class RandomExecutionTrace:
 			record.active = False
 
 		# Mark that this is the 'root' of the current execution trace
-		self.rootframe = sys._getframe()
-
-		# Run the computation, which will create/lookup random variables
-		self.returnValue = self.computation()
+		if not self.staticAddressing:
+			self.rootframe = sys._getframe()
+
+		# Run the computation, which will create/lookup random variables.
+		# If it uses one of its collapsed variables in a way that has no closed
+		# form, that variable is sampled as usual from then on, and we start over.
+		retry = False
+		try:
+			self.returnValue = self.computation()
+			if self.numDeferred:
+				self.returnValue = lazy.forced(self.returnValue)
+		except conjugacy.UncollapsibleUse as e:
+			if e.owner != id(self) or e.name in self.uncollapsible:
+				raise
+			self.uncollapsible = self.uncollapsible | set([e.name])
+			retry = True
+		finally:
+			_current.trace = originalTrace
+			self.runToken = None
+		if retry:
+			self.traceUpdate()
+			return
 
 		# Clear out the root frame, etc.
 		self.rootframe = None
@@ -113,26 +208,43 @@ class RandomExecutionTrace:
 				self.oldlogprob += record.logprob
 		self._vars = {name:record for name,record in self._vars.iteritems() if record.active}
 
-		_trace = originalTrace
-
 	def proposeChange(self, varname):
 		"""
 		Propose a random change to the variable name 'varname'
 		Returns a new sample trace from the computation and the
 			forward and reverse probabilities of proposing this change
 		"""
-		nextTrace = copy.deepcopy(self)
-		var = nextTrace.getRecord(varname)
-		propval = var.erp._proposal(var.val, var.params)
+		var = self.getRecord(varname)
+		propval = var.erp._proposal(var.val, var.params, self.rng)
 		fwdPropLP = var.erp._logProposalProb(var.val, propval, var.params)
 		rvsPropLP = var.erp._logProposalProb(propval, var.val, var.params)
-		var.val = propval
-		var.logprob = var.erp._logprob(var.val, var.params)
-		nextTrace.traceUpdate(not var.structural)
+		nextTrace = self.changeValue(varname, propval)
 		fwdPropLP += nextTrace.newlogprob
 		rvsPropLP += nextTrace.oldlogprob
 		return nextTrace, fwdPropLP, rvsPropLP
 
+	def changeValue(self, varname, val):
+		"""
+		A new trace from the computation in which the variable
+		name 'varname' has value 'val'
+		"""
+		return self.changeValues({varname: val})
+
+	def changeValues(self, values):
+		"""
+		A new trace from the computation in which the variables named
+		by the keys of 'values' have the corresponding values
+		"""
+		nextTrace = copy.deepcopy(self)
+		structureIsFixed = True
+		for varname, val in values.iteritems():
+			var = nextTrace.getRecord(varname)
+			var.val = val
+			var.logprob = var.erp._logprob(val, var.params)
+			structureIsFixed = structureIsFixed and not var.structural
+		nextTrace.traceUpdate(structureIsFixed)
+		return nextTrace
+
 	def currentName(self, numFrameSkip):
 		"""
 		Return the current name, as determined by the interpreter
@@ -164,28 +276,81 @@ class RandomExecutionTrace:
 
 		return name
 
+	def currentStaticName(self):
+		"""
+		Return the current name, as determined by the explicit address
+			stack of a statically-addressed program
+		"""
+		prefix = self.addressStack[-1]
+		varnum = self.loopcounters[prefix]
+		self.loopcounters[prefix] += 1
+		return "{0}{1}".format(prefix, varnum)
+
 	def lookup(self, erp, params, numFrameSkip, isStructural, conditionedValue=None):
 		"""
 		Looks up the value of a random variable.
 		If this random variable does not exist, create it
 		"""
 
+		# Free choices of lazy ERPs only get their address for now. Their
+		# addresses are kept in order of creation, and reused as long as the
+		# structure of the trace is fixed, just like the flat list of variables.
+		if self.deferNext and conditionedValue is None and not self.collapse:
+			self.deferNext = False
+			if self.numDeferred < len(self.lazyNames):
+				name = self.lazyNames[self.numDeferred]
+			else:
+				name = (self.currentStaticName() if self.staticAddressing else self.currentName(numFrameSkip+1))
+				if not self.lazyNamesFixed:
+					self.lazyNames.append(name)
+			self.numDeferred += 1
+			return lazy.LazyValue(self, erp, params, isStructural, name)
+		if self.numDeferred:
+			params = lazy.forced(params)
+			conditionedValue = lazy.forced(conditionedValue)
+
+		# Items of subsampled plates are scored without keeping records
+		if self.inSubsampledPlate:
+			if conditionedValue is None:
+				raise ValueError("Subsampled plates can only make conditioned random choices")
+			self.logprob += erp._logprob(conditionedValue, params)
+			return conditionedValue
+
 		record = None
 		name = None
+		# Conjugate priors are collapsed, and their children are scored
+		# under the collapsed variable's posterior predictive
+		parent = None
+		if self.collapse:
+			if erp.conjugateChild is not None and conditionedValue is None and not isStructural:
+				name = (self.currentStaticName() if self.staticAddressing else self.currentName(numFrameSkip+1))
+				if name not in self.uncollapsible:
+					return conjugacy.CollapsedVariable(id(self), name, erp, params)
+			else:
+				parent = conjugacy.collapsedParent(erp, params)
+				if parent is not None and conditionedValue is None:
+					raise conjugacy.UncollapsibleUse(parent)
 		# Try to find the variable (first check the flat list, then do
 		# slower structural name lookup)
 		varIsInFlatList = self.currVarIndex < len(self.varlist)
 		if varIsInFlatList:
 			record = self.varlist[self.currVarIndex]
 		else:
-			name = self.currentName(numFrameSkip+1)
+			if name is None:
+				name = (self.currentStaticName() if self.staticAddressing else self.currentName(numFrameSkip+1))
 			record = self._vars.get(name)
 			if (not record or record.erp is not erp or isStructural != record.structural):
 				record = None
 		# If we didn't find the variable, create a new one
 		if not record:
-			val = (conditionedValue if conditionedValue else erp._sample_impl(params))
-			ll = erp._logprob(val, params)
+			if conditionedValue is not None:
+				val = conditionedValue
+			elif self.guide:
+				val, glp = self.guide.sampleSite(name, erp, params, self.rng)
+				self.guidelogprob += glp
+			else:
+				val = erp._sample_impl(params, self.rng)
+			ll = (parent._observe(erp, val) if parent is not None else erp._logprob(val, params))
 			self.newlogprob += ll
 			record = RandomVariableRecord(name, erp, params, val, ll, isStructural, conditionedValue != None)
 			self._vars[name] = record
@@ -194,15 +359,15 @@ class RandomExecutionTrace:
 		else:
 			record.conditioned = (conditionedValue != None)
 			hasChanges = False
-			if record.params != params:
+			if parent is not None or record.params != params:
 				record.params = params
 				hasChanges = True
-			if conditionedValue and conditionedValue != record.val:
+			if conditionedValue is not None and conditionedValue != record.val:
 				record.val = conditionedValue
 				record.conditioned = True
 				hasChanges = True
 			if hasChanges:
-				record.logprob = erp._logprob(record.val, record.params)
+				record.logprob = (parent._observe(erp, record.val) if parent is not None else erp._logprob(record.val, record.params))
 
 		# Finish up and return
 		if not varIsInFlatList:
@@ -212,6 +377,101 @@ class RandomExecutionTrace:
 		record.active = True
 		return record.val
 
+	def materialize(self, lazyval):
+		"""
+		Make the random choice of a lazy value, reusing the variable
+		at its address if there is one
+		"""
+		erp = lazyval.erp
+		params = lazy.forced(lazyval.params)
+		record = self._vars.get(lazyval.name)
+		if not record or record.erp is not erp or lazyval.isStructural != record.structural or record.conditioned:
+			if self.guide:
+				val, glp = self.guide.sampleSite(lazyval.name, erp, params, self.rng)
+				self.guidelogprob += glp
+			else:
+				val = erp._sample_impl(params, self.rng)
+			record = RandomVariableRecord(lazyval.name, erp, params, val, erp._logprob(val, params), lazyval.isStructural)
+			self.newlogprob += record.logprob
+			self._vars[lazyval.name] = record
+		elif record.params != params:
+			record.params = params
+			record.logprob = erp._logprob(record.val, params)
+		self.logprob += record.logprob
+		record.active = True
+		return record.val
+
+	def lookupObservation(self, erp, params, data, numFrameSkip):
+		"""
+		Looks up the record of a whole dataset of observations.
+		The data is scored through its sufficient statistics, which are only
+		recomputed if a different data object is observed, or if an observed
+		list has grown or shrunk.
+		"""
+
+		if self.numDeferred:
+			params = lazy.forced(params)
+
+		if self.inSubsampledPlate:
+			self.logprob += erp._logprobFromStatistics(sufficientStatistics(erp, data), params)
+			return
+
+		parent = (conjugacy.collapsedParent(erp, params) if self.collapse else None)
+		record = None
+		name = None
+		varIsInFlatList = self.currVarIndex < len(self.varlist)
+		if varIsInFlatList:
+			record = self.varlist[self.currVarIndex]
+		else:
+			name = (self.currentStaticName() if self.staticAddressing else self.currentName(numFrameSkip+1))
+			record = self._vars.get(name)
+			if (not record or record.erp is not erp or record.stats is None):
+				record = None
+		if not record:
+			stats = sufficientStatistics(erp, data)
+			ll = (parent._observeStatistics(erp, stats) if parent is not None else erp._logprobFromStatistics(stats, params))
+			self.newlogprob += ll
+			record = RandomVariableRecord(name, erp, params, data, ll, False, True)
+			record.stats = stats
+			record.dataLength = _dataLength(data)
+			self._vars[name] = record
+		else:
+			hasChanges = False
+			if record.val is not data or record.dataLength != _dataLength(data):
+				record.val = data
+				record.stats = sufficientStatistics(erp, data)
+				record.dataLength = _dataLength(data)
+				hasChanges = True
+			if parent is not None or record.params != params:
+				record.params = params
+				hasChanges = True
+			if hasChanges:
+				record.logprob = (parent._observeStatistics(erp, record.stats) if parent is not None else \
+								  erp._logprobFromStatistics(record.stats, record.params))
+
+		if not varIsInFlatList:
+			self.varlist.append(record)
+		self.currVarIndex += 1
+		self.logprob += record.logprob
+		record.active = True
+
+	def evaluatePlate(self, data, block):
+		"""
+		Run a plate on just the items picked by the plate selector,
+		keeping the log probability contributed by each of them
+		"""
+		indices = self.plateSelector(len(self.plateLogprobs), len(data))
+		lps = []
+		self.inSubsampledPlate = True
+		try:
+			for i in indices:
+				lp = self.logprob
+				block(data[i])
+				lps.append(self.logprob - lp)
+		finally:
+			self.inSubsampledPlate = False
+		self.plateLogprobs.append((len(data), indices, lps))
+
 	def getRecord(self, name):
 		"""
 		Simply retrieve the variable record associated with name
@@ -228,29 +488,84 @@ class RandomExecutionTrace:
 		"""
 		Condition the trace on the value of a boolean expression
 		"""
-		self.conditionsSatisfied = self.conditionsSatisfied and boolexpr
+		if self.conditionsSatisfied and not boolexpr:
+			self.conditionsSatisfied = False
+
+class _CurrentTrace(threading.local):
+	"""
+	The trace of the computation running on this thread, if any.
+	Every thread has its own, so independent queries can run concurrently.
+	"""
+	trace = None
+
+_current = _CurrentTrace()
 
-"""
-Global singleton instance
-"""
-_trace = None
+def currentTrace():
+	return _current.trace
+
+def setCurrentTrace(t):
+	"""
+	Make 't' (anything with the trace interface, or None) the current
+	trace of this thread. Returns the trace it replaces.
+	"""
+	original = _current.trace
+	_current.trace = t
+	return original
 
 def lookupVariableValue(erp, params, isStructural, numFrameSkip, conditionedValue=None):
-	global _trace
-	if not _trace:
-		return (conditionedValue if conditionedValue else erp._sample_impl(params))
+	t = _current.trace
+	if not t:
+		return (conditionedValue if conditionedValue is not None else erp._sample_impl(params, random))
 	else:
-		return _trace.lookup(erp, params, numFrameSkip+1, isStructural, conditionedValue)
+		return t.lookup(erp, params, numFrameSkip+1, isStructural, conditionedValue)
+
+def newTrace(computation, rng=None):
+	return RandomExecutionTrace(computation, True, rng)
 
-def newTrace(computation):
-	return RandomExecutionTrace(computation)
+def guidedTrace(computation, guide, rng=None):
+	"""
+	Run a computation once, drawing each of its free random
+	choices from a guide instead of from its ERP
+	"""
+	t = RandomExecutionTrace(computation, False, rng)
+	t.guide = guide
+	t.traceUpdate()
+	return t
+
+def sufficientStatistics(erp, data):
+	"""
+	Sufficient statistics of a dataset under an ERP. Datasets that
+	can summarize themselves (e.g. a dataset.Dataset) are asked to.
+	"""
+	summarize = getattr(data, "statistics", None)
+	return (summarize(erp) if summarize is not None else erp._sufficientStatistics(data))
+
+def _dataLength(data):
+	# Observations can be appended to a list in place as they arrive, which
+	# its length shows without looking at (or keeping a copy of) its contents
+	return (len(data) if isinstance(data, list) else None)
+
+def observe(erp, params, data):
+	"""
+	Condition on a dataset of independent draws from an ERP, e.g.
+	observe(gaussian, [mu, sigma], ys). 'params' is the ERP's parameter list.
+	The data is summarized once by sufficient statistics, so as long as the
+	same data is observed, rescoring it under new parameters takes constant
+	time. 'data' may be a list, a tuple or a dataset.Dataset. A list may
+	have observations appended to (or removed from) it in place; any other
+	change to the data (e.g. editing a list's items, or changing a NumPy
+	array in place) must be made by observing a new data object.
+	"""
+	t = _current.trace
+	if t:
+		t.lookupObservation(erp, params, data, 1)
 
 def factor(num):
-	global _trace
-	if _trace:
-		_trace.addFactor(num)
+	t = _current.trace
+	if t:
+		t.addFactor(num)
 
 def condition(boolexpr):
-	global _trace
-	if _trace:
-		_trace.conditionOn(boolexpr)
\ No newline at end of file
+	t = _current.trace
+	if t:
+		t.conditionOn(boolexpr)
\ No newline at end of file
@@ -0,0 +1,249 @@
+import trace
+import erp
+import randomstream
+import math
+
+
+def _sigmoid(z):
+	if z >= 0:
+		return 1.0 / (1.0 + math.exp(-z))
+	ez = math.exp(z)
+	return ez / (1.0 + ez)
+
+
+class _GaussianSite:
+	"""
+	Guide factor for a continuous variable: a Gaussian over the variable,
+	mapped onto the ERP's support where that is not the whole real line
+	"""
+
+	def __init__(self, theerp, params):
+		self.erp = theerp
+		if isinstance(theerp, erp.GaussianRandomPrimitive):
+			self.params = [float(params[0]), math.log(params[1])]
+		elif isinstance(theerp, erp.GammaRandomPrimitive):
+			self.params = [math.log(params[0]*params[1]), 0.0]
+		elif isinstance(theerp, erp.BetaRandomPrimitive):
+			self.params = [math.log(float(params[0])/params[1]), 0.0]
+		else:
+			self.params = [0.0, 0.0]
+
+	def _toValue(self, z, params):
+		"""
+		Map an unconstrained value onto the ERP's support
+		Returns the value and the log absolute Jacobian of the mapping
+		"""
+		if isinstance(self.erp, erp.GammaRandomPrimitive):
+			return math.exp(z), z
+		if isinstance(self.erp, erp.BetaRandomPrimitive):
+			s = _sigmoid(z)
+			return s, math.log(s) + math.log(1.0 - s)
+		if isinstance(self.erp, erp.UniformRandomPrimitive):
+			lo, hi = params
+			s = _sigmoid(z)
+			return lo + (hi - lo)*s, math.log(hi - lo) + math.log(s) + math.log(1.0 - s)
+		return z, 0.0
+
+	def _fromValue(self, val, params):
+		if isinstance(self.erp, erp.GammaRandomPrimitive):
+			return math.log(val)
+		if isinstance(self.erp, erp.BetaRandomPrimitive):
+			return math.log(val) - math.log(1.0 - val)
+		if isinstance(self.erp, erp.UniformRandomPrimitive):
+			s = float(val - params[0]) / (params[1] - params[0])
+			return math.log(s) - math.log(1.0 - s)
+		return val
+
+	def sample(self, params, rng):
+		mu, logsigma = self.params
+		z = rng.gauss(mu, math.exp(logsigma))
+		val, logdet = self._toValue(z, params)
+		return val, erp.gaussian_logprob(z, mu, math.exp(logsigma)) - logdet
+
+	def gradLogprob(self, val, params):
+		mu, logsigma = self.params
+		z = self._fromValue(val, params)
+		d = (z - mu) / math.exp(logsigma)
+		return [d / math.exp(logsigma), d*d - 1.0]
+
+
+class _CategoricalSite:
+	"""
+	Guide factor for a discrete variable: a categorical distribution
+	over the variable's values, parameterized by logits
+	"""
+
+	def __init__(self, theerp, params):
+		self.erp = theerp
+		if isinstance(theerp, erp.FlipRandomPrimitive):
+			probs = [1.0 - params[0], params[0]]
+		elif isinstance(theerp, erp.RandomIntegerRandomPrimitive):
+			probs = [1.0 / params[0]] * params[0]
+		else:
+			probs = params
+		self.params = map(lambda p: math.log(max(p, 1e-10)), probs)
+
+	def _probs(self):
+		lse = erp.logsumexp(self.params)
+		return map(lambda l: math.exp(l - lse), self.params)
+
+	def _index(self, val):
+		return int(bool(val)) if isinstance(self.erp, erp.FlipRandomPrimitive) else val
+
+	def sample(self, params, rng):
+		probs = self._probs()
+		i = erp.multinomial_sample(probs, rng)
+		val = (i == 1) if isinstance(self.erp, erp.FlipRandomPrimitive) else i
+		return val, math.log(probs[i])
+
+	def gradLogprob(self, val, params):
+		i = self._index(val)
+		return [(1.0 if j == i else 0.0) - p for j, p in enumerate(self._probs())]
+
+
+class _PriorSite:
+	"""
+	Guide factor for variables that have no variational family:
+	they are drawn from their ERP, which contributes no gradient
+	"""
+
+	def __init__(self, theerp, params):
+		self.erp = theerp
+		self.params = []
+
+	def sample(self, params, rng):
+		val = self.erp._sample_impl(params, rng)
+		return val, self.erp._logprob(val, params)
+
+	def gradLogprob(self, val, params):
+		return []
+
+
+def _makeSite(theerp, params):
+	if isinstance(theerp, (erp.GaussianRandomPrimitive, erp.GammaRandomPrimitive, \
+						   erp.BetaRandomPrimitive, erp.UniformRandomPrimitive)):
+		site = _GaussianSite(theerp, params)
+	elif isinstance(theerp, (erp.FlipRandomPrimitive, erp.MultinomialRandomPrimitive, erp.RandomIntegerRandomPrimitive)):
+		site = _CategoricalSite(theerp, params)
+	else:
+		site = _PriorSite(theerp, params)
+	# Optimizer state
+	site.m = [0.0]*len(site.params)
+	site.v = [0.0]*len(site.params)
+	return site
+
+
+class MeanFieldGuide:
+	"""
+	Fully factorized approximate posterior over the random choices of a
+	program, with one independent factor per address.
+	Continuous variables get Gaussian factors; flip, multinomial and
+	randomInteger variables get categorical ones. Factors are created the first time
+	their address is reached.
+	"""
+
+	def __init__(self):
+		self.sites = {}
+
+	def site(self, name, theerp, params):
+		site = self.sites.get(name)
+		if site is None or site.erp is not theerp or \
+		   (theerp is erp.multinomial and len(site.params) != len(params)) or \
+		   (theerp is erp.randomInteger and len(site.params) != params[0]):
+			site = _makeSite(theerp, params)
+			self.sites[name] = site
+		return site
+
+	def sampleSite(self, name, theerp, params, rng):
+		"""
+		Draw a value for the variable at address 'name'
+		Returns the value and its log probability under the guide
+		"""
+		return self.site(name, theerp, params).sample(params, rng)
+
+	def sample(self, computation, numsamps, seed=None):
+		"""
+		Draw independent samples of a computation from the guide, with no MCMC.
+		Executions that violate the computation's conditions are rejected.
+		"""
+		rng = randomstream.makeStream(seed)
+		samps = []
+		while len(samps) < numsamps:
+			t = trace.guidedTrace(computation, self, rng)
+			if t.conditionsSatisfied:
+				samps.append((t.returnValue, t.logprob))
+		return samps
+
+
+def fitMeanField(computation, numsteps=1000, batchSize=10, learningRate=0.3, verbose=False, seed=None):
+	"""
+	Fit a MeanFieldGuide to the posterior of a computation by stochastic
+	maximization of the evidence lower bound.
+	Gradients are score-function estimates over batches of guided
+	executions, using the mean of the rest of the batch as each execution's
+	baseline; steps are taken with Adam, at a step size of
+	learningRate / (1 + step/100), which stays near 'learningRate' for the
+	first hundred or so steps and then decays as 1/step (a Robbins-Monro
+	schedule), and the fitted parameters are the average of the iterates
+	over the second half of the steps.
+	Executions that violate the computation's conditions are left out of
+	their batch.
+	"""
+	rng = randomstream.makeStream(seed)
+	guide = MeanFieldGuide()
+	beta1 = 0.9
+	beta2 = 0.999
+	# Running sums of the parameters of each site, and the number of steps summed
+	averages = {}
+	for step in xrange(1, numsteps+1):
+		if step > numsteps // 2:
+			for site in guide.sites.itervalues():
+				sums = averages.setdefault(site, [[0.0]*len(site.params), 0])
+				for i in xrange(len(site.params)):
+					sums[0][i] += site.params[i]
+				sums[1] += 1
+		traces = filter(lambda t: t.conditionsSatisfied, \
+						[trace.guidedTrace(computation, guide, rng) for b in xrange(batchSize)])
+		if len(traces) < 2:
+			continue
+		elbos = map(lambda t: t.logprob - t.guidelogprob, traces)
+		if any(math.isinf(e) or math.isnan(e) for e in elbos):
+			continue
+		total = sum(elbos)
+		grads = {}
+		for t, elbo in zip(traces, elbos):
+			weight = (elbo - (total - elbo)/(len(traces) - 1)) / len(traces)
+			for name, record in t._vars.iteritems():
+				if record.conditioned:
+					continue
+				site = guide.site(name, record.erp, record.params)
+				g = grads.setdefault(site, [0.0]*len(site.params))
+				for i, gi in enumerate(site.gradLogprob(record.val, record.params)):
+					g[i] += weight*gi
+		stepSize = learningRate / (1.0 + step / 100.0)
+		for site, g in grads.iteritems():
+			m = site.m
+			v = site.v
+			for i in xrange(len(g)):
+				m[i] = beta1*m[i] + (1 - beta1)*g[i]
+				v[i] = beta2*v[i] + (1 - beta2)*g[i]*g[i]
+				mhat = m[i] / (1 - beta1**step)
+				vhat = v[i] / (1 - beta2**step)
+				site.params[i] += stepSize * mhat / (math.sqrt(vhat) + 1e-8)
+		if verbose:
+			print "iteration {0}, ELBO estimate {1}\r".format(step, total / len(traces)),
+	if verbose:
+		print ""
+	for site, (sums, count) in averages.iteritems():
+		site.params = [s / count for s in sums]
+	return guide
+
+
+def meanFieldVI(computation, numsamps, numsteps=1000, batchSize=10, learningRate=0.3, verbose=False, seed=None):
+	"""
+	Sample from a probabilistic computation by fitting a mean-field guide
+	to its posterior, then drawing samples from the guide
+	"""
+	rng = randomstream.makeStream(seed)
+	guide = fitMeanField(computation, numsteps, batchSize, learningRate, verbose, rng)
+	return guide.sample(computation, numsamps, rng)
@@ -0,0 +1,150 @@
+import trace
+import inference
+import randomstream
+import copy
+import math
+
+
+def reattachTrace(oldTrace, computation, rng):
+	"""
+	A trace of 'computation' that keeps the random choices of oldTrace
+	wherever their addresses match, re-scored under the new computation;
+	choices it makes that oldTrace lacks are drawn from their priors.
+	Addresses match when the new computation runs the same code as the old
+	one (e.g. the same function over new data or observations), or when both
+	are @program functions. oldTrace itself is left unchanged.
+	The new trace may not satisfy its conditions.
+	"""
+	newTrace = copy.deepcopy(oldTrace)
+	newTrace.reattach(computation, rng)
+	newTrace.traceUpdate()
+	return newTrace
+
+
+def _priorOnly(tr, other):
+	"""
+	Log probability of the unconditioned choices in one trace that the other lacks
+	"""
+	return sum(r.logprob for name, r in tr._vars.iteritems() if not r.conditioned and name not in other._vars)
+
+class _BridgeTrace(inference.LARJInterpolationTrace):
+	"""
+	Interpolation from a trace of an old computation to a trace of a new one.
+	Unlike in LARJ, the choices that only one of the traces makes are scored
+	by their priors on the other side, so that the path starts at the old
+	posterior (with new choices drawn from their priors) and ends at the
+	new posterior, and its log probabilities can weight samples.
+	"""
+
+	@property
+	def logprob(self):
+		return (1-self.alpha)*(self.trace1.logprob + _priorOnly(self.trace2, self.trace1)) + \
+			   self.alpha*(self.trace2.logprob + _priorOnly(self.trace1, self.trace2))
+
+
+def _bridgeStart(oldTrace, computation, rng, oldComputation):
+	"""
+	The bridge (at alpha = 0) from oldTrace, still attached to its own
+	computation, to its reattachment to the new computation
+	"""
+	oldComputation = (oldComputation if oldComputation is not None else oldTrace.computation)
+	if oldComputation is None:
+		raise ValueError("Bridging from a detached trace needs its old computation")
+	newTrace = reattachTrace(oldTrace, computation, rng)
+	oldTrace = copy.deepcopy(oldTrace)
+	oldTrace.reattach(oldComputation, rng)
+	return _BridgeTrace(oldTrace, newTrace)
+
+
+def warmStart(oldTrace, computation, numsamps, lag=1, annealSteps=0, oldComputation=None, kernel=None, \
+			  verbose=False, recorder=None, seed=None):
+	"""
+	Continue a chain after its computation has changed (e.g. new observations
+	have arrived), instead of starting a new one: the chain picks up from
+	oldTrace (e.g. the last trace kept by a TraceRecorder), reattached to the
+	new computation (see reattachTrace), and samples with 'kernel'
+	(single-variable MH by default).
+	If the change is large, 'annealSteps' steps of non-structural MH first
+	move the chain along a path that interpolates between the old and new
+	log probabilities; a trace whose computation has been detached (e.g. by
+	pickling) needs 'oldComputation' for this.
+	If the chain cannot be continued because the new trace violates its
+	conditions, it restarts from a rejection-initialized trace.
+	"""
+	rng = randomstream.makeStream(seed)
+	if annealSteps > 0:
+		bridge = _bridgeStart(oldTrace, computation, rng, oldComputation)
+		bridgeKernel = inference.RandomWalkKernel(structural=False)
+		if bridge.freeVarNames(structural=False):
+			for step in xrange(annealSteps):
+				bridge.alpha = float(step + 1) / annealSteps
+				bridge = bridgeKernel.next(bridge)
+		currTrace = bridge.trace2
+	else:
+		currTrace = reattachTrace(oldTrace, computation, rng)
+	if not currTrace.conditionsSatisfied:
+		currTrace = trace.newTrace(computation, rng)
+	return inference.mcmc(computation, (kernel if kernel else inference.RandomWalkKernel()), numsamps, lag, \
+						  verbose, recorder, None, False, None, currTrace)
+
+
+def _resample(particles, logweights, rng):
+	"""
+	Systematic resampling of particles by their log weights
+	"""
+	maxlw = max(logweights)
+	weights = [math.exp(lw - maxlw) for lw in logweights]
+	step = sum(weights) / len(particles)
+	u = rng.random() * step
+	resampled = []
+	cumulative = 0.0
+	for w, p in zip(weights, particles):
+		cumulative += w
+		while u < cumulative and len(resampled) < len(particles):
+			# Copies share their traces, which are never modified in place, but not their alpha
+			resampled.append(_BridgeTrace(p.trace1, p.trace2, p.alpha))
+			u += step
+	while len(resampled) < len(particles):
+		resampled.append(_BridgeTrace(p.trace1, p.trace2, p.alpha))
+	return resampled
+
+
+def smcUpdate(traces, computation, bridgeSteps=10, moveSteps=1, resampleThreshold=0.5, oldComputation=None, \
+			  verbose=False, seed=None):
+	"""
+	Update a population of posterior traces (e.g. every trace kept by a
+	TraceRecorder(keep=None), or the last traces of several chains) to the
+	posterior of a changed computation, with sequential Monte Carlo.
+	Each trace is reattached to the new computation (see reattachTrace); the
+	population is then moved through 'bridgeSteps' distributions that
+	interpolate between the old and new log probabilities, being reweighted,
+	resampled when its effective size drops below 'resampleThreshold' of its
+	size, and moved by 'moveSteps' steps of non-structural MH at each one.
+	Returns an equally weighted population of traces of the new computation;
+	[(t.returnValue, t.logprob) for t in traces] gives them as samples.
+	"""
+	rng = randomstream.makeStream(seed)
+	kernel = inference.RandomWalkKernel(structural=False)
+	particles = [_bridgeStart(t, computation, rng, oldComputation) for t in traces]
+	logweights = [0.0] * len(particles)
+	for step in xrange(bridgeSteps):
+		alpha = float(step + 1) / bridgeSteps
+		for i, p in enumerate(particles):
+			prevlp = p.logprob
+			p.alpha = alpha
+			logweights[i] = (logweights[i] + p.logprob - prevlp if p.conditionsSatisfied else -float('inf'))
+		if max(logweights) == -float('inf'):
+			raise ValueError("No trace satisfies the conditions of the changed computation")
+		maxlw = max(logweights)
+		weights = [math.exp(lw - maxlw) for lw in logweights]
+		ess = sum(weights)**2 / sum(w*w for w in weights)
+		if verbose:
+			print "alpha: {0:.3f}, effective population size: {1:.1f}".format(alpha, ess)
+		if ess < resampleThreshold * len(particles) or step == bridgeSteps - 1:
+			particles = _resample(particles, logweights, rng)
+			logweights = [0.0] * len(particles)
+		for i in xrange(len(particles)):
+			if particles[i].freeVarNames(structural=False):
+				for m in xrange(moveSteps):
+					particles[i] = kernel.next(particles[i])
+	return [p.trace2 for p in particles]
@@ -1,8 +1,16 @@
 from probabilistic import *
+from probabilistic.inference import mcmc, RandomWalkKernel, SliceSamplingKernel
+from probabilistic.erp import gaussian_logprob, logsumexp
 import math
 from collections import Counter
 import cProfile
 import pstats
+import time
+import threading
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 ###############################
 
@@ -280,6 +288,163 @@ def totalVariationDist(P, Q):
 	return 0.5*total
 
 
+def benchmarkRandomStreams(draws, iters):
+	"""
+	Compare unbuffered and NumPy-buffered random streams, on raw ERP draws and on
+	full traceMH runs
+	"""
+	erps = [("flip", flip, [0.5]), ("gaussian", gaussian, [10, 0.5]), ("gamma", gamma, [9, 0.5]), \
+			("poisson", poisson, [10]), ("binomial", binomial, [0.5, 40])]
+	for streamType in [RandomStream, BufferedRandomStream]:
+		print streamType.__name__
+		for name, generator, params in erps:
+			rng = streamType(0)
+			t0 = time.time()
+			for i in xrange(draws):
+				generator._sample_impl(params, rng)
+			print "  {0} draws/sec: {1:.0f}".format(name, draws / (time.time() - t0))
+		for name, computation in [("sumOfTen", sumOfTen), ("onePoisson", onePoisson)]:
+			t0 = time.time()
+			traceMH(computation, iters, 1, False, None, streamType(0))
+			print "  traceMH {0} iters/sec: {1:.0f}".format(name, iters / (time.time() - t0))
+
+def benchmarkLogprobs(evals, chains):
+	"""
+	Throughput of ERP log probability evaluations, scalar and (over
+	'chains' values at once) vectorized
+	"""
+	erps = [("flip", flip, True, [0.3]), ("gaussian", gaussian, 10.3, [10, 0.5]), ("gamma", gamma, 4.1, [9, 0.5]), \
+			("beta", beta, 0.3, [2, 2]), ("binomial", binomial, 17, [0.5, 40]), ("poisson", poisson, 8, [10]), \
+			("dirichlet", dirichlet, [0.2, 0.3, 0.5], [1.0, 2.0, 3.0]), ("multinomial", multinomial, 1, [0.2, 0.3, 0.5]), \
+			("uniform", uniform, 0.4, [0, 1])]
+	for name, generator, val, params in erps:
+		t0 = time.time()
+		for i in xrange(evals):
+			generator._logprob(val, params)
+		print "  {0} logprobs/sec: {1:.0f}".format(name, evals / (time.time() - t0))
+	if numpy is None:
+		return
+	for name, generator, val, params in erps:
+		if generator.vectorized:
+			vals = generator._vsample(params, chains, numpy.random.RandomState(0))
+			t0 = time.time()
+			for i in xrange(evals / chains):
+				generator._vlogprob(vals, params)
+			print "  {0} vectorized logprobs/sec: {1:.0f}".format(name, evals / (time.time() - t0))
+
+def benchmarkMultinomial(k, draws):
+	"""
+	Draws and projected-out proposals for a multinomial over 'k' outcomes,
+	from a plain list of weights and from MultinomialWeights, and uniformDraw
+	"""
+	rng = RandomStream(0)
+	theta = [rng.random() for i in xrange(k)]
+	for name, params in [("list", theta), ("MultinomialWeights", MultinomialWeights(theta))]:
+		t0 = time.time()
+		for i in xrange(draws):
+			multinomial._sample_impl(params, rng)
+		print "  {0} draws/sec: {1:.0f}".format(name, draws / (time.time() - t0))
+		t0 = time.time()
+		for i in xrange(draws):
+			multinomial._logProposalProb(i, multinomial._proposal(i, params, rng), params)
+		print "  {0} proposals/sec: {1:.0f}".format(name, draws / (time.time() - t0))
+	items = range(k)
+	t0 = time.time()
+	for i in xrange(draws):
+		uniformDraw(items)
+	print "  uniformDraw draws/sec: {0:.0f}".format(draws / (time.time() - t0))
+
+def benchmarkServer(queries, numsamps, burnIn):
+	"""
+	Latency of small expectation queries on sprinklerTest, each run as a
+	cold traceMH chain with burn-in, and answered by an InferenceServer
+	"""
+	t0 = time.time()
+	for i in xrange(queries):
+		samps = traceMH(sprinklerTest, burnIn + numsamps)
+		mean(map(lambda s: float(s[0]), samps[burnIn:]))
+	print "  cold chains, ms/query: {0:.2f}".format(1000 * (time.time() - t0) / queries)
+	server = InferenceServer(burnIn=burnIn)
+	server.register("sprinkler", sprinklerTest)
+	server.start()
+	server.query("sprinkler", "distrib", 1)
+	t0 = time.time()
+	threads = [threading.Thread(target=server.query, args=("sprinkler", "distrib", numsamps)) for i in xrange(queries)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	print "  server, ms/query: {0:.2f}".format(1000 * (time.time() - t0) / queries)
+	print "  server metrics:", server.metrics()["sprinkler"]
+	server.close()
+
+def benchmarkTempering(iters, numChains=4):
+	"""
+	Effective sample size per second of single-chain traceMH and of
+	temperedMH, on a mixture of two well-separated gaussians (a chain
+	that mixes between them spends half its time in each)
+	"""
+	def bimodal():
+		x = gaussian(0.0, 2.0)
+		factor(logsumexp([gaussian_logprob(x, -4.0, 0.4), gaussian_logprob(x, 4.0, 0.4)]))
+		return x
+	for name, sampler in [("traceMH", lambda: traceMH(bimodal, iters)), \
+						  ("temperedMH", lambda: temperedMH(bimodal, iters, numChains, 50.0))]:
+		t0 = time.time()
+		xs = map(lambda s: s[0], sampler())
+		elapsed = time.time() - t0
+		ess = effectiveSampleSize(xs)
+		print "  {0}: ESS {1:.1f}, {2:.2f} sec, ESS/sec {3:.1f}, fraction in the right-hand mode {4:.2f}".format( \
+			name, ess, elapsed, ess / elapsed, mean(map(lambda x: float(x > 0), xs)))
+
+def benchmarkLazy(width, iters):
+	"""
+	traceMH on a model that makes 'width' gaussian choices but only
+	uses one of them, with eager and lazy ERPs
+	"""
+	for name, gen in [("eager", gaussian), ("lazy", lazy(gaussian))]:
+		def wide():
+			xs = [gen(0.0, 1.0) for i in xrange(width)]
+			k = randomInteger(width)
+			gaussian(xs[k], 0.5, conditionedValue=1.0)
+			return xs[k]
+		t0 = time.time()
+		traceMH(wide, iters)
+		print "  {0} iterations/sec: {1:.0f}".format(name, iters / (time.time() - t0))
+
+def benchmarkSlice(scale, iters):
+	"""
+	Effective sample size per execution of the computation for traceMH
+	and slice sampling, on a gaussian posterior of the given scale
+	"""
+	def scaled():
+		mu = gaussian(0.0, 1.0)
+		gaussian(mu * scale, scale * 0.1, conditionedValue=scale)
+		return mu
+	for name, kernel in [("traceMH", RandomWalkKernel()), ("slice", SliceSamplingKernel())]:
+		samps = mcmc(scaled, kernel, iters)
+		executions = (kernel.executions if hasattr(kernel, "executions") else kernel.proposalsMade)
+		ess = effectiveSampleSize(map(lambda s: s[0], samps))
+		print "  {0}: ESS {1:.1f}, executions {2}, ESS per 1000 executions {3:.2f}".format( \
+			name, ess, executions, 1000 * ess / executions)
+
+def benchmarkMAP(dims, iters):
+	"""
+	Log probability reached and executions used by MAP over traceMH
+	samples and by annealedMAP, on a mixture with 'dims' continuous variables
+	"""
+	def mixture():
+		c = flip(0.5)
+		mus = [gaussian(3.0 if c else -3.0, 1.0) for i in xrange(dims)]
+		for mu in mus:
+			gaussian(mu, 0.5, conditionedValue=2.0)
+		return mus
+	samps = traceMH(mixture, iters)
+	print "  MAP(traceMH): log probability {0:.4f}, executions {1}".format(max(map(lambda s: s[1], samps)), iters)
+	optimizer = MAPOptimizer(iters / 10)
+	best = optimizer.run(mixture, RandomStream())
+	print "  annealedMAP: log probability {0:.4f}, executions {1}".format(best.logprob, optimizer.executions)
+
 ###############################
 
 if __name__ == "__main__":
@@ -308,6 +473,14 @@ if __name__ == "__main__":
 	# print totalVariationDist(constrainedStringATrueDist(), distrib(constrainedStringA, LARJMH, 1000, 20, None, 1, True))
 	# print totalVariationDist(constrainedStringBTrueDist(), distrib(constrainedStringB, traceMH, 1000, 1, True))
 	# print totalVariationDist(constrainedStringBTrueDist(), distrib(constrainedStringB, LARJMH, 1000, 10, None, 1, True))
+	# benchmarkRandomStreams(200000, 20000)
+	# benchmarkLogprobs(200000, 1000)
+	# benchmarkMultinomial(100000, 1000)
+	# benchmarkServer(200, 100, 1000)
+	# benchmarkTempering(20000)
+	# benchmarkLazy(100, 3000)
+	# benchmarkSlice(1.0, 10000)
+	# benchmarkMAP(10, 20000)
 	cProfile.run('distrib(constrainedStringA, LARJMH, 1000, 20)', 'prof')
 	p = pstats.Stats('prof')
 	p.strip_dirs().sort_stats('cumulative').print_stats(10)